@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# anonymize.py - rewrite an mbox file or Maildir into a corpus that can be
+# shared for benchmarking, with the text replaced by random data of the same
+# shape
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   ./anonymize.py ~/Mail/archive.mbox corpus.mbox
+#   ./anonymize.py --key-file corpus.key ~/Mail/inbox corpus/
+#
+
+import argparse
+import base64
+import binascii
+import codecs
+import email.parser
+import email.policy
+import hmac
+import os
+import quopri
+import random
+import re
+import string
+import sys
+import unicodedata
+
+from decode import _PPV3_REGEX, find_decoder
+from mbox_follow import read_messages
+from url_scanner import TLDS, scan
+
+#
+# what decode_email.py spends its time on depends on the shape of a message,
+# not on what it says: the MIME tree, the size and transfer encoding of each
+# part, where the URLs are, and, for v3 URLs, the `*` and `**X` tokens and
+# the UTF-8 byte widths of the characters they stand for. anonymize() keeps
+# all of that, and replaces everything else:
+#
+#  - each word (a run of letters and digits: text, host names, path
+#    segments, org ids, recipient identifiers, ...) is replaced by a random
+#    word of the same length, with letters for letters (of the same case),
+#    digits for digits, and non-ASCII characters by characters of the same
+#    general category, from the same Unicode block, that take as many bytes
+#    in the part's charset. punctuation and whitespace are kept.
+#  - the randomness is drawn from an HMAC of the word with a key, so the same
+#    word is always replaced by the same word (e.g., a host name that appears
+#    in many URLs stays one host name), but the replacements can't be
+#    reversed without the key.
+#  - mangled URLs keep their gateway host and prefix (urldefense.com/v3/,
+#    ...), URL schemes and top-level domains are kept, so the same URLs are
+#    found in the same places, and v3 `*`/`**X` tokens are kept; the v3
+#    replacement characters are replaced like words, and base64-encoded
+#    again. percent escapes and v2 `-XX` escapes keep their format, but the
+#    bytes they stand for are replaced like words too (with random bytes of
+#    the same UTF-8 widths).
+#  - text parts are decoded (transfer encoding and charset), anonymized and
+#    encoded again the same way; other parts are replaced by random bytes of
+#    the same length. in text/html parts, tag and attribute names and
+#    entities are kept.
+#  - headers keep their names; Content-* headers (but for file names,
+#    Content-ID and Content-Description) and the Date are kept, and encoded
+#    words (=?charset?b?...?=) are decoded, anonymized and encoded again.
+#
+# 7bit, 8bit and base64 parts keep their exact size; quoted-printable ones
+# may change by a few bytes, where the escaping differs.
+#
+
+# headers that describe the structure of a message, not its contents
+STRUCTURE_HEADERS = ["mime-version", "date"]
+# Content-* headers that hold text, not structure
+CONTENT_TEXT_HEADERS = ["content-id", "content-description"]
+
+# words that the URL scanner and decoders depend on
+_SCHEMES = frozenset(["http", "https"])
+_TLDS = frozenset(TLDS.split("|"))
+_DOMAIN_WORDS = _TLDS | _SCHEMES
+
+_WORD_REGEX = re.compile(r"(?:%[0-9A-Fa-f]{2})+|[^\W_]+")
+_PERCENT_ESCAPE_REGEX = re.compile(r"%([0-9A-Fa-f]{2})")
+_ENCODED_WORD_REGEX = re.compile(r"=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?=")
+_TAG_REGEX = re.compile(r"<[^<>]*>")
+_TAG_NAMES_REGEX = re.compile(r"^</?[A-Za-z][\w:-]*|[\w:-]+(?=\s*=)")
+_ENTITY_REGEX = re.compile(r"&#?\w+;")
+_FILENAME_REGEX = re.compile(r"((?:file)?name\*?(?:\d+\*?)?=)(\"?)([^\";\r\n]*)")
+_HEADER_END_REGEX = re.compile(rb"\r?\n\r?\n")
+_FIELD_REGEX = re.compile(rb"(?m)^(?![ \t])")
+
+# the tokens that v3 URLs replace characters with (see decode_ppv3())
+_V3_TOKEN_REGEX = re.compile(r"((?<!\*)\*(?!\*)|\*{2}[A-Za-z0-9-_])")
+_V2_TOKEN_REGEX = re.compile(r"(^url|[?&][^=&]*=|(?:-(?:25)?[0-9A-Fa-f]{2})+|_)")
+# `-XX`, or `-25XX` for a percent escape in the URL (which is unquoted too)
+_V2_ESCAPE_REGEX = re.compile(r"-(?:25)?([0-9A-Fa-f]{2})")
+
+# MIME nesting deeper than this is anonymized as text
+MAX_DEPTH = 50
+
+
+class Anonymizer:
+    def __init__(self, key):
+        self.key = key
+        self.words = {}
+
+    def _rng(self, kind, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogatepass")
+        digest = hmac.new(self.key, kind.encode() + b"\0" + data, "sha256").digest()
+        return random.Random(digest)
+
+    def _char(self, rng, c, encoding):
+        if c in string.ascii_lowercase:
+            return rng.choice(string.ascii_lowercase)
+        if c in string.ascii_uppercase:
+            return rng.choice(string.ascii_uppercase)
+        if c in string.digits:
+            return rng.choice(string.digits)
+        category = unicodedata.category(c)
+        if c.isascii() or category in ["Cs", "Cn"]:
+            return c
+
+        # a character from the same block, of the same kind and width
+        try:
+            width = len(c.encode(encoding))
+        except (UnicodeEncodeError, LookupError):
+            return c
+        base = ord(c) & ~0x7F
+        for _ in range(32):
+            r = chr(base | rng.randrange(0x80))
+            if unicodedata.category(r) != category:
+                continue
+            try:
+                if len(r.encode(encoding)) == width:
+                    return r
+            except UnicodeEncodeError:
+                continue
+        return c
+
+    def word(self, word, encoding="utf-8", avoid=frozenset()):
+        """Returns the replacement for `word`, which isn't in `avoid`."""
+        key = (word, encoding, avoid)
+        if key not in self.words:
+            salt = 0
+            while True:
+                rng = self._rng(f"word{salt}", word)
+                r = "".join(self._char(rng, c, encoding) for c in word)
+                if r.lower() not in avoid or salt == 8:
+                    break
+                salt += 1
+            self.words[key] = r
+        return self.words[key]
+
+    def escapes(self, run, regex):
+        """Replaces the bytes that `run`, a run of escapes that `regex`
+        matches (with the hex digits in group 1), stands for, keeping the
+        format of the escapes."""
+        matches = list(regex.finditer(run))
+        data = bytes(int(m.group(1), 16) for m in matches)
+        rng = self._rng("escapes", data)
+
+        replaced = []
+        for c in data.decode("utf-8", "surrogateescape"):
+            if "\udc80" <= c <= "\udcff":
+                # a byte that isn't UTF-8: a lone continuation byte isn't
+                # either, whatever it follows
+                replaced.append(bytes([0x80 | rng.randrange(0x40)]))
+            else:
+                replaced.append(self._char(rng, c, "utf-8").encode("utf-8"))
+        data = b"".join(replaced)
+
+        hex_format = "02x" if any(c in "abcdef" for c in run) else "02X"
+        return "".join(
+            m.group(0)[: m.start(1) - m.start(0)] + format(b, hex_format)
+            for m, b in zip(matches, data)
+        )
+
+    def words_in(self, text, encoding="utf-8"):
+        """Replaces the words in `text`, keeping URL schemes and top-level
+        domains."""
+
+        def replace(match):
+            word = match.group(0)
+            lower = word.lower()
+            after_dot = match.start() > 0 and text[match.start() - 1] == "."
+            if word.startswith("%"):
+                return self.escapes(word, _PERCENT_ESCAPE_REGEX)
+            if lower in _SCHEMES:
+                return word
+            if after_dot:
+                if lower in _TLDS:
+                    return word
+                # don't make new domain names (i.e., URLs)
+                return self.word(word, encoding, _DOMAIN_WORDS)
+            return self.word(word, encoding, _SCHEMES)
+
+        return _WORD_REGEX.sub(replace, text)
+
+    def _v3(self, rest):
+        # rest: __URL__;REPLACEMENTS!!ORG!RECIPIENT$
+        ps = _PPV3_REGEX.search(rest)
+        if ps is None:
+            return self.words_in(rest)
+
+        pieces = _V3_TOKEN_REGEX.split(ps.group(1))
+        url = "".join(
+            piece if i % 2 else self.words_in(piece) for i, piece in enumerate(pieces)
+        )
+
+        # the replacement characters, with the same UTF-8 widths
+        replacement_b64 = ps.group(2)
+        try:
+            replacement = base64.urlsafe_b64decode(replacement_b64 + "==")
+        except (binascii.Error, ValueError):
+            replacement_b64 = self.words_in(replacement_b64)
+        else:
+            replacement = replacement.decode("utf-8", "surrogateescape")
+            rng = self._rng("v3", replacement)
+            replacement = "".join(self._char(rng, c, "utf-8") for c in replacement)
+            encoded = base64.urlsafe_b64encode(
+                replacement.encode("utf-8", "surrogateescape")
+            ).decode()
+            if "=" not in replacement_b64:
+                encoded = encoded.rstrip("=")
+            replacement_b64 = encoded
+
+        return (
+            rest[: ps.start()]
+            + f"__{url}__;{replacement_b64}!!"
+            + self.words_in(rest[ps.end() :])
+        )
+
+    def _v2(self, rest):
+        # rest: url?u=ENCODED_URL&d=...&c=ORG&r=RECIPIENT&...
+        pieces = _V2_TOKEN_REGEX.split(rest)
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0:
+                pieces[i] = self.words_in(piece)
+            elif piece.startswith("-"):
+                pieces[i] = self.escapes(piece, _V2_ESCAPE_REGEX)
+        return "".join(pieces)
+
+    def url(self, url, encoding="utf-8"):
+        """Returns an anonymized `url`, which, if it's mangled, is mangled
+        the same way."""
+        try:
+            decoder = find_decoder(url)
+        except ValueError:
+            decoder = None
+        if decoder is None:
+            return self.words_in(url, encoding)
+
+        # keep the gateway's scheme, host and prefix
+        prefix = re.match(
+            r"(?:[A-Za-z][A-Za-z0-9+.-]*://)?[^/]*" + re.escape(decoder.prefix), url
+        )
+        if prefix is None:
+            return self.words_in(url, encoding)
+        rest = url[prefix.end() :]
+        if decoder.name == "ppv3":
+            rest = self._v3(rest)
+        elif decoder.name == "ppv2":
+            rest = self._v2(rest)
+        else:
+            rest = self.words_in(rest, encoding)
+        return prefix.group(0) + rest
+
+    def text(self, text, encoding="utf-8", html=False):
+        """Returns an anonymized `text`, with its URLs in the same places."""
+        spans = [(start, end, True) for start, end in scan(text)]
+        if html:
+            # tag and attribute names, and entities
+            for tag in _TAG_REGEX.finditer(text):
+                spans.extend(
+                    (tag.start() + m.start(), tag.start() + m.end(), False)
+                    for m in _TAG_NAMES_REGEX.finditer(tag.group(0))
+                )
+            spans.extend(
+                (m.start(), m.end(), False) for m in _ENTITY_REGEX.finditer(text)
+            )
+            spans.sort()
+
+        parts = []
+        pos = 0
+        for start, end, is_url in spans:
+            if start < pos:
+                # (within a URL)
+                continue
+            parts.append(self.words_in(text[pos:start], encoding))
+            if is_url:
+                parts.append(self.url(text[start:end], encoding))
+            else:
+                parts.append(text[start:end])
+            pos = end
+        parts.append(self.words_in(text[pos:], encoding))
+        return "".join(parts)
+
+    def text_bytes(self, data, charset="utf-8", html=False):
+        try:
+            charset = codecs.lookup(charset).name
+        except LookupError:
+            charset = "utf-8"
+        text = data.decode(charset, "surrogateescape")
+        text = self.text(text, charset, html)
+        try:
+            return text.encode(charset, "surrogateescape")
+        except UnicodeEncodeError:
+            return text.encode(charset, "replace")
+
+    def opaque(self, data):
+        """Returns random bytes of the same length as `data`."""
+        return self._rng("bytes", data).randbytes(len(data))
+
+    def _encoded_word(self, match):
+        charset, encoding, payload = match.groups()
+        try:
+            if encoding in "bB":
+                data = base64.b64decode(payload + "==")
+            else:
+                data = binascii.a2b_qp(payload, header=True)
+            data = self.text_bytes(data, charset)
+        except (binascii.Error, ValueError):
+            return self.words_in(match.group(0))
+        if encoding in "bB":
+            payload = base64.b64encode(data).decode()
+        else:
+            payload = binascii.b2a_qp(data, header=True).decode().replace("?", "=3F")
+        return f"=?{charset}?{encoding}?{payload}?="
+
+    def header(self, field):
+        """Returns an anonymized header field ("Name: value\\n")."""
+        name, colon, value = field.partition(":")
+        if not colon:
+            return self.words_in(field)
+        lower = name.strip().lower()
+        if lower in STRUCTURE_HEADERS:
+            return field
+        if lower.startswith("content-") and lower not in CONTENT_TEXT_HEADERS:
+            value = _FILENAME_REGEX.sub(
+                lambda m: m.group(1) + m.group(2) + self.words_in(m.group(3)), value
+            )
+            return name + colon + value
+
+        pieces = []
+        pos = 0
+        for m in _ENCODED_WORD_REGEX.finditer(value):
+            pieces.append(self.text(value[pos : m.start()]))
+            pieces.append(self._encoded_word(m))
+            pos = m.end()
+        pieces.append(self.text(value[pos:]))
+        return name + colon + "".join(pieces)
+
+    def message(self, raw, depth=0):
+        """Returns an anonymized message (or MIME part), given as bytes."""
+        if depth > MAX_DEPTH:
+            return self.text_bytes(raw)
+
+        if raw.startswith(b"\n") or raw.startswith(b"\r\n"):
+            headers, sep, body = b"", b"", raw
+        else:
+            m = _HEADER_END_REGEX.search(raw)
+            if m is None:
+                headers, sep, body = raw, b"", b""
+            else:
+                headers, sep, body = raw[: m.start()], m.group(0), raw[m.end() :]
+
+        msg = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(
+            headers + b"\n\n"
+        )
+        fields = _FIELD_REGEX.split(headers)
+        headers = b"".join(
+            self.header(field.decode("utf-8", "surrogateescape")).encode(
+                "utf-8", "surrogateescape"
+            )
+            for field in fields
+        )
+        return headers + sep + self._body(body, msg, depth)
+
+    def _body(self, body, msg, depth):
+        boundary = msg.get_boundary()
+        if msg.get_content_maintype() == "multipart" and boundary:
+            return self._multipart(body, boundary, depth)
+
+        cte = str(msg.get("content-transfer-encoding", "7bit")).strip().lower()
+        try:
+            if cte == "base64":
+                data = base64.b64decode(body)
+            elif cte == "quoted-printable":
+                data = quopri.decodestring(body)
+            else:
+                data = body
+        except (binascii.Error, ValueError):
+            cte, data = "7bit", body
+
+        if msg.get_content_type() == "message/rfc822":
+            data = self.message(data, depth + 1)
+        elif msg.get_content_maintype() == "text":
+            charset = msg.get_content_charset() or "utf-8"
+            html = msg.get_content_subtype() == "html"
+            data = self.text_bytes(data, charset, html)
+        else:
+            data = self.opaque(data)
+
+        newline = b"\r\n" if b"\r\n" in body else b"\n"
+        if cte == "base64":
+            width = len(body.split(b"\n", 1)[0].rstrip(b"\r")) or 76
+            encoded = base64.b64encode(data)
+            data = newline.join(
+                encoded[i : i + width] for i in range(0, len(encoded), width)
+            )
+            if body.endswith(b"\n"):
+                data += newline
+        elif cte == "quoted-printable":
+            data = quopri.encodestring(data)
+            if newline == b"\r\n":
+                data = re.sub(rb"(?<!\r)\n", b"\r\n", data)
+        return data
+
+    def _multipart(self, body, boundary, depth):
+        delimiter = re.compile(
+            rb"(?m)^--" + re.escape(boundary.encode()) + rb"(--)?[ \t]*\r?$"
+        )
+        parts = []
+        pos = 0
+        for m in delimiter.finditer(body):
+            part = body[pos : m.start()]
+            if pos == 0:
+                # the preamble
+                parts.append(self.text_bytes(part))
+            else:
+                parts.append(self.message(part, depth + 1))
+            parts.append(body[m.start() : m.end() + 1])
+            pos = m.end() + 1
+            if m.group(1):
+                break
+        if pos == 0:
+            # no parts: anonymize as text
+            return self.text_bytes(body)
+
+        # the epilogue
+        parts.append(self.text_bytes(body[pos:]))
+        return b"".join(parts)
+
+    def from_line(self, line):
+        """Returns an anonymized mbox "From " line, keeping the date."""
+        sender, space, date = line[5:].partition(b" ")
+        sender = self.words_in(sender.decode("utf-8", "surrogateescape"))
+        return b"From " + sender.encode("utf-8", "surrogateescape") + space + date
+
+
+def anonymize_mbox(anonymizer, path, output):
+    """Writes the anonymized messages of the mbox file at `path` to the mbox
+    file `output`. Returns the number of messages."""
+    count = 0
+    with open(path, "rb") as f, open(output, "wb") as out:
+        end = os.fstat(f.fileno()).st_size
+        for _, _, raw in read_messages(f, 0, end):
+            line, newline, message = raw.partition(b"\n")
+            out.write(anonymizer.from_line(line) + newline)
+            out.write(anonymizer.message(message))
+            count += 1
+    return count
+
+
+def anonymize_maildir(anonymizer, path, output):
+    """Writes the anonymized messages of the Maildir at `path` to the
+    Maildir `output`, keeping their flags. Returns the number of
+    messages."""
+    for subdir in ["tmp", "new", "cur"]:
+        os.makedirs(os.path.join(output, subdir), exist_ok=True)
+
+    count = 0
+    for subdir in ["new", "cur"]:
+        for name in sorted(os.listdir(os.path.join(path, subdir))):
+            with open(os.path.join(path, subdir, name), "rb") as f:
+                raw = f.read()
+            # (the rest of the name has the host name in it)
+            info = name.partition(":")[1:]
+            new_name = f"{count}.anonymize" + "".join(info)
+            with open(os.path.join(output, subdir, new_name), "wb") as f:
+                f.write(anonymizer.message(raw))
+            count += 1
+    return count
+
+
+def anonymize(path, output, key):
+    """Writes an anonymized copy of the mbox file or Maildir at `path` to
+    `output`, using `key` (bytes). Returns the number of messages."""
+    anonymizer = Anonymizer(key)
+    if os.path.isdir(os.path.join(path, "cur")):
+        return anonymize_maildir(anonymizer, path, output)
+    return anonymize_mbox(anonymizer, path, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="rewrite an mbox file or Maildir into an anonymized corpus with the same MIME structure, sizes and URLs"
+    )
+    parser.add_argument(
+        "--key-file",
+        help="read the key from this file (creating it with a random key if it doesn't exist), so that runs replace the same words the same way; by default, a random key is used and forgotten",
+    )
+    parser.add_argument("input", help="mbox file or Maildir")
+    parser.add_argument("output", help="mbox file or Maildir to write")
+    args = parser.parse_args()
+
+    if args.key_file is None:
+        key = os.urandom(32)
+    else:
+        try:
+            with open(args.key_file, "rb") as f:
+                key = f.read()
+        except FileNotFoundError:
+            key = os.urandom(32)
+            fd = os.open(args.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(key)
+
+    count = anonymize(args.input, args.output, key)
+    print(f"{args.output}: {count} messages", file=sys.stderr)
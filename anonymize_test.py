@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import base64
+import email
+import email.policy
+import mailbox
+import os
+import quopri
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+from parameterized import parameterized
+
+from anonymize import Anonymizer, anonymize
+from decode import decode, identify
+from url_scanner import scan
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "anonymize.py")
+
+V2_URL = "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com_a-2Db-3Fc-3D1&d=DwMF&c=euGZstcaTDllvimEN8b7jXrwqOf-v5A_CdpgnVfiiMM&r=xyz123&m=abc&s=def&e="
+V3_URL = "https://urldefense.com/v3/__https://www.example.com/?=a1!b2@c3*d4$5e*6*5E7&8*9(10*7C*5C**B7D*7B__;IyUlKiUlW10lJQ!!Org1d!Recip1ent$"
+V3_URL_UTF8 = "https://urldefense.com/v3/__http://www.example.com/**E.html*abc__;5L2g5aW9w6k!!foo!bar$"
+
+HTML = (
+    '<html><body><p class="intro">Dear Alice,</p>'
+    f'<a href="{V3_URL}">click &amp; see</a> or www.example.org/page'
+    "</body></html>"
+)
+TEXT = (
+    f"Hello Alice, see {V3_URL_UTF8} and {V2_URL}.\n"
+    "Grüße aus 東京, http://plain.example.net/x?y=%20z\n"
+)
+
+
+def multipart():
+    return (
+        "From: Alice Example <alice@example.com>\n"
+        "To: =?utf-8?b?"
+        + base64.b64encode("Bøb".encode()).decode()
+        + "?= <bob@example.org>\n"
+        "Subject: Quarterly report\n"
+        "Date: Mon, 1 Jan 2024 00:00:00 +0000\n"
+        "MIME-Version: 1.0\n"
+        'Content-Type: multipart/mixed; boundary="XYZ"\n'
+        "\n"
+        "preamble text\n"
+        "--XYZ\n"
+        'Content-Type: multipart/alternative; boundary="ABC"\n'
+        "\n"
+        "--ABC\n"
+        "Content-Type: text/plain; charset=utf-8\n"
+        "Content-Transfer-Encoding: quoted-printable\n"
+        "\n" + quopri.encodestring(TEXT.encode()).decode() + "--ABC\n"
+        "Content-Type: text/html; charset=utf-8\n"
+        "Content-Transfer-Encoding: base64\n"
+        "\n" + base64.encodebytes(HTML.encode()).decode() + "--ABC--\n"
+        "--XYZ\n"
+        'Content-Type: application/pdf; name="secret-plans.pdf"\n'
+        "Content-Transfer-Encoding: base64\n"
+        "\n"
+        + base64.encodebytes(b"%PDF-1.4 secret contents" * 10).decode()
+        + "--XYZ--\n"
+        "epilogue\n"
+    ).encode("utf-8")
+
+
+def urls(text):
+    return [text[start:end] for start, end in scan(text)]
+
+
+class TestAnonymizer(unittest.TestCase):
+    def setUp(self):
+        self.anonymizer = Anonymizer(b"key")
+
+    @parameterized.expand(
+        [
+            ("v2", V2_URL),
+            ("v3", V3_URL),
+            ("v3_utf8", V3_URL_UTF8),
+        ]
+    )
+    def test_mangled_url(self, name, url):
+        anonymized = self.anonymizer.url(url)
+        self.assertEqual(len(anonymized), len(url))
+        self.assertNotIn("example", anonymized)
+
+        # decodes to a URL of the same shape
+        cleaned, original = decode(anonymized), decode(url)
+        self.assertNotEqual(cleaned, original)
+        self.assertEqual(len(cleaned.encode()), len(original.encode()))
+        self.assertEqual(len(cleaned), len(original))
+        self.assertEqual(
+            [len(c.encode()) for c in cleaned], [len(c.encode()) for c in original]
+        )
+        self.assertEqual(re.sub(r"\w", "", cleaned), re.sub(r"\w", "", original))
+
+        # with the same gateway, tokens and identifiers of the same shape
+        self.assertEqual(anonymized[:30], url[:30])
+        self.assertEqual(re.sub(r"\w", "", anonymized), re.sub(r"\w", "", url))
+        ids, original_ids = identify(anonymized), identify(url)
+        for field in ["org_id", "recipient"]:
+            self.assertNotEqual(ids[field], original_ids[field])
+            self.assertEqual(len(ids[field]), len(original_ids[field]))
+
+    def test_deterministic(self):
+        self.assertEqual(self.anonymizer.text(TEXT), Anonymizer(b"key").text(TEXT))
+        self.assertNotEqual(self.anonymizer.text(TEXT), Anonymizer(b"other").text(TEXT))
+
+        # the same word, the same replacement
+        words = self.anonymizer.text("alice example.com alice").split()
+        self.assertEqual(words[0], words[2])
+        self.assertIn(words[1], self.anonymizer.url("https://example.com/"))
+
+    @parameterized.expand(
+        [
+            ("plain", TEXT, False),
+            ("html", HTML, True),
+        ]
+    )
+    def test_text(self, name, text, html):
+        anonymized = self.anonymizer.text(text, html=html)
+        self.assertEqual(len(anonymized.encode()), len(text.encode()))
+        self.assertEqual(list(scan(anonymized)), list(scan(text)))
+        for word in ["Alice", "Grüße", "東京", "Dear", "click"]:
+            self.assertNotIn(word, anonymized)
+        if html:
+            self.assertEqual(
+                re.findall(r"<[^>]*?(?=[ >])|\w+=|&\w+;", anonymized),
+                re.findall(r"<[^>]*?(?=[ >])|\w+=|&\w+;", text),
+            )
+
+    @parameterized.expand(
+        [
+            ("percent", "http://x.com/%E5%BC%A0%E4%B8%89?q=%41%20%e9"),
+            (
+                "v2",
+                "https://urldefense.proofpoint.com/v2/url?u=http-3A__x.com_-E5-BC-A0-25E4-25B8-2589&d=DwMF&c=a&r=b&m=c&s=d&e=",
+            ),
+        ]
+    )
+    def test_escapes(self, name, url):
+        anonymized = self.anonymizer.url(url)
+        self.assertNotIn("%E5%BC%A0", anonymized)
+        self.assertNotIn("-E5-BC-A0", anonymized)
+
+        # the same escapes, standing for bytes of the same UTF-8 widths
+        escapes = r"[%-](?:25)?[0-9A-Fa-f]{2}"
+        self.assertEqual(
+            [m.span() for m in re.finditer(escapes, anonymized)],
+            [m.span() for m in re.finditer(escapes, url)],
+        )
+        cleaned, original = decode(anonymized, True), decode(url, True)
+        self.assertNotEqual(cleaned, original)
+        self.assertEqual(
+            [len(c.encode()) for c in cleaned], [len(c.encode()) for c in original]
+        )
+
+    def test_content_headers(self):
+        header = self.anonymizer.header
+        for field in [
+            "Content-ID: <part1.alice@example.com>\n",
+            "Content-Description: Alice's quarterly report\n",
+        ]:
+            anonymized = header(field)
+            self.assertNotIn("alice", anonymized.lower())
+            self.assertEqual(len(anonymized), len(field))
+            self.assertEqual(anonymized.split(":")[0], field.split(":")[0])
+        field = 'Content-Type: text/plain; charset="utf-8"\n'
+        self.assertEqual(header(field), field)
+
+    def test_no_new_urls(self):
+        text = " ".join(f"w{i}.x{i % 7}" for i in range(2000))
+        self.assertEqual(list(scan(self.anonymizer.text(text))), [])
+
+    def test_message(self):
+        raw = multipart()
+        anonymized = self.anonymizer.message(raw)
+        for secret in [b"Alice", b"Quarterly", b"secret", b"preamble", b"epilogue"]:
+            self.assertNotIn(secret, anonymized)
+
+        original = email.message_from_bytes(raw, policy=email.policy.default)
+        new = email.message_from_bytes(anonymized, policy=email.policy.default)
+        self.assertEqual(new["Date"], original["Date"])
+        self.assertIn(b"To: =?utf-8?b?", anonymized)
+        self.assertNotIn("Bøb", str(new["To"]))
+
+        original_parts = list(original.walk())
+        new_parts = list(new.walk())
+        self.assertEqual(
+            [p.get_content_type() for p in new_parts],
+            [p.get_content_type() for p in original_parts],
+        )
+        for o, n in zip(original_parts, new_parts):
+            self.assertEqual(
+                n["Content-Transfer-Encoding"], o["Content-Transfer-Encoding"]
+            )
+            if o.is_multipart():
+                continue
+            payload, new_payload = o.get_payload(decode=True), n.get_payload(
+                decode=True
+            )
+            self.assertEqual(len(new_payload), len(payload))
+            self.assertNotEqual(new_payload, payload)
+            if o.get_content_maintype() == "text":
+                self.assertEqual(len(urls(n.get_content())), len(urls(o.get_content())))
+
+        # base64 parts keep their size, line by line
+        self.assertEqual(
+            [len(line) for line in anonymized.split(b"\n")][-12:],
+            [len(line) for line in raw.split(b"\n")][-12:],
+        )
+
+    def test_not_a_message(self):
+        for raw in [b"", b"\n", b"no headers at all", b"Subject: x\n\n--\n"]:
+            self.assertEqual(len(self.anonymizer.message(raw)), len(raw))
+
+
+class TestAnonymize(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_mbox(self):
+        path = os.path.join(self.tmp.name, "in.mbox")
+        output = os.path.join(self.tmp.name, "out.mbox")
+        with open(path, "wb") as f:
+            for i in range(3):
+                f.write(b"From alice@example.com Mon Jan  1 00:00:00 2024\n")
+                f.write(multipart() + b"\n")
+
+        self.assertEqual(anonymize(path, output, b"key"), 3)
+        with open(output, "rb") as f:
+            data = f.read()
+        self.assertEqual(data.count(b"\nFrom "), 2)
+        self.assertTrue(data.startswith(b"From "))
+        self.assertTrue(data.split(b"\n")[0].endswith(b"Mon Jan  1 00:00:00 2024"))
+        self.assertNotIn(b"alice", data)
+        self.assertEqual(len(mailbox.mbox(output)), 3)
+
+    def test_maildir(self):
+        path = os.path.join(self.tmp.name, "Maildir")
+        output = os.path.join(self.tmp.name, "corpus")
+        maildir = mailbox.Maildir(path)
+        key = maildir.add(multipart())
+        msg = maildir.get_message(key)
+        msg.set_flags("RS")
+        msg.set_subdir("cur")
+        maildir[key] = msg
+        maildir.add(multipart())
+
+        self.assertEqual(anonymize(path, output, b"key"), 2)
+        self.assertEqual(len(os.listdir(os.path.join(output, "new"))), 1)
+        (name,) = os.listdir(os.path.join(output, "cur"))
+        self.assertTrue(name.endswith(":2,RS"))
+        self.assertNotIn(os.uname().nodename, name)
+
+    def test_command_line(self):
+        path = os.path.join(self.tmp.name, "in.mbox")
+        key_file = os.path.join(self.tmp.name, "key")
+        with open(path, "wb") as f:
+            f.write(b"From a@example.com Mon Jan  1 00:00:00 2024\n")
+            f.write(multipart() + b"\n")
+
+        outputs = []
+        for i in range(2):
+            output = os.path.join(self.tmp.name, f"out{i}.mbox")
+            subprocess.run(
+                [sys.executable, SCRIPT, "--key-file", key_file, path, output],
+                check=True,
+                capture_output=True,
+            )
+            with open(output, "rb") as f:
+                outputs.append(f.read())
+
+        # the same key, the same output
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(os.stat(key_file).st_mode & 0o777, 0o600)
+
+
+if __name__ == "__main__":
+    unittest.main()
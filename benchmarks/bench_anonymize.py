@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decode_email.py's message processing on a corpus and on its
+# anonymized copy (see anonymize.py), which should take about as long
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_anonymize.py [MBOX]
+#
+# without an mbox file, synthetic messages are used.
+#
+
+import base64
+import os
+import sys
+
+import corpus
+from anonymize import Anonymizer
+from decode_email import process_message
+from mbox_follow import read_messages
+
+
+def synthetic(count=100):
+    messages = []
+    for i in range(count):
+        text = corpus.text(num_lines=100, seed=i)
+        html = "".join(f"<p>{line}</p>\n" for line in text.splitlines())
+        messages.append(
+            (
+                "From: a@example.com\nSubject: newsletter\nMIME-Version: 1.0\n"
+                'Content-Type: multipart/alternative; boundary="b"\n\n'
+                "--b\nContent-Type: text/plain; charset=utf-8\n\n"
+                f"{text}--b\nContent-Type: text/html; charset=utf-8\n"
+                "Content-Transfer-Encoding: base64\n\n"
+                + base64.encodebytes(html.encode()).decode()
+                + "--b--\n"
+            ).encode()
+        )
+    return messages
+
+
+def process_all(messages):
+    for raw in messages:
+        process_message(raw.decode("utf-8", "surrogateescape"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            end = os.fstat(f.fileno()).st_size
+            messages = [
+                raw.partition(b"\n")[2] for _, _, raw in read_messages(f, 0, end)
+            ]
+    else:
+        messages = synthetic()
+
+    anonymizer = Anonymizer(os.urandom(32))
+    anonymized = [anonymizer.message(raw) for raw in messages]
+
+    size = sum(len(raw) for raw in messages) / 1e6
+    print(f"{len(messages)} messages, {size:.1f} MB")
+    print(f"{'corpus':>11} {'seconds':>8} {'MB':>6}")
+    for name, corpus_ in [("original", messages), ("anonymized", anonymized)]:
+        seconds = corpus.timeit(process_all, corpus_, repeat=3)
+        size = sum(len(raw) for raw in corpus_) / 1e6
+        print(f"{name:>11} {seconds:>8.3f} {size:>6.1f}")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: throughput of decode_async.decode_stream() and the longest
+# stall of the event loop while it runs, by offload_size
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_async.py
+#
+
+import asyncio
+import math
+import time
+
+import corpus
+from decode_async import decode_stream
+
+CHUNK_SIZE = 256 << 10
+
+
+async def run(text, offload_size):
+    stalls = []
+
+    async def heartbeat():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stalls.append(now - last - 0.001)
+            last = now
+
+    async def chunks():
+        for i in range(0, len(text), CHUNK_SIZE):
+            await asyncio.sleep(0)
+            yield text[i : i + CHUNK_SIZE]
+
+    task = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    async for _ in decode_stream(chunks(), offload_size=offload_size):
+        pass
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    return elapsed, max(stalls)
+
+
+if __name__ == "__main__":
+    text = corpus.text(num_lines=50000)
+    size = len(text) / 1e6
+    print(f"input: {size:.1f} MB, in chunks of {CHUNK_SIZE >> 10} KiB")
+    print(f"{'offload_size':>13} {'MB/s':>8} {'max stall (ms)':>15}")
+    for offload_size in [math.inf, 1 << 20, 64 << 10, 16 << 10, 4 << 10]:
+        elapsed, stall = asyncio.run(run(text, offload_size))
+        name = "never" if offload_size == math.inf else f"{offload_size >> 10} KiB"
+        print(f"{name:>13} {size / elapsed:>8.1f} {stall * 1000:>15.1f}")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decode_batch() against decode() on each URL of a list, in time
+# and memory per URL
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_batch.py
+#
+
+import random
+import tracemalloc
+
+import corpus
+from decode import decode
+from decode_batch import decode_batch, pack, unpack
+
+N = 100000
+
+
+def urls(n, seed=0):
+    rng = random.Random(seed)
+    choices = [corpus.V3_URL, corpus.V3_URL_UTF8, corpus.V2_URL, corpus.PLAIN_URL]
+    return [rng.choice(choices) for _ in range(n)]
+
+
+def one_at_a_time(urls):
+    return [decode(url) for url in urls]
+
+
+def batch(packed):
+    return decode_batch(*packed)
+
+
+def memory(fn, *args):
+    """Returns the peak memory (in bytes) allocated while calling fn(*args),
+    and the memory still held by its result."""
+    tracemalloc.start()
+    result = fn(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, current
+
+
+if __name__ == "__main__":
+    inputs = urls(N)
+    packed = pack(inputs)
+    assert list(unpack(*batch(packed)[:2])) == one_at_a_time(inputs)
+
+    t_list = corpus.timeit(one_at_a_time, inputs)
+    t_batch = corpus.timeit(batch, packed)
+    peak_list, held_list = memory(one_at_a_time, inputs)
+    peak_batch, held_batch = memory(batch, packed)
+
+    print(f"{N} URLs (per URL)")
+    print(f"{'':>14} {'time':>9} {'peak memory':>12} {'result':>8}")
+    for label, t, peak, held in [
+        ("decode()", t_list, peak_list, held_list),
+        ("decode_batch()", t_batch, peak_batch, held_batch),
+    ]:
+        print(
+            f"{label:>14} {t / N * 1e6:>7.2f}us {peak / N:>10.1f} B {held / N:>6.1f} B"
+        )
+    print(f"speedup: {t_list / t_batch:.1f}x")
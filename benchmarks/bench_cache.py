@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decode() with and without an on-disk decode cache
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_cache.py
+#
+
+import os
+import tempfile
+
+import corpus
+from decode import decode, set_cache
+from decode_cache import DecodeCache
+
+URLS = {
+    "v3": corpus.V3_URL,
+    "v3 utf-8": corpus.V3_URL_UTF8,
+    "v2": corpus.V2_URL,
+}
+
+# distinct URLs, as if from different messages; the cache is reopened for
+# each, like a process per message would
+N = 1000
+
+
+def decode_urls(urls):
+    for url in urls:
+        decode(url)
+
+
+def variants(url, n):
+    # the same mangled URL with different recipient identifiers (v3) or
+    # paths (v2), i.e., distinct URLs with distinct cache keys
+    if "/v3/" in url:
+        return [url.replace("__;", f"/{i}__;") for i in range(n)]
+    return [url.replace("foobar", f"foobar{i}") for i in range(n)]
+
+
+def lookups(cache, keys):
+    for key in keys:
+        cache.get(key)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        print(f"{'url':>10} {'no cache':>9} {'miss':>9} {'hit':>9} {'lookup':>9}")
+        for label, url in URLS.items():
+            urls = variants(url, N)
+
+            set_cache(None)
+            t_none = corpus.timeit(decode_urls, urls)
+
+            def run():
+                with DecodeCache(path) as cache:
+                    set_cache(cache)
+                    decode_urls(urls)
+                set_cache(None)
+                return cache
+
+            def cold():
+                os.path.exists(path) and os.unlink(path)
+                run()
+
+            t_miss = corpus.timeit(cold)
+            t_hit = corpus.timeit(run)
+            assert run().hits == N
+
+            # just the lookup, of keys like decode() makes
+            keys = [f"key {i}" for i in range(N)]
+            with DecodeCache(path) as cache:
+                for key in keys:
+                    cache.put(key, url)
+            with DecodeCache(path) as cache:
+                t_lookup = corpus.timeit(lookups, cache, keys)
+
+            print(
+                f"{label:>10} {t_none / N * 1e6:>7.2f}us {t_miss / N * 1e6:>7.2f}us "
+                f"{t_hit / N * 1e6:>7.2f}us {t_lookup / N * 1e6:>7.2f}us"
+            )
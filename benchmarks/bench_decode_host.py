@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decode_host() against a full decode() followed by urlparse()
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_decode_host.py
+#
+
+import base64
+import urllib.parse
+
+import corpus
+from decode import decode, decode_host
+
+LONG_V3_URL = (
+    "https://urldefense.com/v3/__https://www.example.com/"
+    + "*a" * 100
+    + "__;"
+    + base64.urlsafe_b64encode(b"#" * 100).decode("ascii")
+    + "!!foo!bar$"
+)
+
+URLS = {
+    "v3": corpus.V3_URL,
+    "v3 utf-8": corpus.V3_URL_UTF8,
+    "v3 long": LONG_V3_URL,
+    "v2": corpus.V2_URL,
+    "plain": corpus.PLAIN_URL,
+}
+
+
+def full(urls):
+    for url in urls:
+        urllib.parse.urlparse(decode(url)).hostname
+
+
+def host_only(urls):
+    for url in urls:
+        decode_host(url)
+
+
+if __name__ == "__main__":
+    print(f"{'url':>10} {'decode+urlparse':>16} {'decode_host':>12} {'speedup':>8}")
+    for label, url in URLS.items():
+        urls = [url] * 10000
+        assert decode_host(url) == urllib.parse.urlparse(decode(url)).hostname
+        t_full = corpus.timeit(full, urls)
+        t_host = corpus.timeit(host_only, urls)
+        print(
+            f"{label:>10} {t_full / len(urls) * 1e6:>14.2f}us "
+            f"{t_host / len(urls) * 1e6:>10.2f}us {t_full / t_host:>7.1f}x"
+        )
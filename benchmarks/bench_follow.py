@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: the cost of a run of follow() against the size of the mbox, when
+# a few messages have been appended since the last run
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_follow.py
+#
+
+import os
+import tempfile
+
+import corpus
+from mbox_follow import follow
+
+MESSAGE = (
+    "From sender@example.com Mon Jan  1 00:00:00 2024\n"
+    "Subject: newsletter\n\n"
+    f"{corpus.V3_URL}\n{corpus.V2_URL}\n{corpus.PLAIN_URL}\n\n"
+).encode()
+
+# messages appended between runs
+NEW = 10
+
+
+def append(path, n):
+    with open(path, "ab") as f:
+        f.write(MESSAGE * n)
+
+
+def process(raw):
+    pass
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'messages':>9} {'full read':>10} {'follow':>10}")
+        for size in [1000, 10000, 100000]:
+            path = os.path.join(tmp, f"mbox{size}")
+            checkpoint = f"{path}.ckpt"
+            append(path, size)
+            follow(path, checkpoint, process)
+
+            def full():
+                os.path.exists(checkpoint) and os.unlink(checkpoint)
+                follow(path, checkpoint, process)
+
+            def incremental():
+                append(path, NEW)
+                follow(path, checkpoint, process)
+
+            t_full = corpus.timeit(full)
+            t_follow = corpus.timeit(incremental)
+            print(f"{size:>9} {t_full * 1e3:>8.2f}ms {t_follow * 1e3:>8.2f}ms")
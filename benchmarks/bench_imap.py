@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: imap_rewrite.py against a stand-in IMAP server (from
+# imap_rewrite_test.py) with simulated network latency, by batch size. a
+# batch size of 1 costs a round trip per command per message; larger
+# batches fetch, store and expunge in one command each, and pipeline their
+# APPENDs.
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_imap.py [LATENCY_MS]
+#
+# LATENCY_MS defaults to 10.
+#
+
+import imaplib
+import sys
+import time
+
+import corpus
+from imap_rewrite import rewrite_folder
+from imap_rewrite_test import FakeImapServer, message
+
+NUM_MESSAGES = 200
+
+if __name__ == "__main__":
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.01
+
+    bodies = [corpus.text(num_lines=20, seed=i) for i in range(NUM_MESSAGES)]
+    print(f"{NUM_MESSAGES} messages, {latency * 1000:.0f} ms latency")
+    print(f"{'batch size':>11} {'seconds':>8} {'messages/s':>11}")
+    for batch_size in [1, 10, 100]:
+        with FakeImapServer(latency=latency) as server:
+            for i, body in enumerate(bodies):
+                server.mailboxes["INBOX"].add(message(i, body))
+            imap = imaplib.IMAP4("127.0.0.1", server.port)
+            imap.login("bench", "bench")
+
+            start = time.perf_counter()
+            counts = rewrite_folder(imap, "INBOX", batch_size=batch_size)
+            seconds = time.perf_counter() - start
+            imap.logout()
+
+        print(f"{batch_size:>11} {seconds:>8.2f} {counts['messages'] / seconds:>11.1f}")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: rewriting an mbox in place with mbox_rewrite.py, against a plain
+# copy of the file and against decoding every message
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_mbox_rewrite.py
+#
+
+import os
+import random
+import shutil
+import tempfile
+
+import corpus
+from decode_email import process_message_with_budget
+from mbox_follow import read_messages
+from mbox_rewrite import rewrite_mbox
+
+N = 10000
+
+
+def mbox(path, n, mangled, seed=0):
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        for i in range(n):
+            body = corpus.text(num_lines=60, url_ratio=0.1, mangled_ratio=0, seed=i)
+            if rng.random() < mangled:
+                body += corpus.V3_URL + "\n"
+            f.write(
+                (
+                    f"From a@example.com Mon Jan  1 00:00:00 2024\n"
+                    f"From: a@example.com\nSubject: {i}\n\n{body}\n"
+                ).encode()
+            )
+
+
+def every_message(src, dst):
+    # what piping each message through decode_email.py amounts to
+    with open(src, "rb") as f, open(dst, "wb") as out:
+        for _, _, raw in read_messages(f, 0, os.path.getsize(src)):
+            output, _ = process_message_with_budget(raw, preserve_mbox_from=True)
+            out.write(output.encode())
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        original = os.path.join(tmp, "original")
+        path = os.path.join(tmp, "mbox")
+
+        def rewrite():
+            shutil.copyfile(original, path)
+            rewrite_mbox(path)
+
+        for mangled in [0, 0.001, 0.01]:
+            mbox(original, N, mangled)
+            size = os.path.getsize(original)
+
+            # (rewrite() includes making the copy it rewrites, so subtract it)
+            t_copy = corpus.timeit(shutil.copyfile, original, path)
+            t_rewrite = corpus.timeit(rewrite) - t_copy
+            t_every = corpus.timeit(every_message, original, path, repeat=1)
+
+            print(f"{N} messages, {size >> 20} MiB, {mangled:.1%} with mangled URLs")
+            for label, t in [
+                ("plain copy", t_copy),
+                ("mbox_rewrite", t_rewrite),
+                ("every message", t_every),
+            ]:
+                print(
+                    f"{label:>14} {t * 1e3:>9.1f}ms {size / t / (1 << 20):>8.1f} MiB/s"
+                )
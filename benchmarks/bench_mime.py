@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: walking the MIME tree of synthetic 5,000-part digests, where
+# every part (or only a few) is text
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_mime.py
+#
+
+import collections
+import email, email.policy
+
+import corpus
+from decode_email import process_payload
+
+NUM_PARTS = 5000
+
+
+def digest(num_parts, text_ratio, seed=0):
+    # a multipart/digest of message/rfc822 parts, each either text/plain
+    # (with a mangled URL) or a base64 attachment
+    body = corpus.text(num_lines=5, url_ratio=1.0, mangled_ratio=1.0, seed=seed)
+    attachment = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==\n"
+    every = max(1, round(1 / text_ratio)) if text_ratio else num_parts + 1
+    parts = []
+    for i in range(num_parts):
+        if i % every == 0:
+            part = f"Content-Type: text/plain\n\n{body}"
+        else:
+            part = (
+                "Content-Type: image/png\n"
+                "Content-Transfer-Encoding: base64\n\n"
+                f"{attachment}"
+            )
+        parts.append(f"--d\n\nSubject: part {i}\n{part}")
+    return (
+        "MIME-Version: 1.0\n"
+        'Content-Type: multipart/digest; boundary="d"\n\n' + "".join(parts) + "--d--\n"
+    )
+
+
+def parse(message):
+    return email.message_from_string(message, policy=email.policy.default)
+
+
+if __name__ == "__main__":
+    print(
+        f"{'text parts':>10} {'MB':>6} {'parse s':>8} {'walk s':>8} "
+        f"{'str() s':>8}  per-depth parts"
+    )
+    for ratio in (1.0, 0.1, 0.01):
+        message = digest(NUM_PARTS, ratio)
+
+        parse_s = corpus.timeit(parse, message, repeat=3)
+
+        # process_payload modifies the message in place: time it on fresh
+        # copies, and keep the last one for the stats and str()
+        best = None
+        for _ in range(3):
+            e = parse(message)
+            stats = collections.Counter()
+            elapsed = corpus.timeit(process_payload, e, None, None, "", stats, repeat=1)
+            best = elapsed if best is None else min(best, elapsed)
+
+        str_s = corpus.timeit(str, e, repeat=3)
+
+        depths = " ".join(
+            f"{k[len('mime_depth_'):]}:{v}"
+            for k, v in sorted(stats.items())
+            if k.startswith("mime_depth_")
+        )
+        print(
+            f"{ratio:>10.0%} {len(message) / 1e6:>6.1f} {parse_s:>8.2f} "
+            f"{best:>8.2f} {str_s:>8.2f}  {depths} "
+            f"(skipped {stats['mime_parts_skipped']})"
+        )
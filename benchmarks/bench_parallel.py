@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: `decode_email.py --plaintext --jobs N FILE` scaling with N
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_parallel.py [MAX_JOBS]
+#
+# MAX_JOBS defaults to the number of CPUs. speedups are relative to --jobs 1.
+#
+
+import io
+import os
+import sys
+import tempfile
+
+import corpus
+
+import decode_email
+
+if __name__ == "__main__":
+    max_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+
+    jobs = [1]
+    while jobs[-1] * 2 <= max_jobs:
+        jobs.append(jobs[-1] * 2)
+    if jobs[-1] != max_jobs:
+        jobs.append(max_jobs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input.txt")
+        with open(path, "w") as f:
+            chunk = corpus.text(num_lines=20000)
+            for _ in range(8):
+                f.write(chunk)
+        size = os.path.getsize(path) / 1e6
+
+        print(f"input: {size:.1f} MB, {os.cpu_count()} CPUs")
+        print(f"{'jobs':>5} {'seconds':>10} {'MB/s':>8} {'speedup':>8}")
+        baseline = None
+        for n in jobs:
+            seconds = corpus.timeit(
+                lambda: decode_email.process_text_parallel(
+                    path, io.StringIO(), n, range_size=1 << 20
+                ),
+                repeat=3,
+            )
+            baseline = baseline or seconds
+            print(
+                f"{n:>5} {seconds:>10.2f} {size / seconds:>8.1f} {baseline / seconds:>8.2f}"
+            )
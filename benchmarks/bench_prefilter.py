@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: processing messages with a large base64 or quoted-printable
+# HTML part, with and without the transfer-encoding-aware prefilter
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_prefilter.py
+#
+
+import email.message
+
+import corpus
+import decode_email
+
+
+def message(cte, mangled_ratio):
+    html = corpus.text(num_lines=20000, url_ratio=0.1, mangled_ratio=mangled_ratio)
+    e = email.message.EmailMessage()
+    e["Subject"] = "benchmark"
+    e.set_content(html, subtype="html", cte=cte)
+    return str(e)
+
+
+if __name__ == "__main__":
+    print(
+        f"{'encoding':>16} {'mangled':>8} {'MB':>6} {'no prefilter':>13} {'prefilter':>10}"
+    )
+    for cte in ("base64", "quoted-printable"):
+        for mangled_ratio in (0.0, 0.5):
+            m = message(cte, mangled_ratio)
+
+            may_contain_anchor = decode_email.may_contain_anchor
+            decode_email.may_contain_anchor = lambda body, encoding: True
+            without = corpus.timeit(decode_email.process_message, m)
+            decode_email.may_contain_anchor = may_contain_anchor
+            with_ = corpus.timeit(decode_email.process_message, m)
+
+            print(
+                f"{cte:>16} {mangled_ratio:>8.0%} {len(m) / 1e6:>6.1f} "
+                f"{without:>12.3f}s {with_:>9.3f}s"
+            )
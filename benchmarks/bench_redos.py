@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: URL extraction on adversarial inputs, URL_REGEX vs. url_scanner
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_redos.py
+#
+# URL_REGEX is only run on the small inputs (and given up on after a few
+# seconds): on some of these families it's exponential in n.
+#
+
+import multiprocessing
+import re
+import time
+
+import corpus
+
+import url_scanner
+
+FAMILIES = {
+    "trailing punctuation": lambda n: "http://a/" + "!" * n + " ",
+    "open parens": lambda n: "http://a/" + "(" * n,
+    "unbalanced parens": lambda n: "http://a/" + "(a)" * n + "(",
+    "nested parens": lambda n: "http://a/" + "((a)" * n,
+    "brackets": lambda n: "http://a/(" + "[x]" * n,
+    "repeated schemes": lambda n: "http://" * n,
+    "dotted labels": lambda n: "a." * n + "x",
+    "dotted domains": lambda n: "a.com" * n,
+}
+
+REGEX_SIZES = (10, 20, 1000, 10000)
+SCANNER_SIZES = (1000, 10000, 100000, 1000000)
+REGEX_TIMEOUT = 5
+
+
+def _regex(text, conn):
+    start = time.perf_counter()
+    re.findall(url_scanner.URL_REGEX, text)
+    conn.send(time.perf_counter() - start)
+
+
+def time_regex(text):
+    parent, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=_regex, args=(text, child))
+    p.start()
+    if parent.poll(REGEX_TIMEOUT):
+        elapsed = parent.recv()
+    else:
+        elapsed = None
+        p.kill()
+    p.join()
+    return elapsed
+
+
+def time_scanner(text):
+    return corpus.timeit(lambda: list(url_scanner.scan(text)), repeat=1)
+
+
+def fmt(seconds):
+    return f">{REGEX_TIMEOUT}s" if seconds is None else f"{seconds:.4f}"
+
+
+if __name__ == "__main__":
+    # compile once, outside of the timings
+    re.compile(url_scanner.URL_REGEX)
+
+    header = " ".join(f"{n:>9}" for n in REGEX_SIZES)
+    print(f"{'URL_REGEX, seconds for n =':<28} {header}")
+    for name, family in FAMILIES.items():
+        times = " ".join(f"{fmt(time_regex(family(n))):>9}" for n in REGEX_SIZES)
+        print(f"{name:<28} {times}")
+
+    print()
+    header = " ".join(f"{n:>9}" for n in SCANNER_SIZES)
+    print(f"{'url_scanner, µs per char, n =':<28} {header}")
+    for name, family in FAMILIES.items():
+        times = []
+        for n in SCANNER_SIZES:
+            text = family(n)
+            times.append(f"{time_scanner(text) / len(text) * 1e6:>9.3f}")
+        print(f"{name:<28} {' '.join(times)}")
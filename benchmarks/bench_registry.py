@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: URL rewriting with 1, 5 and 20 registered decoders
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_registry.py
+#
+# the extra decoders claim made-up hosts, so the work done per URL is the same
+# in every configuration: what changes is the size of the anchor alternation.
+#
+
+import corpus
+
+import decode
+import decode_email
+
+
+def configure(num_decoders):
+    for name in list(decode.decoders):
+        if name.startswith("bench"):
+            decode.unregister_decoder(name)
+
+    if num_decoders == 1:
+        builtin = decode.unregister_decoder("ppv2")
+    else:
+        builtin = None
+
+    for i in range(num_decoders - 2):
+        decode.register_decoder(
+            f"bench{i}",
+            [f"gateway{i}.example.net"],
+            "/r/",
+            lambda mangled_url, unquote_url: mangled_url,
+        )
+
+    return builtin
+
+
+if __name__ == "__main__":
+    texts = {
+        "10% urls": corpus.text(url_ratio=0.1),
+        "no mangled urls": corpus.text(url_ratio=0.1, mangled_ratio=0.0),
+    }
+
+    print(f"{'decoders':>8} {'input':>16} {'seconds':>10} {'MB/s':>8}")
+    for num_decoders in (1, 5, 20):
+        builtin = configure(num_decoders)
+        for label, t in texts.items():
+            seconds = corpus.timeit(decode_email.process_text, t)
+            mbps = len(t) / seconds / 1e6
+            print(f"{num_decoders:>8} {label:>16} {seconds:>10.4f} {mbps:>8.1f}")
+        if builtin is not None:
+            decode.register_decoder(*builtin)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: spool_queue.py throughput with 1, 2, 4 and 8 local worker
+# processes
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_spool.py
+#
+
+import mailbox
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import corpus
+from spool_queue import enqueue, work
+
+MAILDIRS = 8
+MESSAGES = 250
+
+
+def maildirs(tmp):
+    paths = []
+    for m in range(MAILDIRS):
+        path = os.path.join(tmp, f"Maildir{m}")
+        maildir = mailbox.Maildir(path)
+        for i in range(MESSAGES):
+            text = corpus.text(num_lines=50, seed=m * MESSAGES + i)
+            maildir.add(f"From: a@example.com\nSubject: {i}\n\n{text}".encode())
+        paths.append(path)
+    return paths
+
+
+def run(spool, paths, jobs):
+    enqueue(spool, paths, batch_size=50)
+    start = time.perf_counter()
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(work, [spool] * jobs)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(r["messages"] for r in results)
+
+
+if __name__ == "__main__":
+    print(f"{MAILDIRS * MESSAGES} messages, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'time':>9} {'messages/s':>11} {'speedup':>8}")
+    base = None
+    for jobs in [1, 2, 4, 8]:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = maildirs(tmp)
+            elapsed, n = run(os.path.join(tmp, "spool"), paths, jobs)
+        base = base or elapsed
+        print(
+            f"{jobs:>8} {elapsed:>8.2f}s {n / elapsed:>11.0f} {base / elapsed:>7.1f}x"
+        )
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: peak memory of `decode_email.py --plaintext` with and without
+# --stream, as the input grows
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_stream.py
+#
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+SCRIPT = os.path.join(os.path.dirname(corpus.__file__), "..", "decode_email.py")
+
+# runs decode_email.py in-process and reports its peak RSS (in KiB on linux)
+RUNNER = """
+import resource, runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    sys.stdout.flush()
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)
+"""
+
+
+def run(path, args):
+    with open(path) as infile:
+        start = time.perf_counter()
+        p = subprocess.run(
+            [sys.executable, "-c", RUNNER, SCRIPT] + args,
+            stdin=infile,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+    return elapsed, int(p.stderr.split()[-1])
+
+
+if __name__ == "__main__":
+    chunk = corpus.text(num_lines=20000)
+
+    print(f"{'input MB':>8} {'mode':>10} {'seconds':>10} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input.txt")
+        for copies in (4, 16, 64):
+            with open(path, "w") as f:
+                for _ in range(copies):
+                    f.write(chunk)
+            size = os.path.getsize(path) / 1e6
+
+            for mode, args in (("in-memory", ["-p"]), ("stream", ["-p", "-s"])):
+                elapsed, rss = run(path, args)
+                print(f"{size:>8.1f} {mode:>10} {elapsed:>10.2f} {rss / 1024:>12.1f}")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decoding on N threads, with a shared decode.UrlDecoder, scaling
+# with N. threads only run in parallel on a free-threaded build of Python
+# (e.g., python3.13t); run this with both to compare.
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_threads.py [MAX_THREADS]
+#
+# MAX_THREADS defaults to the number of CPUs. speedups are relative to a
+# single thread.
+#
+
+import concurrent.futures
+import io
+import os
+import sys
+import tempfile
+
+import corpus
+
+import decode_email
+from decode import UrlDecoder, iter_urls
+
+
+def decode_all(decoder, urls, threads):
+    # the URLs in `threads` slices, one per thread
+    size = -(-len(urls) // threads)
+    slices = [urls[i : i + size] for i in range(0, len(urls), size)]
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for _ in executor.map(lambda s: [decoder.decode(u) for u in s], slices):
+            pass
+
+
+if __name__ == "__main__":
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+
+    threads = [1]
+    while threads[-1] * 2 <= max_threads:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != max_threads:
+        threads.append(max_threads)
+
+    gil = "disabled" if decode_email.free_threaded() else "enabled"
+    print(f"Python {sys.version.split()[0]}, GIL {gil}, {os.cpu_count()} CPUs")
+
+    text = corpus.text(num_lines=20000)
+    urls = [m.raw for m in iter_urls(text) if m.version is not None] * 4
+    decoder = UrlDecoder()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "input.txt")
+        with open(path, "w") as f:
+            for _ in range(8):
+                f.write(text)
+        size = os.path.getsize(path) / 1e6
+
+        print(f"{len(urls)} URLs; {size:.1f} MB of text")
+        print(
+            f"{'threads':>8} {'URLs/s':>10} {'speedup':>8} {'MB/s':>8} {'speedup':>8}"
+        )
+        baseline = None
+        for n in threads:
+            url_seconds = corpus.timeit(decode_all, decoder, urls, n, repeat=3)
+            text_seconds = corpus.timeit(
+                lambda: decode_email.process_text_parallel(
+                    path, io.StringIO(), n, range_size=1 << 20, threads=True
+                ),
+                repeat=3,
+            )
+            baseline = baseline or (url_seconds, text_seconds)
+            print(
+                f"{n:>8} {len(urls) / url_seconds:>10.0f}"
+                f" {baseline[0] / url_seconds:>8.2f}"
+                f" {size / text_seconds:>8.1f} {baseline[1] / text_seconds:>8.2f}"
+            )
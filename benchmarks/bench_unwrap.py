@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+#
+# benchmark: decode() of nested mangled URLs, by depth and URL length, and
+# the cost of checking for another layer on URLs that aren't nested
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: python3 benchmarks/bench_unwrap.py
+#
+
+import corpus
+from decode import decode
+from decode_test import mangle_v3
+
+N = 1000
+
+
+def decode_urls(urls, max_depth):
+    for url in urls:
+        decode(url, max_depth=max_depth)
+
+
+def nested(url, depth):
+    for _ in range(depth):
+        url = mangle_v3(url)
+    return url
+
+
+if __name__ == "__main__":
+    print("not nested (per URL)")
+    print(f"{'url':>10} {'depth 1':>9} {'depth 4':>9}")
+    for label, url in [
+        ("v3", corpus.V3_URL),
+        ("v3 utf-8", corpus.V3_URL_UTF8),
+        ("v2", corpus.V2_URL),
+    ]:
+        urls = [url] * N
+        t_one = corpus.timeit(decode_urls, urls, 1)
+        t_four = corpus.timeit(decode_urls, urls, 4)
+        print(f"{label:>10} {t_one / N * 1e6:>7.2f}us {t_four / N * 1e6:>7.2f}us")
+
+    # time per byte of the outer URL stays flat as URLs get longer: linear
+    print()
+    print("nested (per byte of the outer URL)")
+    print(f"{'length':>8} {'1 layer':>9} {'2 layers':>9} {'3 layers':>9}")
+    for length in [100, 1000, 10000, 100000]:
+        inner = "https://www.example.com/" + "a*b" * (length // 3)
+        times = []
+        for depth in [1, 2, 3]:
+            url = nested(inner, depth)
+            t = corpus.timeit(decode_urls, [url], depth)
+            times.append(t / len(url) * 1e9)
+        print(f"{length:>8} " + " ".join(f"{t:>7.1f}ns" for t in times))
@@ -0,0 +1,60 @@
+#
+# synthetic inputs shared by the benchmarks in this directory
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import os
+import random
+import sys
+import time
+
+# make the scripts in the top-level directory importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+V2_URL = "https://urldefense.com/v2/url?u=https-3A__www.example.com_-23-23-23-23-23foobar&d=&c=&r=&m=&s=&e="
+V3_URL = "https://urldefense.com/v3/__http://example.com/?=a1!b2@c3*d4$5e*6*5E7&8*9(10*7C*5C**B7D*7B__;IyUlKiUlW10lJQ!!foo!bar$"
+V3_URL_UTF8 = (
+    "https://urldefense.com/v3/__http://www.example.com/**E.html__;5L2g5aW9!!foo!bar$"
+)
+PLAIN_URL = "https://www.example.org/some/path?with=query&and=more"
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+def text(num_lines=10000, url_ratio=0.1, mangled_ratio=0.5, seed=0):
+    """Returns lines of filler text where roughly `url_ratio` of the lines
+    carry a URL, and `mangled_ratio` of those URLs are proofpoint-mangled."""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(num_lines):
+        line = " ".join(rng.choice(WORDS) for _ in range(12))
+        if rng.random() < url_ratio:
+            if rng.random() < mangled_ratio:
+                url = rng.choice([V2_URL, V3_URL, V3_URL_UTF8])
+            else:
+                url = PLAIN_URL
+            line = f"{line} {url} {rng.choice(WORDS)}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def timeit(fn, *args, repeat=5):
+    """Returns the best wall-clock time (in seconds) of `repeat` calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+#
+# load test: replay a corpus of messages through decode_email.py, as mail
+# delivery does, and report latency percentiles, throughput, CPU time and
+# peak memory per configuration, as JSON
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   python3 benchmarks/load_test.py --concurrency 1,4 --rate 20,50 ~/Mail/inbox
+#   python3 benchmarks/load_test.py --mode process,follow --count 500 > load.json
+#
+# with no corpus (mbox files or Maildirs), synthetic messages are used.
+#
+
+import argparse
+import concurrent.futures
+import fcntl
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import corpus
+from mbox_follow import read_messages
+
+DECODE_EMAIL = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "decode_email.py"
+)
+
+#
+# each configuration is a mode, a concurrency and an arrival rate:
+#
+#   process  a fresh decode_email.py process per message, as procmail and
+#            fdm run it, with at most `concurrency` running at once
+#   follow   `concurrency` long-running `decode_email.py --checkpoint
+#            --follow` processes, each following its own mbox spool; messages
+#            are appended to the spools in turn (under the same locks as
+#            mail delivery agents take)
+#
+# messages arrive at `rate` per second (with exponentially distributed
+# gaps, i.e., a Poisson process), or, without a rate, all at once (a
+# delivery storm). a message's latency is from its arrival until its output
+# is complete, so it includes any time spent waiting for a free process (or
+# for the next poll): measuring from when it *started* would hide queueing,
+# which is what a storm is made of.
+#
+# CPU time and peak RSS are those of the decode_email.py processes (from
+# wait4()), not of this script.
+#
+MARKER = b"X-Load-Test"
+MARKER_REGEX = re.compile(rb"^X-Load-Test: (\d+)$", re.MULTILINE)
+
+FROM_LINE = b"From load-test@example.com Mon Jan  1 00:00:00 2024\n"
+
+
+def synthetic(count=50):
+    messages = []
+    for i in range(count):
+        body = corpus.text(num_lines=200, seed=i)
+        messages.append(
+            f"From: a@example.com\nTo: b@example.com\nSubject: {i}\n\n{body}".encode()
+        )
+    return messages
+
+
+def load_corpus(paths):
+    """Returns the messages (as bytes, without "From " lines) in the mbox
+    files and Maildirs in `paths`."""
+    messages = []
+    for path in paths:
+        if os.path.isdir(os.path.join(path, "cur")):
+            for subdir in ["new", "cur"]:
+                for name in sorted(os.listdir(os.path.join(path, subdir))):
+                    with open(os.path.join(path, subdir, name), "rb") as f:
+                        messages.append(f.read())
+        else:
+            with open(path, "rb") as f:
+                end = os.fstat(f.fileno()).st_size
+                for _, _, raw in read_messages(f, 0, end):
+                    messages.append(raw.partition(b"\n")[2])
+    return messages
+
+
+def arrivals(count, rate, seed=0):
+    """Returns the arrival time (in seconds from the start) of each of
+    `count` messages, at `rate` per second, or all at 0 if rate is None."""
+    if rate is None:
+        return [0.0] * count
+    rng = random.Random(seed)
+    times = []
+    t = 0.0
+    for _ in range(count):
+        times.append(t)
+        t += rng.expovariate(rate)
+    return times
+
+
+def percentile(values, p):
+    """Returns the `p`th percentile of `values` (nearest rank)."""
+    values = sorted(values)
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def _sleep_until(t):
+    delay = t - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def run_process(messages, times, concurrency, args, tmp):
+    # the messages as files, so that the children read them from a file, as
+    # from procmail, rather than through a pipe that we'd have to feed
+    paths = []
+    for i, message in enumerate(messages):
+        path = os.path.join(tmp, f"{i}.eml")
+        with open(path, "wb") as f:
+            f.write(message)
+        paths.append(path)
+
+    cmd = [sys.executable, DECODE_EMAIL] + args
+    done = [None] * len(times)
+    usage = []
+
+    def run_one(i):
+        with open(paths[i % len(paths)], "rb") as f:
+            proc = subprocess.Popen(cmd, stdin=f, stdout=subprocess.DEVNULL)
+        # (wait4() rather than proc.wait(), for the child's resource usage)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        done[i] = time.monotonic()
+        usage.append(rusage)
+        return proc.returncode == 0
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = []
+        for i, t in enumerate(times):
+            _sleep_until(start + t)
+            futures.append(executor.submit(run_one, i))
+        errors = sum(not future.result() for future in futures)
+
+    return start, done, errors, usage
+
+
+def _deliver(path, message):
+    # append to the spool as a mail delivery agent does
+    with open(path, "ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        f.write(message)
+        f.flush()
+
+
+def _watch(outputs, done, stop):
+    # records when each message's output appears in one of the outputs
+    offsets = [0] * len(outputs)
+    tails = [b""] * len(outputs)
+    while not stop.is_set():
+        for n, path in enumerate(outputs):
+            with open(path, "rb") as f:
+                f.seek(offsets[n])
+                data = f.read()
+            if not data:
+                continue
+            now = time.monotonic()
+            offsets[n] += len(data)
+            # (a marker may be split between reads: search from the start of
+            # the last, possibly incomplete, line)
+            data = tails[n] + data
+            last = data.rfind(b"\n") + 1
+            for match in MARKER_REGEX.finditer(data, 0, last):
+                i = int(match.group(1))
+                if done[i] is None:
+                    done[i] = now
+            tails[n] = data[last:]
+        if all(t is not None for t in done):
+            return
+        time.sleep(0.001)
+
+
+def run_follow(messages, times, concurrency, args, tmp, poll, timeout):
+    spools = []
+    outputs = []
+    followers = []
+    for n in range(concurrency):
+        spool = os.path.join(tmp, f"spool{n}")
+        checkpoint = os.path.join(tmp, f"spool{n}.ckpt")
+        output = os.path.join(tmp, f"output{n}")
+        open(spool, "wb").close()
+        open(output, "wb").close()
+        cmd = [sys.executable, DECODE_EMAIL] + args
+        cmd += ["--checkpoint", checkpoint, "--follow", str(poll), "-o", output, spool]
+        followers.append(subprocess.Popen(cmd))
+        spools.append(spool)
+        outputs.append(output)
+
+    # wait for the followers to take their first checkpoint
+    for n in range(concurrency):
+        while not os.path.exists(os.path.join(tmp, f"spool{n}.ckpt")):
+            if followers[n].poll() is not None:
+                raise RuntimeError(
+                    f"decode_email.py exited with {followers[n].returncode}"
+                )
+            time.sleep(0.01)
+
+    done = [None] * len(times)
+    stop = threading.Event()
+    watcher = threading.Thread(target=_watch, args=(outputs, done, stop))
+    watcher.start()
+
+    start = time.monotonic()
+    for i, t in enumerate(times):
+        message = messages[i % len(messages)]
+        # tag each message, so that its output can be recognized
+        marked = FROM_LINE + MARKER + b": %d\n" % i + message
+        if not marked.endswith(b"\n\n"):
+            marked += b"\n" if marked.endswith(b"\n") else b"\n\n"
+        _sleep_until(start + t)
+        _deliver(spools[i % concurrency], marked)
+
+    watcher.join(timeout)
+    stop.set()
+    watcher.join()
+
+    usage = []
+    for follower in followers:
+        follower.send_signal(signal.SIGINT)
+        _, status, rusage = os.wait4(follower.pid, 0)
+        follower.returncode = os.waitstatus_to_exitcode(status)
+        usage.append(rusage)
+
+    errors = sum(t is None for t in done)
+    return start, done, errors, usage
+
+
+def run(mode, messages, count, concurrency, rate, args, poll=0.05, timeout=60):
+    """Replays `count` messages through decode_email.py (with extra `args`)
+    in `mode`, and returns a dict of results."""
+    times = arrivals(count, rate)
+    with tempfile.TemporaryDirectory() as tmp:
+        if mode == "process":
+            start, done, errors, usage = run_process(
+                messages, times, concurrency, args, tmp
+            )
+        else:
+            start, done, errors, usage = run_follow(
+                messages, times, concurrency, args, tmp, poll, timeout
+            )
+
+    latencies = [d - (start + t) for t, d in zip(times, done) if d is not None]
+    finished = [d for d in done if d is not None]
+    seconds = max(finished) - start if finished else 0.0
+    result = {
+        "mode": mode,
+        "concurrency": concurrency,
+        "rate": rate,
+        "messages": count,
+        "errors": errors,
+        "seconds": seconds,
+        "throughput": len(finished) / seconds if seconds else 0.0,
+        "cpu_seconds": sum(u.ru_utime + u.ru_stime for u in usage),
+        # (ru_maxrss is in KiB on Linux)
+        "peak_rss_mib": max(u.ru_maxrss for u in usage) / 1024,
+    }
+    if mode == "follow":
+        result["poll"] = poll
+    if latencies:
+        result["latency"] = {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+        }
+    return result
+
+
+def _list(type_):
+    def parse(value):
+        return [None if v == "storm" else type_(v) for v in value.split(",")]
+
+    return parse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="replay messages through decode_email.py and report latency percentiles, throughput, CPU time and peak RSS, as JSON"
+    )
+    parser.add_argument(
+        "--mode",
+        help="comma-separated modes: process (a process per message), follow (long-running --follow processes)",
+        type=lambda value: value.split(","),
+        default=["process", "follow"],
+    )
+    parser.add_argument(
+        "--concurrency",
+        help="comma-separated numbers of processes",
+        type=_list(int),
+        default=[1, 4],
+    )
+    parser.add_argument(
+        "--rate",
+        help="comma-separated arrival rates, in messages per second ('storm': all at once)",
+        type=_list(float),
+        default=[None],
+    )
+    parser.add_argument(
+        "--count", help="messages per configuration", type=int, default=200
+    )
+    parser.add_argument(
+        "--poll",
+        help="with --mode follow, seconds between checks for new messages",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--decode-email-args",
+        help="extra arguments for decode_email.py, e.g. '--timeout 10 --cache /tmp/decode.db'",
+        type=shlex.split,
+        default=[],
+    )
+    parser.add_argument(
+        "--output", "-o", help="write the results to this file instead of STDOUT"
+    )
+    parser.add_argument("corpus", nargs="*", help="mbox file or Maildir")
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        if mode not in ["process", "follow"]:
+            parser.error(f"--mode: unknown mode {mode!r}")
+
+    messages = load_corpus(args.corpus) if args.corpus else synthetic()
+    if not messages:
+        parser.error("no messages in the corpus")
+
+    results = []
+    for mode, concurrency, rate in itertools.product(
+        args.mode, args.concurrency, args.rate
+    ):
+        result = run(
+            mode,
+            messages,
+            args.count,
+            concurrency,
+            rate,
+            args.decode_email_args,
+            args.poll,
+        )
+        latency = result.get("latency", {})
+        print(
+            f"{mode} concurrency={concurrency} rate={rate or 'storm'}: "
+            f"{result['throughput']:.1f} messages/s, "
+            f"p99 {latency.get('p99', math.nan) * 1000:.0f} ms, "
+            f"{result['errors']} errors",
+            file=sys.stderr,
+        )
+        results.append(result)
+
+    outfile = sys.stdout if args.output is None else open(args.output, "w")
+    json.dump(results, outfile, indent=2)
+    outfile.write("\n")
@@ -34,12 +34,19 @@ Returns:
 
 import argparse
 import base64
+import codecs
+import collections
+import logging
+import os
 import re
 import sys
 import pdb
+import threading
 import urllib.request, urllib.parse, urllib.error
 
-DEBUG = False
+from url_scanner import scan
+
+_log = logging.getLogger("decode")
 
 
 #
@@ -68,7 +75,7 @@ def decode_ppv2(mangled_url):
     param = urllib.parse.parse_qs(query)
 
     if "u" not in param:
-        sys.exit("ERROR: check if URL is a proofpoint URL")
+        raise ValueError("check if URL is a proofpoint URL")
     else:
         u = param["u"][0].replace("-", "%").replace("_", "/")
         cleaned_url = urllib.parse.unquote(u)
@@ -76,6 +83,47 @@ def decode_ppv2(mangled_url):
     return cleaned_url
 
 
+def key_ppv2(mangled_url):
+    # the cleaned URL depends only on the first non-empty `u` value, so URLs
+    # sent to different recipients (different `r`, `m`, `s`) share a key. the
+    # query is split like urlparse() and parse_qs() do; if a parameter name
+    # might be `u` in disguise (e.g., `%75`), the whole query is the key.
+    query = mangled_url.split("#", 1)[0].partition("?")[2]
+    for param in query.split("&"):
+        name, equals, value = param.partition("=")
+        if name == "u":
+            if equals and value:
+                return value
+        elif not _PARAM_NAME_REGEX.fullmatch(name):
+            return query
+    return query
+
+
+_PARAM_NAME_REGEX = re.compile(r"[A-Za-z0-9_-]*")
+
+
+#
+# besides `u`, v2 URLs carry:
+#
+#   c  the organization ("customer") id
+#   r  an identifier tied to the recipient
+#   d, m, s  the sending domain, a message-specific value and a signature
+#            (XXX exact derivation unknown)
+#
+def identify_ppv2(mangled_url):
+    query = urllib.parse.urlparse(mangled_url).query
+    param = urllib.parse.parse_qs(query, keep_blank_values=True)
+
+    def get(name):
+        return param[name][0] if name in param and param[name][0] != "" else None
+
+    return {
+        "org_id": get("c"),
+        "recipient": get("r"),
+        "extra": {k: get(k) for k in ["d", "m", "s"] if get(k) is not None},
+    }
+
+
 #
 # proofpoint "protected" v3 URLs take the form of:
 #
@@ -130,6 +178,50 @@ def decode_ppv2(mangled_url):
 # XXX unknown as to how this is derived
 #
 
+
+def identify_ppv3(mangled_url):
+    ids = re.search(r"!!([^!$]*)!([^!$]*)\$?$", mangled_url)
+    if ids is None:
+        return {"org_id": None, "recipient": None, "extra": {}}
+
+    return {
+        "org_id": ids.group(1) or None,
+        "recipient": ids.group(2) or None,
+        "extra": {},
+    }
+
+
+def key_ppv3(mangled_url):
+    # the cleaned URL depends only on the mangled URL and the replacement
+    # string, not on the identifiers that follow them
+    ps = _PPV3_REGEX.search(mangled_url)
+    return mangled_url if ps is None else ps.group(0)
+
+
+_PPV3_REGEX = re.compile("__(.*)__;(.*)!!")
+
+_PPV3_RUN_REGEX = re.compile(r"\*\*([A-Za-z0-9-_])")
+
+
+def min_length_ppv3(mangled_url):
+    # a lower bound on len(decode_ppv3(mangled_url)), without decoding it:
+    # the characters of the URL that aren't replaced, plus at least one
+    # character per 4 bytes of replacement (the more of the bytes the
+    # replacement runs ask for and the bytes the base64 string holds)
+    ps = _PPV3_REGEX.search(mangled_url)
+    if ps is None:
+        return 0
+
+    url, replacement_b64 = ps.group(1), ps.group(2)
+    runs = _PPV3_RUN_REGEX.findall(url)
+    singles = url.count("*") - 2 * len(runs)
+    run_bytes = sum(replacement_str_mapping.get(run, 0) for run in runs)
+    b64_bytes = len(replacement_b64.rstrip("=")) * 3 // 4
+
+    kept = len(url) - singles - 3 * len(runs)
+    return kept + -(-max(singles + run_bytes, b64_bytes) // 4)
+
+
 replacement_str_mapping = {
     "A": 2,
     "B": 3,
@@ -203,18 +295,21 @@ def decode_ppv3(mangled_url, unquote_url=False):
     # (e.g., it's not sure if the query belongs to the inner or our URL)
     parsed_url = mangled_url
 
+    # (checked once, rather than for every debugging message)
+    debug = _log.isEnabledFor(logging.DEBUG)
+
     # extract URL between `__`s (e.g., /v3/__https://www.example.com__;Iw!![organization_id]![unique_identifier]$)
     p = re.compile("__(.*)__;(.*)!!")
     ps = p.search(parsed_url)
 
     if ps is None:
-        DEBUG and print("%s is not a valid URL?" % parsed_url)
+        debug and _log.debug("%s is not a valid URL?" % parsed_url)
 
         # return as is
         return parsed_url
 
     url = ps.group(1)
-    DEBUG and print(url)
+    debug and _log.debug(url)
 
     # get string of b64-encoded replacement characters (e.g., "Iw" in  /v3/__https://www.example.com__;Iw!![organization_id]![unique_identifier]$)
     replacement_b64 = ps.group(2)
@@ -223,7 +318,7 @@ def decode_ppv3(mangled_url, unquote_url=False):
     if len(replacement_b64) == 0:
         return url
 
-    DEBUG and print("replacement b64 = %s" % replacement_b64)
+    debug and _log.debug("replacement b64 = %s" % replacement_b64)
 
     # base64 decode replacement string
     #
@@ -235,7 +330,7 @@ def decode_ppv3(mangled_url, unquote_url=False):
     replacement_str = (base64.urlsafe_b64decode(replacement_b64 + "==")).decode(
         "utf-8"
     )  # b64decode ignores any extra padding
-    DEBUG and print(
+    debug and _log.debug(
         "replacement string = %s (%d)"
         % (replacement_str, len(replacement_str.encode("utf-8")))
     )
@@ -246,31 +341,37 @@ def decode_ppv3(mangled_url, unquote_url=False):
     #    print(f"{test} {len(test.encode('utf-8'))}")
 
     # replace `*` with actual symbols
-    replacement_list = list(replacement_str)
-    url_list = list(url)
+    #
+    # (a deque, and the cleaned URL built up in `parts`, rather than popping
+    # from the front of a list and splicing into another: both of those take
+    # time linear in the length of the URL, for every replacement)
+    replacement_list = collections.deque(replacement_str)
+    parts = []
+    pos = 0  # end of the last match in `url`
 
-    DEBUG and print("replacement list = %s" % replacement_list)
+    debug and _log.debug("replacement list = %s" % replacement_list)
 
-    offset = 0
     save_bytes = 0
     # this regex says: find ("*" but not "**") or ("**A", "**B", "**C", ..., "**-", "**_")
     for m in re.finditer(r"(?<!\*)\*(?!\*)|\*{2}[A-Za-z0-9-_]", url):
-        DEBUG and print("%d %d %s" % (m.start(), m.end(), m.group(0)))
+        debug and _log.debug("%d %d %s" % (m.start(), m.end(), m.group(0)))
 
         if m.group(0) == "*":
             # we only need to replace one character here
-            url_list[m.start() + offset] = replacement_list.pop(0)
+            parts.append(url[pos : m.start()])
+            parts.append(replacement_list.popleft())
+            pos = m.end()
         elif m.group(0).startswith("**"):
             # we need to replace a certain number of bytes
             # e.g., "foobar**Dfoo" --> "foobar#####foo"
             num_bytes = replacement_str_mapping[m.group(0)[-1]]
 
-            DEBUG and print(f"replacing {num_bytes} + {save_bytes} bytes")
+            debug and _log.debug(f"replacing {num_bytes} + {save_bytes} bytes")
 
             if save_bytes != 0:
                 num_bytes += save_bytes
                 save_bytes = 0  # reset
-            DEBUG and print(f"replacing {num_bytes} bytes total")
+            debug and _log.debug(f"replacing {num_bytes} bytes total")
 
             # replace "**[A-Za-z0-9-_]" with replacement characters
             replacement_chars = list()
@@ -283,11 +384,11 @@ def decode_ppv3(mangled_url, unquote_url=False):
                 # encoding. so we replace the for loop with a while loop and
                 # increment a counter with the size of each character being
                 # replaced.
-                replacement_char = replacement_list.pop(0)
+                replacement_char = replacement_list.popleft()
                 replacement_chars.append(replacement_char)
                 i += len(replacement_char.encode("utf-8"))
 
-                DEBUG and print(
+                debug and _log.debug(
                     f"the character {replacement_char} takes {len(replacement_char.encode('utf-8'))} bytes - running total: {i}"
                 )
 
@@ -329,19 +430,18 @@ def decode_ppv3(mangled_url, unquote_url=False):
                         # break out of loop
                         i += save_bytes
 
-            # replace a sub-list with a replacement list
-            # works nicely even if the replacement list is shorter than the sub-list
-            url_list[m.start() + offset : m.end() + offset] = replacement_chars
-
-            # update offset as we're modifying url_list in place
-            # (m.start() and m.end() refer to positions in the original `url` string)
-            offset += len(replacement_chars) - 3
+            # replace "**[A-Za-z0-9-_]" with the replacement characters
+            # works nicely even if there are fewer of them than 3
+            parts.append(url[pos : m.start()])
+            parts.extend(replacement_chars)
+            pos = m.end()
         else:
             # shouldn't get here
-            DEBUG and print("shouldn't get here")
+            debug and _log.debug("shouldn't get here")
             pass
 
-    cleaned_url = "".join(url_list)
+    parts.append(url[pos:])
+    cleaned_url = "".join(parts)
 
     # we don't know whether the original URL was quoted or not, so
     # give the option to unquote the URL.
@@ -351,40 +451,553 @@ def decode_ppv3(mangled_url, unquote_url=False):
     return cleaned_url
 
 
-def decode(mangled_url, unquote_url=False):
-    parsed_url = urllib.parse.urlparse(mangled_url)
+#
+# often we only need the host of the cleaned URL (e.g., to check its
+# reputation), which in a v3 URL usually comes before the first `*`. so
+# rather than decoding the whole replacement string and rebuilding the URL,
+# decode_ppv3_host() only decodes the replacement characters that fall in
+# the scheme and authority (the part up to the first `/`, `?` or `#` after
+# `://`).
+#
+# if that part has a `**` run (e.g., an internationalized host name), or
+# doesn't start with a scheme and `://`, we fall back to a full decode.
+#
+_SCHEME_AUTHORITY_REGEX = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://[^/?#]*")
+
+
+def decode_ppv3_host(mangled_url):
+    """Returns urlparse(decode_ppv3(mangled_url)).hostname, for valid
+    URLs."""
+    ps = re.search("__(.*)__;(.*)!!", mangled_url)
+    if ps is None:
+        return urllib.parse.urlparse(mangled_url).hostname
+
+    url, replacement_b64 = ps.group(1), ps.group(2)
+
+    authority = _SCHEME_AUTHORITY_REGEX.match(url)
+    if authority is None or "**" in authority.group(0):
+        return urllib.parse.urlparse(decode_ppv3(mangled_url)).hostname
+
+    prefix = authority.group(0)
+    num_stars = prefix.count("*")
+    if num_stars == 0:
+        return urllib.parse.urlparse(prefix).hostname
+
+    # each character is at most 4 bytes in UTF-8, and each 3 bytes take 4
+    # base64 characters
+    size = -(-4 * num_stars // 3) * 4
+    replacement_bytes = base64.urlsafe_b64decode(replacement_b64[:size] + "==")
+    replacement_str = codecs.getincrementaldecoder("utf-8")().decode(replacement_bytes)
+
+    parts = prefix.split("*")
+    prefix = parts[0] + "".join(
+        replacement_str[i] + part for i, part in enumerate(parts[1:])
+    )
+    return urllib.parse.urlparse(prefix).hostname
+
+
+#
+# decoder registry
+#
+# each decoder declares the hosts it handles (its "anchors"), the path prefix
+# that identifies its URLs on those hosts, and a function that takes
+# (mangled_url, unquote_url) and returns the cleaned URL. the proofpoint v2
+# and v3 decoders are the built-in entries; URLs rewritten by other gateways
+# can be handled by adding an entry with register_decoder().
+#
+# a decoder may also have an `identify` function that takes the mangled URL
+# and returns the identifiers the gateway embedded in it, as a dict with
+# "org_id", "recipient" (either may be None) and "extra" (a dict of any
+# others), and a `host` function that returns just the host of the cleaned
+# URL, with less work than a full decode.
+#
+# a decoder may also have a `key` function that returns the part of the
+# mangled URL that the cleaned URL depends on (e.g., without the recipient
+# identifiers), for caching decoded URLs (see set_cache()). decoders without
+# one aren't cached.
+#
+# a decoder may also have a `min_length` function that returns a lower bound
+# on the length of the cleaned URL, without decoding it, so that callers
+# with a limit on it (decode_email.py --max-replacement) can skip URLs that
+# are bound to exceed it before doing the work.
+#
+# a decoder may also have an `unquote` function, which decode(...,
+# unquote_url=True) applies to the cleaned URL when the decoder's layer is
+# the innermost one (urllib.parse.unquote by default). v2 URLs are unquoted
+# as they're decoded, so the v2 decoder's leaves them as they are: unquoting
+# again would turn an escaped `%26` in the URL into a literal `&`.
+#
+# scanners should use anchor_regex() to find candidate URLs: it's a single
+# compiled alternation over every registered anchor, so adding decoders
+# doesn't add another pass over the text per vendor.
+#
+Decoder = collections.namedtuple(
+    "Decoder",
+    [
+        "name",
+        "hosts",
+        "prefix",
+        "decode",
+        "identify",
+        "host",
+        "key",
+        "min_length",
+        "unquote",
+    ],
+    defaults=[None, None, None, None, None],
+)
+
+decoders = {}  # name -> Decoder, in registration order
+decoders_by_host = {}  # host -> [Decoder, ...]
+
+
+def register_decoder(
+    name,
+    hosts,
+    prefix,
+    decode_fn,
+    identify_fn=None,
+    host_fn=None,
+    key_fn=None,
+    min_length_fn=None,
+    unquote_fn=None,
+):
+    global _current
+
+    decoder = Decoder(
+        name,
+        tuple(hosts),
+        prefix,
+        decode_fn,
+        identify_fn,
+        host_fn,
+        key_fn,
+        min_length_fn,
+        unquote_fn,
+    )
+    with _lock:
+        if name in decoders:
+            _unregister(name)
+
+        decoders[name] = decoder
+        for host in decoder.hosts:
+            decoders_by_host.setdefault(host, []).append(decoder)
+
+        # a new snapshot is taken on the next decode
+        _current = None
+
+    return decoder
+
+
+def _unregister(name):
+    decoder = decoders.pop(name)
+    for host in decoder.hosts:
+        decoders_by_host[host].remove(decoder)
+        if len(decoders_by_host[host]) == 0:
+            del decoders_by_host[host]
+    return decoder
+
+
+def unregister_decoder(name):
+    global _current
+
+    with _lock:
+        decoder = _unregister(name)
+        _current = None
+
+    return decoder
+
+
+def anchor_regex():
+    return _decoder().anchor_regex()
+
+
+#
+# anchors in transfer-encoded text
+#
+# to decide whether a base64 or quoted-printable body needs decoding at all,
+# we search the encoded body itself for the encoded forms of the anchors.
+#
+# base64 encodes each 3 bytes as 4 characters, so the same anchor encodes
+# differently depending on its offset (mod 3) in the text. for each of the
+# three alignments we keep only the characters that depend on the anchor
+# alone, not on the bytes around it, and search the body with its line
+# breaks removed.
+#
+# in quoted-printable, soft line breaks (=\n) may fall anywhere, and a "."
+# at the start of a line is often written as =2E.
+#
+# both assume the text is in an ASCII-compatible charset. false positives
+# are fine (the decoded text is searched again), so when every anchor
+# starts with the same 8 or more characters (e.g., "urldefense."), only
+# that prefix is searched for.
+#
+def _search_anchors(hosts):
+    prefix = os.path.commonprefix(hosts)
+    if len(prefix) >= 8:
+        return [prefix]
+    return hosts
+
+
+def _base64_anchors(anchor):
+    anchor = anchor.encode("ascii")
+    for k in range(3):
+        encoded = base64.b64encode(b"\0" * k + anchor).decode("ascii")
+        yield encoded[(8 * k + 5) // 6 : 8 * (k + len(anchor)) // 6]
+
+
+def may_contain_anchor(body, encoding):
+    """Returns False if `body`, in the given (lowercase)
+    content-transfer-encoding, can't contain any registered anchor once
+    decoded. The body isn't decoded."""
+    return _decoder().may_contain_anchor(body, encoding)
+
+
+def find_decoder(mangled_url):
+    return _decoder().find_decoder(mangled_url)
+
+
+#
+# decode cache
+#
+# set_cache() makes decode() look up decoded URLs in `cache` first, and add
+# the ones it decodes. a cache is any object with get(key) (returning None
+# when missing) and put(key, value) methods, where keys and values are str;
+# decode_cache.DecodeCache keeps them on disk, so that processes decoding one
+# message each (e.g., under procmail) share it.
+#
+_cache = None
+
+
+def set_cache(cache):
+    """Makes decode() use `cache` (or no cache, if None). Returns the
+    previous cache."""
+    global _cache, _current
+
+    with _lock:
+        previous, _cache = _cache, cache
+        _current = None
+    return previous
+
+
+#
+# nested URLs
+#
+# mail forwarded between organizations that both use proofpoint arrives with
+# URLs wrapped more than once: a v3 URL whose cleaned URL is itself a v2 or
+# v3 URL, and so on. decode() unwraps the URL it's given until the result
+# isn't mangled anymore, or until it has unwrapped `max_depth` layers
+# (set_unwrap_depth(), DEFAULT_UNWRAP_DEPTH by default).
+#
+# every layer is shorter than the one around it, and the number of layers is
+# bounded, so a decode takes time linear in the length of the URL.
+#
+# layers are decoded without unquoting (an inner URL could be a v2 URL, whose
+# `u` is percent-encoded); the result is unquoted once at the end, if asked.
+# if an inner layer can't be decoded, the URL is left as it was before it.
+#
+DEFAULT_UNWRAP_DEPTH = 4
+
+_unwrap_depth = DEFAULT_UNWRAP_DEPTH
+
+
+def set_unwrap_depth(depth):
+    """Makes decode() unwrap at most `depth` layers of nested mangled URLs
+    (1 to only unwrap the outer one). Returns the previous depth."""
+    global _unwrap_depth, _current
+
+    if depth < 1:
+        raise ValueError("unwrap depth must be at least 1")
+    with _lock:
+        previous, _unwrap_depth = _unwrap_depth, depth
+        _current = None
+    return previous
+
+
+#
+# threads
+#
+# decode(), iter_urls() and the other functions here don't read the
+# registry, the cache and the unwrap depth above directly: they go through a
+# UrlDecoder, an immutable snapshot of all three, taken on the first call
+# after any of them changes. register_decoder(), set_cache() and
+# set_unwrap_depth() only drop the snapshot (under a lock, in case two
+# threads change them at once). so a call that's running in one thread
+# while another registers a decoder carries on with the snapshot it started
+# with, and no call ever sees half of a change, without taking a lock on
+# every decode. this matters most on free-threaded (no-GIL) builds of
+# Python, where threads really do decode at the same time.
+#
+# a UrlDecoder can also be made explicitly, e.g., to decode with other
+# decoders, or with a cache of its own in each thread: a cache shared between
+# threads must be thread-safe itself, which decode_cache.DecodeCache (like
+# any sqlite3 connection) isn't.
+#
+_lock = threading.Lock()
+_current = None
 
-    if (
-        (
-            (
-                parsed_url.netloc == "urldefense.proofpoint.com"
-                or parsed_url.netloc == "urldefense.com"
-                or parsed_url.netloc == "urldefense.us"
-            )
-            and parsed_url.path.startswith("/v2/")
+
+class UrlDecoder:
+    """Decodes URLs with a fixed list of decoders (by default, the
+    registered ones), cache and unwrap depth. It's never modified once it's
+    made, so any number of threads can share it."""
+
+    def __init__(self, decoders=None, cache=None, unwrap_depth=DEFAULT_UNWRAP_DEPTH):
+        if unwrap_depth < 1:
+            raise ValueError("unwrap depth must be at least 1")
+        if decoders is None:
+            decoders = _registered()
+
+        self.decoders = tuple(decoders)
+        self.cache = cache
+        self.unwrap_depth = unwrap_depth
+
+        by_host = {}
+        for decoder in self.decoders:
+            for host in decoder.hosts:
+                by_host.setdefault(host, []).append(decoder)
+        self.decoders_by_host = {host: tuple(d) for host, d in by_host.items()}
+
+        # longest first, so that one anchor that is a prefix of another
+        # doesn't shadow it (and one that never matches if there are none)
+        hosts = sorted(by_host, key=len, reverse=True)
+        self._anchor_regex = re.compile(
+            "|".join(re.escape(h) for h in hosts) or r"(?!)"
         )
-        or (parsed_url.path.startswith("urldefense.proofpoint.com/v2/"))
-        or (parsed_url.path.startswith("urldefense.com/v2/"))
-        or (parsed_url.path.startswith("urldefense.us/v2/"))
-    ):
-        cleaned_url = decode_ppv2(mangled_url)
-    elif (
-        (
-            (
-                parsed_url.netloc == "urldefense.com"
-                or parsed_url.netloc == "urldefense.us"
-            )
-            and parsed_url.path.startswith("/v3/")
+
+        search = _search_anchors(hosts)
+        self._base64_anchors = [
+            encoded for a in search for encoded in _base64_anchors(a)
+        ]
+        self._quoted_printable_regex = re.compile(
+            "|".join(re.escape(a).replace(r"\.", r"(?:\.|=2[Ee])") for a in search)
+            or r"(?!)"
         )
-        or (parsed_url.path.startswith("urldefense.com/v3/"))
-        or (parsed_url.path.startswith("urldefense.us/v3/"))
-    ):
-        cleaned_url = decode_ppv3(mangled_url, unquote_url)
-    else:
-        # assume URL hasn't been mangled
-        return mangled_url
 
-    return cleaned_url
+    def anchor_regex(self):
+        return self._anchor_regex
+
+    def may_contain_anchor(self, body, encoding):
+        if encoding == "base64":
+            # str.find() is much faster than a regex alternation here
+            body = body.replace("\r", "").replace("\n", "")
+            return any(encoded in body for encoded in self._base64_anchors)
+
+        if encoding == "quoted-printable":
+            body = body.replace("=\r\n", "").replace("=\n", "")
+            return self._quoted_printable_regex.search(body) is not None
+
+        return self._anchor_regex.search(body) is not None
+
+    def find_decoder(self, mangled_url):
+        parsed_url = urllib.parse.urlparse(mangled_url)
+
+        if parsed_url.netloc != "":
+            host = parsed_url.netloc
+            path = parsed_url.path
+        else:
+            # no scheme, e.g., urldefense.com/v3/__http://www.example.com__;!!foo!bar$
+            host, _, path = parsed_url.path.partition("/")
+            path = "/" + path
+
+        for decoder in self.decoders_by_host.get(host, ()):
+            if path.startswith(decoder.prefix):
+                return decoder
+
+        return None
+
+    def _decode_layer(self, decoder, mangled_url):
+        if self.cache is None or decoder.key is None:
+            return decoder.decode(mangled_url, False)
+
+        key = f"{decoder.name}\0{decoder.key(mangled_url)}"
+        cleaned_url = self.cache.get(key)
+        if cleaned_url is None:
+            # (exceptions aren't cached)
+            cleaned_url = decoder.decode(mangled_url, False)
+            self.cache.put(key, cleaned_url)
+
+        return cleaned_url
+
+    def _inner_decoder(self, url):
+        try:
+            return self.find_decoder(url)
+        except ValueError:
+            # e.g., an invalid IPv6 address: not something we can unwrap
+            return None
+
+    def unwrap(self, mangled_url, unquote_url=False, max_depth=None):
+        """Returns (cleaned_url, depth), where depth is the number of layers
+        of mangling that were unwrapped (0 if the URL isn't mangled)."""
+        if max_depth is None:
+            max_depth = self.unwrap_depth
+
+        decoder = self.find_decoder(mangled_url)
+        url = mangled_url
+        depth = 0
+        while decoder is not None:
+            try:
+                cleaned_url = self._decode_layer(decoder, url)
+            except Exception:
+                if depth == 0:
+                    raise
+                break
+            if cleaned_url == url:
+                # e.g., a link to the gateway itself, not a mangled URL
+                break
+            url = cleaned_url
+            innermost = decoder
+            depth += 1
+            if depth == max_depth:
+                break
+            decoder = self._inner_decoder(url)
+
+        if unquote_url and depth:
+            url = (innermost.unquote or urllib.parse.unquote)(url)
+        return url, depth
+
+    def decode(self, mangled_url, unquote_url=False, max_depth=None):
+        return self.unwrap(mangled_url, unquote_url, max_depth)[0]
+
+    def decode_host(self, mangled_url):
+        """Returns the host name of the cleaned URL, i.e.,
+        urlparse(decode(mangled_url)).hostname, with as little work as the
+        decoder allows."""
+        decoder = self.find_decoder(mangled_url)
+
+        if decoder is None:
+            return urllib.parse.urlparse(mangled_url).hostname
+
+        if decoder.host is None:
+            return urllib.parse.urlparse(self.decode(mangled_url)).hostname
+
+        host = decoder.host(mangled_url)
+        if host in self.decoders_by_host and self.unwrap_depth > 1:
+            # the cleaned URL may be mangled too
+            return urllib.parse.urlparse(self.decode(mangled_url)).hostname
+        return host
+
+    def min_length(self, mangled_url):
+        """Returns a lower bound on the length of decode(mangled_url), from
+        the mangled URL alone (0 if its decoder has no way to tell)."""
+        decoder = self.find_decoder(mangled_url)
+
+        if decoder is None or decoder.min_length is None:
+            return 0
+
+        return decoder.min_length(mangled_url)
+
+    def identify(self, mangled_url):
+        """Returns the identifiers embedded in a mangled URL (see Decoder),
+        or None if it isn't mangled or its decoder doesn't extract any."""
+        decoder = self.find_decoder(mangled_url)
+
+        if decoder is None or decoder.identify is None:
+            return None
+
+        return decoder.identify(mangled_url)
+
+    def iter_urls(self, text):
+        """Yields a UrlMatch for each URL in `text` (see iter_urls())."""
+        anchors = self._anchor_regex
+
+        for start, end in scan(text):
+            raw = text[start:end]
+
+            version = None
+            if anchors.search(raw) is not None:
+                decoder = self.find_decoder(raw)
+                if decoder is not None:
+                    version = decoder.name
+
+            yield UrlMatch(start, end, raw, version)
+
+
+def _registered():
+    return list(decoders.values())
+
+
+def _decoder():
+    # the current snapshot, taking a new one if anything changed
+    global _current
+
+    decoder = _current
+    if decoder is None:
+        with _lock:
+            if _current is None:
+                _current = UrlDecoder(None, _cache, _unwrap_depth)
+            decoder = _current
+    return decoder
+
+
+def unwrap(mangled_url, unquote_url=False, max_depth=None):
+    """Returns (cleaned_url, depth), where depth is the number of layers of
+    mangling that were unwrapped (0 if the URL isn't mangled)."""
+    return _decoder().unwrap(mangled_url, unquote_url, max_depth)
+
+
+def decode(mangled_url, unquote_url=False, max_depth=None):
+    return _decoder().unwrap(mangled_url, unquote_url, max_depth)[0]
+
+
+def decode_host(mangled_url):
+    """Returns the host name of the cleaned URL, i.e.,
+    urlparse(decode(mangled_url)).hostname, with as little work as the
+    decoder allows."""
+    return _decoder().decode_host(mangled_url)
+
+
+def min_length(mangled_url):
+    """Returns a lower bound on the length of decode(mangled_url), from the
+    mangled URL alone (0 if its decoder has no way to tell)."""
+    return _decoder().min_length(mangled_url)
+
+
+def identify(mangled_url):
+    """Returns the identifiers embedded in a mangled URL (see Decoder), or
+    None if it isn't mangled or its decoder doesn't extract any."""
+    return _decoder().identify(mangled_url)
+
+
+#
+# URLs in text
+#
+# iter_urls() lazily yields a UrlMatch for each URL in a text, in order, so
+# callers can stop early, stream output as they go, or both rewrite and
+# extract URLs from a single scan. `start` and `end` are offsets into the
+# text, `raw` is the URL as found, and `version` is the name of the decoder
+# that handles it (e.g., "ppv3"), or None if it isn't mangled.
+#
+UrlMatch = collections.namedtuple("UrlMatch", ["start", "end", "raw", "version"])
+
+
+def iter_urls(text):
+    return _decoder().iter_urls(text)
+
+
+# built-in decoders
+#
+# (decode_ppv2 always unquotes `u`, which is how v2 URLs are encoded, so
+# unquote_url is ignored, and the cleaned URL isn't unquoted again)
+register_decoder(
+    "ppv2",
+    ["urldefense.proofpoint.com", "urldefense.com", "urldefense.us"],
+    "/v2/",
+    lambda mangled_url, unquote_url: decode_ppv2(mangled_url),
+    identify_ppv2,
+    key_fn=key_ppv2,
+    unquote_fn=lambda cleaned_url: cleaned_url,
+)
+register_decoder(
+    "ppv3",
+    ["urldefense.com", "urldefense.us"],
+    "/v3/",
+    decode_ppv3,
+    identify_ppv3,
+    decode_ppv3_host,
+    key_ppv3,
+    min_length_ppv3,
+)
 
 
 if __name__ == "__main__":
@@ -412,13 +1025,15 @@ if __name__ == "__main__":
     parser.add_argument("url", type=str, help="URL to clean and decode")
     args = parser.parse_args()
 
-    if args.verbose:
-        DEBUG = True
+    if args.verbose or args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
     if args.debug:
-        DEBUG = True
         pdb.set_trace()
 
-    cleaned_url = decode(args.url, args.unquote)
+    try:
+        cleaned_url = decode(args.url, args.unquote)
+    except ValueError as err:
+        sys.exit(f"ERROR: {err}")
 
     print(cleaned_url)
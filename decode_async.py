@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# decode_async.py - decode mangled URLs in streamed text, for asyncio
+# applications
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#
+#   from decode_async import decode_stream
+#
+#   async for chunk in decode_stream(reader):
+#       writer.write(chunk)
+#
+# or, to try it out: ./decode_async.py < input.txt > output.txt
+#
+
+import asyncio
+import codecs
+import sys
+
+from decode_email import _split_point, process_text
+
+#
+# an asyncio application (a chat or ticketing bridge, ...) can't call
+# process_text() on a large text without blocking its event loop for as long
+# as the decoding takes, and needs the whole text in memory first.
+# decode_stream() takes the text as an async iterable of chunks instead, and
+# yields the decoded text in chunks as it goes:
+#
+#  - as in process_text_stream(), the text after the last whitespace
+#    character of each chunk is carried over to the next one, so URLs
+#    crossing chunk boundaries are decoded as if the whole text had been
+#    passed to process_text(). a run of more than `max_carry` characters
+#    without whitespace is decoded as is (and may be split).
+#  - bytes chunks are decoded (and the output encoded again) with
+#    `encoding`, incrementally, so a character may be split between chunks
+#    too; undecodable bytes are passed through (surrogateescape).
+#  - texts of up to `offload_size` characters are decoded right on the event
+#    loop, which blocks it for about as long as a 16 KiB text takes (a couple
+#    of milliseconds: see benchmarks/bench_async.py). larger ones are
+#    decoded in `executor` (by default, the event loop's default
+#    ThreadPoolExecutor), so the event loop keeps running. a smaller
+#    `offload_size` bounds the time the event loop is blocked more tightly,
+#    at the cost of a round trip to the executor per chunk.
+#
+# with a ThreadPoolExecutor, the decoding thread holds the GIL while it
+# runs, but gives it up every sys.getswitchinterval() seconds (5 ms by
+# default), which then bounds event loop latency. a ProcessPoolExecutor
+# avoids that, at the cost of copying the text to and from the worker; the
+# decode cache (decode.set_cache()) isn't shared with its workers.
+#
+DEFAULT_OFFLOAD_SIZE = 16 << 10
+
+
+async def _chunks(iterable):
+    # (for plain iterables too)
+    if hasattr(iterable, "__aiter__"):
+        async for chunk in iterable:
+            yield chunk
+    else:
+        for chunk in iterable:
+            yield chunk
+
+
+async def decode_stream(
+    chunks,
+    encoding="utf-8",
+    offload_size=DEFAULT_OFFLOAD_SIZE,
+    executor=None,
+    max_carry=1 << 20,
+):
+    """Yields the text of the (async) iterable `chunks` (of str, or of bytes
+    in `encoding`) with mangled URLs decoded, in chunks of the same type.
+
+    The output is the same as process_text() on the whole text. Texts longer
+    than `offload_size` characters are decoded in `executor` (None for the
+    event loop's default executor), the rest on the event loop itself."""
+    loop = asyncio.get_running_loop()
+    decoder = None
+    carry = ""
+
+    async def decode(text):
+        if len(text) > offload_size:
+            text = await loop.run_in_executor(executor, process_text, text)
+        else:
+            text = process_text(text)
+        return text if decoder is None else text.encode(encoding, "surrogateescape")
+
+    async for chunk in _chunks(chunks):
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)("surrogateescape")
+            chunk = decoder.decode(chunk)
+        if chunk == "":
+            continue
+
+        buf = carry + chunk
+        split = _split_point(buf)
+        if split == 0 and len(buf) > max_carry:
+            split = len(buf)
+
+        carry = buf[split:]
+        if split > 0:
+            yield await decode(buf[:split])
+
+    if decoder is not None:
+        carry += decoder.decode(b"", final=True)
+    if carry != "":
+        yield await decode(carry)
+
+
+async def _main():
+    # (reading STDIN blocks the event loop, which has nothing else to do)
+    chunks = iter(lambda: sys.stdin.buffer.read(1 << 16), b"")
+    async for chunk in decode_stream(chunks):
+        sys.stdout.buffer.write(chunk)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import asyncio
+import concurrent.futures
+import os
+import subprocess
+import sys
+import time
+import unittest
+from parameterized import parameterized
+
+from decode_async import decode_stream
+from decode_email import process_text
+from decode_email_test import TEXT
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "decode_async.py")
+
+
+async def chunked(data, size):
+    for i in range(0, len(data), size):
+        await asyncio.sleep(0)
+        yield data[i : i + size]
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(1)
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(fn, *args, **kwargs)
+
+
+class TestDecodeStream(unittest.IsolatedAsyncioTestCase):
+    @parameterized.expand([[1], [2], [7], [64], [100], [1 << 20]])
+    async def test_identical(self, chunk_size):
+        chunks = await collect(decode_stream(chunked(TEXT * 3, chunk_size)))
+        self.assertEqual("".join(chunks), process_text(TEXT * 3))
+
+    @parameterized.expand([[1], [3], [64]])
+    async def test_bytes(self, chunk_size):
+        # multi-byte characters split between chunks, and a byte that isn't
+        # UTF-8 at all
+        data = (TEXT * 3 + " 你好 ").encode() + b"\xff end"
+        chunks = await collect(decode_stream(chunked(data, chunk_size)))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+        text = data.decode("utf-8", "surrogateescape")
+        self.assertEqual(
+            b"".join(chunks), process_text(text).encode("utf-8", "surrogateescape")
+        )
+
+    async def test_plain_iterable(self):
+        chunks = await collect(decode_stream([TEXT[:10], TEXT[10:]]))
+        self.assertEqual("".join(chunks), process_text(TEXT))
+
+    async def test_max_carry(self):
+        text = "x" * 1000
+        chunks = await collect(decode_stream(chunked(text, 10), max_carry=100))
+        self.assertEqual("".join(chunks), text)
+        self.assertGreater(len(chunks), 1)
+
+    async def test_offload(self):
+        executor = CountingExecutor()
+        self.addCleanup(executor.shutdown)
+
+        # small texts are decoded on the event loop
+        chunks = await collect(
+            decode_stream(chunked(TEXT, 100), offload_size=1000, executor=executor)
+        )
+        self.assertEqual("".join(chunks), process_text(TEXT))
+        self.assertEqual(executor.submitted, 0)
+
+        # large ones in the executor
+        text = TEXT * 100
+        chunks = await collect(
+            decode_stream(chunked(text, 5000), offload_size=1000, executor=executor)
+        )
+        self.assertEqual("".join(chunks), process_text(text))
+        # (but for the short text after the last chunk's last whitespace)
+        self.assertGreaterEqual(executor.submitted, len(chunks) - 1)
+
+    async def test_event_loop_latency(self):
+        # a large text is decoded in the executor, and the event loop keeps
+        # running (a heartbeat keeps ticking) while it is
+        text = TEXT * 2000
+        ticks = 0
+        ticks_during = []
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.001)
+                ticks += 1
+
+        class HeartbeatExecutor(CountingExecutor):
+            def submit(self, fn, *args, **kwargs):
+                def run():
+                    # (until the heartbeat has ticked a few times, which it
+                    # can't if the event loop is blocked; with a deadline,
+                    # so that it fails rather than hangs)
+                    start = ticks
+                    deadline = time.monotonic() + 5
+                    while ticks < start + 3 and time.monotonic() < deadline:
+                        time.sleep(0.001)
+                    result = fn(*args, **kwargs)
+                    ticks_during.append(ticks - start)
+                    return result
+
+                return super().submit(run)
+
+        executor = HeartbeatExecutor()
+        self.addCleanup(executor.shutdown)
+        task = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0)
+        chunks = await collect(
+            decode_stream(chunked(text, len(text)), executor=executor)
+        )
+        task.cancel()
+
+        self.assertEqual("".join(chunks), process_text(text))
+        self.assertGreaterEqual(executor.submitted, 1)
+        self.assertTrue(all(n >= 3 for n in ticks_during), ticks_during)
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_stdin(self):
+        result = subprocess.run(
+            [sys.executable, SCRIPT],
+            input=TEXT.encode(),
+            capture_output=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout, process_text(TEXT).encode())
+
+
+if __name__ == "__main__":
+    unittest.main()
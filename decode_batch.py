@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# decode_batch.py - decode many URLs at once, in a columnar layout
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: ./decode_batch.py < urls.txt > cleaned.txt
+#
+
+import argparse
+import array
+import binascii
+import re
+import sys
+
+from decode import _decoder, decode_ppv3, replacement_str_mapping
+
+#
+# decoding tens of millions of URLs one decode() at a time creates a str
+# (and a few lists) per URL, and most of the time goes into allocating and
+# collecting them. decode_batch() works on a whole batch in a columnar
+# layout instead, like Arrow or Parquet string columns:
+#
+#   data     one bytes-like buffer of all the UTF-8 encoded URLs, back to back
+#   offsets  n + 1 offsets into `data`: URL i is data[offsets[i]:offsets[i+1]]
+#
+# and returns the cleaned URLs in the same layout, plus a status per URL:
+#
+#   NOT_MANGLED  not a mangled URL, copied as is
+#   DECODED      decoded by its decoder (same as decode())
+#   FAILED       decode() would have raised an exception; copied as is
+#
+# (a URL without any decoder host in it is NOT_MANGLED, even where decode()
+# would raise because urlparse() rejects it.)
+#
+# v3 URLs are decoded with bytes operations only, and the replacement
+# strings of the whole batch are base64-decoded with a single binascii call.
+# other URLs, and v3 URLs whose cleaned URL may be mangled too (see
+# decode.unwrap()), fall back to decode().
+#
+NOT_MANGLED = 0
+DECODED = 1
+FAILED = 2
+
+_V3_REGEX = re.compile(rb"__(.*)__;(.*)!!")
+# the same tokens as in decode_ppv3(), but starting with the literal `*` (so
+# the regex engine can skip ahead to it), and captured, for split()
+_TOKEN_REGEX = re.compile(rb"(\*(?:(?<!\*\*)(?!\*)|\*[A-Za-z0-9-_]))")
+_URLSAFE_B64_REGEX = re.compile(rb"[A-Za-z0-9_-]*")
+_URLSAFE_TO_STANDARD = bytes.maketrans(b"-_", b"+/")
+
+_NUM_BYTES = {ord(k): v for k, v in replacement_str_mapping.items()}
+
+
+def pack(urls):
+    """Returns (data, offsets) for a sequence of str URLs."""
+    data = bytearray()
+    offsets = array.array("Q", [0])
+    for url in urls:
+        data += url.encode("utf-8", "surrogatepass")
+        offsets.append(len(data))
+    return data, offsets
+
+
+def unpack(data, offsets):
+    """Yields each URL in (data, offsets) as a str."""
+    for i in range(len(offsets) - 1):
+        yield bytes(data[offsets[i] : offsets[i + 1]]).decode("utf-8", "surrogatepass")
+
+
+def _char_sizes(replacement):
+    # byte size of each UTF-8 character, from its lead byte
+    sizes = []
+    for b in replacement:
+        if b < 0x80 or b >= 0xC0:
+            sizes.append(1)
+        else:
+            sizes[-1] += 1
+    return sizes
+
+
+def _substitute(url, replacement):
+    # bytes version of the `*` and `**X` replacement loop in decode_ppv3()
+    if not replacement:
+        # decode_ppv3() returns the URL as is, whatever `*`s it has
+        return url
+
+    parts = _TOKEN_REGEX.split(url)
+    if replacement.isascii():
+        # one byte per character: `*` takes one, and `**X` as many as X says
+        rpos = 0
+        for k in range(1, len(parts), 2):
+            size = 1 if len(parts[k]) == 1 else _NUM_BYTES[parts[k][2]]
+            parts[k] = replacement[rpos : rpos + size]
+            rpos += size
+        if rpos > len(replacement):
+            raise IndexError("pop from empty list")
+        return b"".join(parts)
+
+    # decode_ppv3() raises on invalid UTF-8 too
+    replacement.decode("utf-8")
+    sizes = _char_sizes(replacement)
+
+    rpos = 0  # in replacement
+    ri = 0  # index of the next replacement character
+    save_bytes = 0
+    for k in range(1, len(parts), 2):
+        if len(parts[k]) == 1:
+            # one character
+            size = sizes[ri]
+            parts[k] = replacement[rpos : rpos + size]
+            rpos += size
+            ri += 1
+            continue
+
+        num_bytes = _NUM_BYTES[parts[k][2]] + save_bytes
+        save_bytes = 0
+        start = rpos
+        i = 0
+        while i < num_bytes:
+            size = sizes[ri]
+            rpos += size
+            ri += 1
+            i += size
+
+            # see decode_ppv3(): if the next character doesn't fit in this
+            # run, its bytes are carried over to the next one
+            if ri < len(sizes) and sizes[ri] > num_bytes - i:
+                save_bytes = num_bytes - i
+                i += save_bytes
+        parts[k] = replacement[start:rpos]
+
+    return b"".join(parts)
+
+
+def _heads(decoders_by_host):
+    # the literal starts of URLs whose decoder find_decoder() would pick
+    # without needing urlparse(): "https://" or "http://" (or nothing), a
+    # host, and a prefix that starts with "/", so that the host ends there.
+    # returns a regex that matches them, in decoders_by_host order so that
+    # the first match is find_decoder()'s, and a dict of their decoders.
+    heads = {}
+    for host, decoders in decoders_by_host.items():
+        for decoder in decoders:
+            if not decoder.prefix.startswith("/"):
+                continue
+            for scheme in ["https://", "http://", ""]:
+                head = (scheme + host + decoder.prefix).encode("utf-8")
+                heads.setdefault(head, decoder)
+    regex = re.compile(b"|".join(re.escape(head) for head in heads) or rb"(?!)")
+    return regex, heads
+
+
+def decode_batch(data, offsets):
+    """Decodes the URLs in (data, offsets) (see above). Returns (out_data,
+    out_offsets, status): a bytearray, an array('Q') and an array('B')."""
+    n = len(offsets) - 1
+    status = array.array("B", bytes(n))
+    view = memoryview(data)
+    # as in decode_email.py, a URL that contains no decoder host can't be
+    # mangled, and needs no further look
+    # (all from one snapshot of the registry, so that a decoder registered
+    # meanwhile can't be half in)
+    url_decoder = _decoder()
+    anchors = re.compile(
+        b"|".join(
+            re.escape(host.encode("utf-8")) for host in url_decoder.decoders_by_host
+        )
+        or rb"(?!)"
+    )
+    head_regex, heads = _heads(url_decoder.decoders_by_host)
+
+    # pass 1: find the v3 URLs, and gather their replacement strings for one
+    # bulk base64 decode. for v3 URLs, keep only where their inner URL is (in
+    # `data`) and where their replacement string is (in the bulk decode);
+    # other mangled URLs are decoded right away.
+    results = {}  # index -> bytes, for mangled URLs other than v3
+    v3 = array.array("Q")  # index, inner start, inner end, start, length
+    b64 = bytearray()
+    for i in range(n):
+        url = view[offsets[i] : offsets[i + 1]]
+        if anchors.search(url) is None:
+            continue
+
+        text = None
+        m = head_regex.match(url)
+        if m is not None:
+            decoder = heads[m.group(0)]
+        else:
+            text = str(url, "utf-8", "surrogatepass")
+            try:
+                decoder = url_decoder.find_decoder(text)
+            except ValueError:
+                # e.g., an invalid IPv6 address
+                status[i] = FAILED
+                continue
+            if decoder is None:
+                continue
+
+        status[i] = DECODED
+        m = _V3_REGEX.search(url) if decoder.decode is decode_ppv3 else None
+        if (
+            m is None
+            or len(m.group(2)) % 4 == 1
+            or _URLSAFE_B64_REGEX.fullmatch(m.group(2)) is None
+        ):
+            # not a v3 URL, or one whose replacement string isn't valid
+            # (b64decode() skips invalid characters): do it the slow way
+            text = text or str(url, "utf-8", "surrogatepass")
+            try:
+                results[i] = url_decoder.decode(text).encode("utf-8", "surrogatepass")
+            except Exception:
+                status[i] = FAILED
+            continue
+
+        # fill up to a multiple of 4 with zero bits ("A"), rather than padding
+        # ("="), which would end the bulk decode
+        length = m.end(2) - m.start(2)
+        v3.extend(
+            (
+                i,
+                offsets[i] + m.start(1),
+                offsets[i] + m.end(1),
+                len(b64) // 4 * 3,
+                length * 6 // 8,
+            )
+        )
+        b64 += m.group(2)
+        b64 += b"A" * (-length % 4)
+
+    # pass 2: one base64 decode for the whole batch, then pack the output,
+    # substituting into the v3 URLs as we go
+    replacements = binascii.a2b_base64(b64.translate(_URLSAFE_TO_STANDARD))
+    del b64
+    out = bytearray()
+    out_offsets = array.array("Q", [0])
+    k = 0  # next v3 URL
+    for i in range(n):
+        if k < len(v3) and v3[k] == i:
+            _, url_start, url_end, start, length = v3[k : k + 5]
+            k += 5
+            try:
+                cleaned_url = _substitute(
+                    view[url_start:url_end].tobytes(),
+                    replacements[start : start + length],
+                )
+            except (IndexError, KeyError, UnicodeDecodeError):
+                status[i] = FAILED
+                out += view[offsets[i] : offsets[i + 1]]
+            else:
+                if anchors.search(cleaned_url) is not None:
+                    # possibly a nested URL: unwrap it like decode() does
+                    url = view[offsets[i] : offsets[i + 1]]
+                    cleaned_url = url_decoder.decode(str(url, "utf-8", "surrogatepass"))
+                    cleaned_url = cleaned_url.encode("utf-8", "surrogatepass")
+                out += cleaned_url
+        elif i in results:
+            out += results.pop(i)
+        else:
+            out += view[offsets[i] : offsets[i + 1]]
+        out_offsets.append(len(out))
+
+    return out, out_offsets, status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="decode proofpoint-mangled URLs, one per line, in batches"
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="number of URLs to decode at a time",
+        type=int,
+        default=100000,
+    )
+    args = parser.parse_args()
+
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        lines = stdin.readlines(args.batch_size * 100)
+        if not lines:
+            break
+
+        data = bytearray()
+        offsets = array.array("Q", [0])
+        for line in lines:
+            data += line.rstrip(b"\r\n")
+            offsets.append(len(data))
+
+        out, out_offsets, status = decode_batch(data, offsets)
+        for i in range(len(out_offsets) - 1):
+            stdout.write(out[out_offsets[i] : out_offsets[i + 1]])
+            stdout.write(b"\n")
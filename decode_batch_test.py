@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import array
+import random
+import unittest
+from parameterized import parameterized
+
+from decode import decode
+from decode_batch import decode_batch, pack, unpack, NOT_MANGLED, DECODED, FAILED
+from decode_test import mangle_v2, mangle_v3
+
+URLS = [
+    "https://urldefense.com/v3/__http://www.example.com__;!!foo!bar$",
+    "https://urldefense.com/v3/__https://www.example.com/*newsletter__;Iw!!foo!bar$",
+    "https://urldefense.com/v3/__http://www.example.com/**Aa*a*.html__;w60jIw!!foo!bar$",
+    "https://urldefense.com/v3/__http://www.example.com/**E.html__;5L2g5aW9!!foo!bar$",
+    "https://urldefense.com/v3/__http://www.example.com/**_**5.html__;w6DDqMOsw7LDucOAw4jDjMOSw5nDocOpw63Ds8O6w73DgcOJw43Dk8Oaw53DosOqw67DtMO7w4LDisOOw5TDm8Ojw7HDtcODw5HDlcOkw6vDr8O2w7zDv8OEw4vDj8OWw5zFuMOlw4XDpsOGxZPFksOnw4fDsMOQw7jDmA!!foo!bar$",
+    "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com_a&d=&c=&r=&m=&s=&e=",
+    "urldefense.com/v3/__http://www.example.com__;!!foo!bar$",
+    "https://www.example.org/path",
+    "http://bücher.example/",
+    "",
+]
+
+
+class TestDecodeBatch(unittest.TestCase):
+    def assertDecodesLikeDecode(self, urls):
+        out, offsets, status = decode_batch(*pack(urls))
+
+        self.assertIsInstance(offsets, array.array)
+        self.assertEqual(offsets.typecode, "Q")
+        self.assertEqual(len(offsets), len(urls) + 1)
+        self.assertEqual(len(status), len(urls))
+
+        for url, cleaned, s in zip(urls, unpack(out, offsets), status):
+            try:
+                expected = decode(url)
+            except Exception:
+                # (decode() raises for some unmangled URLs too, e.g., with an
+                # invalid IPv6 address; decode_batch() doesn't look at them)
+                self.assertIn(s, (FAILED, NOT_MANGLED), url)
+                self.assertEqual(cleaned, url)
+                continue
+            self.assertEqual(cleaned, expected, url)
+            self.assertNotEqual(s, FAILED, url)
+
+    def test_urls(self):
+        self.assertDecodesLikeDecode(URLS)
+
+    def test_empty(self):
+        out, offsets, status = decode_batch(*pack([]))
+        self.assertEqual(out, b"")
+        self.assertEqual(list(offsets), [0])
+        self.assertEqual(len(status), 0)
+
+    @parameterized.expand(
+        [
+            ["https://www.example.org/path", NOT_MANGLED],
+            [
+                "https://urldefense.com/v3/__http://www.example.com__;!!foo!bar$",
+                DECODED,
+            ],
+            ["https://urldefense.com/v3/__http://a/*__;Iw!!foo!bar$", DECODED],
+            # an empty replacement string leaves the `*`s as they are
+            ["https://urldefense.com/v3/__http://a.com/*x__;!!a!b$", DECODED],
+            ["https://urldefense.com/v3/__http://a/**B__;!!foo!bar$", DECODED],
+            # `**` alone isn't replaced, but `**B` needs more replacement bytes
+            ["https://urldefense.com/v3/__http://a/**__;Iw!!foo!bar$", DECODED],
+            ["https://urldefense.com/v3/__http://a/**B__;Iw!!foo!bar$", FAILED],
+            # invalid base64, and invalid UTF-8
+            ["https://urldefense.com/v3/__http://a/*__;I!!foo!bar$", FAILED],
+            ["https://urldefense.com/v3/__http://a/*__;_w!!foo!bar$", FAILED],
+        ]
+    )
+    def test_status(self, url, expected):
+        _, _, status = decode_batch(*pack([url]))
+        self.assertEqual(status[0], expected)
+        self.assertDecodesLikeDecode([url])
+
+    def test_invalid_does_not_affect_others(self):
+        # the replacement strings of the batch are decoded together
+        urls = [
+            "https://urldefense.com/v3/__http://a/*__;I!!foo!bar$",
+            "https://urldefense.com/v3/__http://a/*b*__;IyQ!!foo!bar$",
+            "https://urldefense.com/v3/__http://a/*__;Iw=!!foo!bar$",
+            "https://urldefense.com/v3/__http://a/**C__;JCUm!!foo!bar$",
+        ]
+        self.assertDecodesLikeDecode(urls)
+
+    def test_offsets_into_larger_buffer(self):
+        data, offsets = pack(URLS)
+        data = b"garbage" + data
+        offsets = array.array("Q", [o + 7 for o in offsets])
+        out, out_offsets, _ = decode_batch(data, offsets)
+        self.assertEqual(list(unpack(out, out_offsets)), [decode(u) for u in URLS])
+
+    def test_nested(self):
+        url = "https://www.example.com/a#b"
+        urls = [
+            mangle_v3(mangle_v3(url)),
+            mangle_v2(mangle_v3(url)),
+            mangle_v3(mangle_v2(url)),
+            mangle_v3("https://urldefense.com/v3/__http://a/*__;I!!foo!bar$"),
+            mangle_v3("https://urldefense.com/v3/__http://a.com/*x__;!!a!b$"),
+        ]
+        self.assertDecodesLikeDecode(urls)
+        out, offsets, _ = decode_batch(*pack(urls))
+        self.assertEqual(list(unpack(out, offsets))[:3], [url] * 3)
+
+    def test_random(self):
+        rng = random.Random(0)
+        chars = "abcXYZ019.-_/:@#?&=%!*[]é你\U0001f600"
+        urls = []
+        for _ in range(2000):
+            url = rng.choice(["http://", "https://", ""]) + "".join(
+                rng.choice(chars) for _ in range(rng.randrange(40))
+            )
+            urls.append(mangle_v3(url))
+            # and some broken ones
+            mangled = list(urls[-1])
+            mangled[rng.randrange(len(mangled))] = rng.choice(chars)
+            urls.append("".join(mangled))
+        self.assertDecodesLikeDecode(urls)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# decode_cache.py - an on-disk cache of decoded URLs, shared by processes
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   ./decode_email.py --cache ~/.cache/decode.db --stats stats.json < message
+#   ./decode_cache.py stats ~/.cache/decode.db
+#
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+
+#
+# under procmail, each message is decoded by a new process, so an in-memory
+# cache never warms up, even though the same newsletter URLs arrive hundreds
+# of times an hour. DecodeCache keeps decoded URLs in a sqlite3 database in
+# WAL mode instead, which many processes can read (and one at a time write)
+# concurrently.
+#
+#  - keys are hashed (see decode.set_cache() for what they're made of), so
+#    every entry takes about the same space, and the recipient identifiers
+#    in mangled URLs aren't stored.
+#  - lookups are a single read, all in one read transaction; new entries,
+#    and the access times of entries that were hit, are written in one
+#    transaction when the cache is flushed (or closed), so a process holds
+#    the write lock once, briefly.
+#  - access times are kept to within TOUCH_INTERVAL.
+#  - when the entries add up to more than `max_bytes` (counting
+#    ENTRY_OVERHEAD bytes for each, besides its value), the least recently
+#    used ones are evicted, down to `low_water` of `max_bytes`. the database
+#    file itself is somewhat larger.
+#  - the cache is only an optimization: if the database is busy or broken,
+#    lookups miss and writes are dropped, and decoding carries on.
+#
+# `hits` and `misses` count lookups in this process; decode_email.py adds
+# them to its --stats file, so the hit rate is hits / (hits + misses).
+#
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key BLOB PRIMARY KEY,
+    value TEXT NOT NULL,
+    atime REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime);
+
+-- the number and size of entries, kept up to date by triggers, so that
+-- checking the size doesn't need a scan
+CREATE TABLE IF NOT EXISTS totals (
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT INTO totals SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM totals);
+CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+    UPDATE totals SET entries = entries + 1,
+        bytes = bytes + length(CAST(NEW.value AS BLOB)) + {overhead};
+END;
+CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF value ON cache BEGIN
+    UPDATE totals SET bytes = bytes + length(CAST(NEW.value AS BLOB))
+        - length(CAST(OLD.value AS BLOB));
+END;
+CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+    UPDATE totals SET entries = entries - 1,
+        bytes = bytes - length(CAST(OLD.value AS BLOB)) - {overhead};
+END;
+"""
+
+# access times are only updated if they're older than this (in seconds), so
+# that hits on popular entries don't each cost a write
+TOUCH_INTERVAL = 60
+
+# bytes per entry, besides its value: the hashed key, atime, and (roughly)
+# the row and index overhead
+ENTRY_OVERHEAD = 64
+
+
+def _hash(key):
+    return hashlib.blake2b(
+        key.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+
+
+class DecodeCache:
+    def __init__(self, path, max_bytes=64 << 20, low_water=0.9, timeout=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.pending = {}  # hashed key -> value, to be written
+        self.touched = set()  # hashed keys that were hit
+        self.now = time.time()
+        self._connect()
+
+    def _connect(self):
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(self.path, timeout=self.timeout)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # (without taking the write lock, once the table exists)
+        if (
+            self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'cache'"
+            ).fetchone()
+            is None
+        ):
+            # (in one transaction, as other processes may be creating it too)
+            self.db.executescript(
+                "BEGIN IMMEDIATE;" + SCHEMA.format(overhead=ENTRY_OVERHEAD) + "COMMIT;"
+            )
+
+    def _check_pid(self):
+        # a sqlite3 connection can't be used across fork(): a forked worker
+        # opens its own, and leaves writing to the parent
+        if os.getpid() != self.pid:
+            self.db = sqlite3.connect(self.path, timeout=self.timeout)
+            self.pid = os.getpid()
+            self.pending = None
+
+    def get(self, key):
+        self._check_pid()
+        h = _hash(key)
+        if self.pending and h in self.pending:
+            self.hits += 1
+            return self.pending[h]
+
+        try:
+            if not self.db.in_transaction:
+                # look up in one read transaction (until the next flush),
+                # rather than taking and releasing a read lock every time
+                self.db.execute("BEGIN")
+                self.now = time.time()
+            row = self.db.execute(
+                "SELECT value, atime FROM cache WHERE key = ?", (h,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if row[1] < self.now - TOUCH_INTERVAL:
+            self.touched.add(h)
+        return row[0]
+
+    def put(self, key, value):
+        self._check_pid()
+        if self.pending is not None:
+            self.pending[_hash(key)] = value
+
+    def flush(self):
+        """Ends the read transaction of get(), writes new entries and access
+        times, and evicts entries if the database is too large."""
+        try:
+            # even with nothing to write: an open read transaction keeps its
+            # snapshot, and the WAL can't be checkpointed past it. (writes
+            # need a new transaction anyway, as ours may have been overtaken
+            # by other writers.)
+            self.db.rollback()
+        except sqlite3.Error:
+            self.errors += 1
+
+        if not self.pending and not self.touched:
+            return
+
+        now = time.time()
+        try:
+            with self.db:
+                if self.pending:
+                    self.db.executemany(
+                        "INSERT INTO cache VALUES (?, ?, ?) ON CONFLICT (key) "
+                        "DO UPDATE SET value = excluded.value, atime = excluded.atime",
+                        ((h, value, now) for h, value in self.pending.items()),
+                    )
+                if self.touched:
+                    self.db.executemany(
+                        "UPDATE cache SET atime = ? WHERE key = ?",
+                        ((now, h) for h in self.touched),
+                    )
+                self._evict()
+        except sqlite3.Error:
+            self.errors += 1
+
+        if self.pending is not None:
+            self.pending = {}
+        self.touched = set()
+
+    def stats(self):
+        entries, size = self.db.execute("SELECT entries, bytes FROM totals").fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        entries, size = self.db.execute("SELECT entries, bytes FROM totals").fetchone()
+        if size <= self.max_bytes:
+            return
+
+        # entries take about the same space, so evict in proportion
+        target = self.max_bytes * self.low_water
+        evict = max(1, math.ceil(entries * (size - target) / size))
+        self.db.execute(
+            "DELETE FROM cache WHERE key IN "
+            "(SELECT key FROM cache ORDER BY atime LIMIT ?)",
+            (evict,),
+        )
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="inspect and maintain a decode cache (see decode_email.py --cache)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="print the number of entries and size as JSON"
+    )
+    stats_parser.add_argument("db", help="cache database")
+
+    clear_parser = subparsers.add_parser("clear", help="remove all entries")
+    clear_parser.add_argument("db", help="cache database")
+
+    args = parser.parse_args()
+
+    with DecodeCache(args.db) as cache:
+        if args.command == "clear":
+            with cache.db:
+                cache.db.execute("DELETE FROM cache")
+            cache.db.execute("VACUUM")
+        json.dump(cache.stats(), sys.stdout)
+        print()
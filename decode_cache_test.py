@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from parameterized import parameterized
+
+from decode import decode, set_cache, key_ppv2
+from decode_cache import DecodeCache, TOUCH_INTERVAL, _hash
+
+V2_URL = "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com_a&d=D&c=C&r={}&m=M&s=S&e="
+V3_URL = "https://urldefense.com/v3/__https://www.example.com/*newsletter__;Iw!!ORG!{}$"
+
+
+def decode_all(path, urls):
+    with DecodeCache(path) as cache:
+        set_cache(cache)
+        try:
+            return [decode(url) for url in urls]
+        finally:
+            set_cache(None)
+
+
+class TestDecodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cache.db")
+
+    def tearDown(self):
+        set_cache(None)
+        self.tmp.cleanup()
+
+    def test_shared_across_instances(self):
+        urls = [V2_URL.format("alice"), V3_URL.format("alice")]
+        expected = [decode(url) for url in urls]
+
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            self.assertEqual([decode(url) for url in urls], expected)
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # other recipients: same key
+        urls = [V2_URL.format("bob"), V3_URL.format("bob")]
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            self.assertEqual([decode(url) for url in urls], expected)
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+    def test_unquote(self):
+        url = "https://urldefense.com/v3/__https://www.example.com/a*7Bb__;JQ!!foo!bar$"
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            self.assertEqual(decode(url), "https://www.example.com/a%7Bb")
+            self.assertEqual(decode(url, True), "https://www.example.com/a{b")
+            self.assertEqual(decode(url), "https://www.example.com/a%7Bb")
+
+    def test_flush_ends_read_transaction(self):
+        # nothing to write: the snapshot from get() must still be released,
+        # or the WAL grows without bound
+        decode_all(self.path, [V3_URL.format("alice")])
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            decode(V3_URL.format("bob"))
+            self.assertTrue(cache.db.in_transaction)
+            self.assertEqual((cache.pending, cache.touched), ({}, set()))
+            cache.flush()
+            self.assertFalse(cache.db.in_transaction)
+
+    def test_not_mangled_not_cached(self):
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            decode("https://www.example.com/")
+            self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_errors_not_cached(self):
+        url = "https://urldefense.com/v3/__http://a/*__;I!!foo!bar$"
+        with DecodeCache(self.path) as cache:
+            set_cache(cache)
+            for _ in range(2):
+                with self.assertRaises(Exception):
+                    decode(url)
+            self.assertEqual(cache.hits, 0)
+
+    def test_eviction(self):
+        with DecodeCache(self.path, max_bytes=64 << 10) as cache:
+            for i in range(5000):
+                cache.put(f"key {i}", "https://www.example.com/" + "x" * 50)
+                if i % 100 == 0:
+                    cache.flush()
+            cache.flush()
+            self.assertLessEqual(cache.stats()["bytes"], 64 << 10)
+
+            # the most recent entries were kept
+            self.assertIsNotNone(cache.get("key 4999"))
+            self.assertIsNone(cache.get("key 0"))
+
+    def test_eviction_least_recently_used(self):
+        def cached(key):
+            # without counting as a hit
+            return cache.db.execute(
+                "SELECT 1 FROM cache WHERE key = ?", (_hash(key),)
+            ).fetchone()
+
+        with DecodeCache(self.path, max_bytes=64 << 10) as cache:
+            cache.put("b", "value")
+            cache.put("a", "value")
+            for i in range(100):
+                cache.put(f"key {i}", "x" * 50)
+            cache.flush()
+            with cache.db:
+                cache.db.execute(f"UPDATE cache SET atime = atime - {TOUCH_INTERVAL}")
+
+            # a hit makes "a" the most recently used
+            self.assertIsNotNone(cache.get("a"))
+            cache.flush()
+
+            i = 100
+            while cached("b"):
+                cache.put(f"key {i}", "x" * 50)
+                cache.flush()
+                i += 1
+            self.assertTrue(cached("a"))
+
+    def test_concurrent_processes(self):
+        urls = [V3_URL.format(i) for i in range(50)] + [
+            V2_URL.format(i) for i in range(50)
+        ]
+        expected = [decode(url) for url in urls]
+        with multiprocessing.Pool(8) as pool:
+            results = pool.starmap(decode_all, [(self.path, urls)] * 32)
+        for result in results:
+            self.assertEqual(result, expected)
+
+        with DecodeCache(self.path) as cache:
+            self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_broken_database(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a database" * 100)
+        with self.assertRaises(Exception):
+            DecodeCache(self.path)
+
+        # decode_email.py carries on without it
+        message = "Subject: test\n\n" + V3_URL.format("alice") + "\n"
+        p = subprocess.run(
+            [sys.executable, "decode_email.py", "--cache", self.path],
+            input=message,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(p.returncode, 0)
+        self.assertIn("https://www.example.com/#newsletter", p.stdout)
+
+    def test_decode_email_stats(self):
+        stats = os.path.join(self.tmp.name, "stats.json")
+        message = "Subject: test\n\n" + V3_URL.format("alice") + "\n"
+        for _ in range(3):
+            subprocess.run(
+                [
+                    sys.executable,
+                    "decode_email.py",
+                    "--cache",
+                    self.path,
+                    "--stats",
+                    stats,
+                ],
+                input=message,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        with open(stats) as f:
+            counts = json.load(f)
+        self.assertEqual((counts["cache_hits"], counts["cache_misses"]), (2, 1))
+
+
+class TestKeys(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["u=a&r=1", "u=a&r=2", True],
+            ["u=a&r=1", "u=b&r=1", False],
+            ["u=&u=a", "u=a", True],
+            # parse_qs() unquotes names: %75 is `u`
+            ["%75=b&u=a", "%75=c&u=a", False],
+            ["u=a#x", "u=a#y", True],
+        ]
+    )
+    def test_ppv2(self, query1, query2, same):
+        url = "https://urldefense.proofpoint.com/v2/url?"
+        self.assertEqual(key_ppv2(url + query1) == key_ppv2(url + query2), same)
+
+
+if __name__ == "__main__":
+    unittest.main()
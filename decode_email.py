@@ -19,421 +19,703 @@
 
 import argparse
 import base64
+import collections
+import concurrent.futures
 import email, email.policy, email.message
 import fileinput
+import datetime
+import fcntl
+import hashlib
+import importlib
+import io
+import json
+import locale
+import multiprocessing
+import os
+import random
 import re
+import resource
+import signal
+import sqlite3
 import sys
+import time
 import urllib.request, urllib.parse, urllib.error
 
-DEBUG = False
-# https://gist.github.com/gruber/8891611
-URL_REGEX = r"""(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))"""
+from decode import (
+    decode,
+    unwrap,
+    anchor_regex,
+    find_decoder,
+    iter_urls,
+    may_contain_anchor,
+    min_length,
+)
+from decode import set_cache, set_unwrap_depth, DEFAULT_UNWRAP_DEPTH
+from decode_cache import DecodeCache
+from mbox_follow import follow, AlreadyFollowed
+from url_scanner import URL_REGEX
 
-
-#
-# proofpoint "protected" v2 URLs take the form of:
 #
-#   https://urldefense.proofpoint.com/v2/url?[params]
-#   https://urldefense.com/v2/url?[params]
+# per-message limits
 #
-# where [params] is described below
+# a pathological message (huge HTML, adversarial input for URL_REGEX, a bogus
+# long `**_` chain, ...) shouldn't stall delivery of the whole mailbox. when a
+# limit is exceeded, process_message_with_budget() gives up and returns the
+# original message unchanged ("fails open").
 #
-# TODO decode parameters
+#   seconds          wall-clock time to process the message
+#   memory           bytes of additional address space the process may use
+#   max_urls         number of URLs per part (or plaintext input)
+#   max_replacement  length of a single decoded URL (or of any layer of a
+#                    nested one), also checked against a lower bound on it
+#                    before the URL is decoded
+#   max_depth        MIME nesting depth (the top-level message is depth 0)
+#   max_parts        number of MIME parts, including multipart containers
 #
-#  c := constant (per organization)
-#  d := constant (per organization)
-#  e := always empty?
-#  m := ?
-#  r := unique identifier tied to email address
-#  s := ?
-#  u := safe-encoded URL
+# None means "no limit".
 #
-#  'm' might be a hash of the URL or some metadata
-#  's' might be a signature or checksum
-#
-def decode_ppv2(mangled_url):
-    query = urllib.parse.urlparse(mangled_url).query
-    param = urllib.parse.parse_qs(query)
+Limits = collections.namedtuple(
+    "Limits",
+    ["seconds", "memory", "max_urls", "max_replacement", "max_depth", "max_parts"],
+    defaults=[None, None, None, None, None, None],
+)
 
-    if "u" not in param:
-        sys.exit("ERROR: check if URL is a proofpoint URL")
-    else:
-        u = param["u"][0].replace("-", "%").replace("_", "/")
-        cleaned_url = urllib.parse.unquote(u)
 
-    return cleaned_url
+class BudgetExceeded(Exception):
+    pass
+
+
+# parts whose contents can't be processed without other messages or
+# external data (RFC 2046, section 5.2): never descend into them
+OPAQUE_TYPES = ["message/partial", "message/external-body"]
+
+# the only parts we decode URLs in
+# XXX are there any more formats we should consider?
+TEXT_TYPES = ["text/plain", "text/html"]
 
 
 #
-# proofpoint "protected" v3 URLs take the form of:
-#
-#   https://urldefense.com/v3/__[mangled_url]__;[b64-encoded_replacement_string]!![organization_id]![unique_identifier]$
-#
-# many symbols in the original URL are replaced with `*` in the [mangled_url] and
-# copied over to the [b64-encoded_replacement_string].
-#
-# example:
-#   mangled: http://www.example.com/*test*test
-# 	replacement string: ##
-# 	cleaned: http://www.example.com/#test#test
-#
-# however, if there are >=2 symbols/bytes that are encoded, it's mapped to
-# something like `**A`, `**B`, and so on.
-#
-# `**` means that there are at least 2 bytes to replace
-# The character following is the number of bytes (A == 2, B == 3, etc.)
-#
-# example:
-#   mangled: http://www.example.com/**Dtest*test
-#   replacement string: ######
-#   cleaned: http://www.example.com/#####test#test
-#
-# after a "run" of a maximum of 65 bytes, it simply repeats itself.
-#
-# example (replacement string consists of all `#`):
-#   mangled: http://www.example.com/**_test
-# 	number of #: 65
-# 	cleaned: http://www.example.com/#################################################################test
-#
-# example (replacement string consists of all `#`):
-#   mangled: http://www.example.com/**_*test
-# 	number of #: 66
-# 	cleaned: http://www.example.com/##################################################################test
-#
-# example (replacement string consists of all `#`):
-#   mangled: http://www.example.com/**_**Atest
-# 	number of #: 67
-# 	cleaned: http://www.example.com/###################################################################test
-#
-# example (replacement string consists of all `#`):
-#   mangled: http://www.example.com/**_**_test
-# 	number of #: 130
-# 	cleaned: http://www.example.com/##################################################################################################################################test
+# shadow mode
 #
-# the [organization_id] is a unique string per organization
-# XXX unknown as to how this is derived
+# to roll out a new engine (URL scanner, decoder, ...) without risking the
+# mail, it can run in the "shadow" of the current one: on a sample of the
+# texts that process_text() handles, the candidate engine runs too, but its
+# output is only compared to the current output, never used. each
+# comparison is logged as a line of JSON to a sidecar file, with the
+# timings of both engines, and both outputs if they differ.
 #
-# the [unique_identifier] is tied to the recipient or sender email address
-# (depending on whether the URL was rewritten inbound or outbound)
-# XXX unknown as to how this is derived
+# an engine is a function that takes a text and returns it with URLs
+# decoded: either one of SHADOW_ENGINES, or "module:function".
 #
+def process_text_regex(e):
+    # the engine used before url_scanner: URL_REGEX via re.finditer()
+    parts = []
+    pos = 0
+    for m in re.finditer(URL_REGEX, e):
+        if find_decoder(m.group(0)) is not None:
+            parts.append(e[pos : m.start()])
+            parts.append(decode(m.group(0)))
+            pos = m.end()
+    parts.append(e[pos:])
+    return "".join(parts)
+
 
-replacement_str_mapping = {
-    "A": 2,
-    "B": 3,
-    "C": 4,
-    "D": 5,
-    "E": 6,
-    "F": 7,
-    "G": 8,
-    "H": 9,
-    "I": 10,
-    "J": 11,
-    "K": 12,
-    "L": 13,
-    "M": 14,
-    "N": 15,
-    "O": 16,
-    "P": 17,
-    "Q": 18,
-    "R": 19,
-    "S": 20,
-    "T": 21,
-    "U": 22,
-    "V": 23,
-    "W": 24,
-    "X": 25,
-    "Y": 26,
-    "Z": 27,
-    "a": 28,
-    "b": 29,
-    "c": 30,
-    "d": 31,
-    "e": 32,
-    "f": 33,
-    "g": 34,
-    "h": 35,
-    "i": 36,
-    "j": 37,
-    "k": 38,
-    "l": 39,
-    "m": 40,
-    "n": 41,
-    "o": 42,
-    "p": 43,
-    "q": 44,
-    "r": 45,
-    "s": 46,
-    "t": 47,
-    "u": 48,
-    "v": 49,
-    "w": 50,
-    "x": 51,
-    "y": 52,
-    "z": 53,
-    "0": 54,
-    "1": 55,
-    "2": 56,
-    "3": 57,
-    "4": 58,
-    "5": 59,
-    "6": 60,
-    "7": 61,
-    "8": 62,
-    "9": 63,
-    "-": 64,
-    "_": 65,
+SHADOW_ENGINES = {
+    "regex": process_text_regex,
 }
 
 
-def decode_ppv3(mangled_url, unquote_url=False):
-    # we don't use urlparse here because the mangled url confuses the function
-    # (e.g., it's not sure if the query belongs to the inner or our URL)
-    parsed_url = mangled_url
+def shadow_engine(name):
+    if name in SHADOW_ENGINES:
+        return SHADOW_ENGINES[name]
+
+    module, sep, function = name.partition(":")
+    if sep == "":
+        raise ValueError(f"unknown engine: {name}")
+    return getattr(importlib.import_module(module), function)
+
+
+class Shadow:
+    def __init__(self, engine, log, rate=1.0):
+        # fail early on unknown engines
+        shadow_engine(engine)
+
+        self.engine = engine
+        self.log = log
+        self.rate = rate
+
+    def sample(self):
+        return self.rate >= 1 or random.random() < self.rate
+
+    def compare(self, text, output, seconds):
+        """Runs the candidate engine on `text`, and logs how it compares to
+        `output`, which the current engine took `seconds` to produce."""
+        start = time.perf_counter()
+        try:
+            candidate = shadow_engine(self.engine)(text)
+            error = None
+        except (BudgetExceeded, MemoryError):
+            # the message's budget ran out while the candidate ran (its time
+            # and memory count towards it): fail open, as with the current
+            # engine, rather than carry on without a deadline
+            raise
+        except Exception as err:
+            candidate = None
+            error = f"{type(err).__name__}: {err}"
+        candidate_seconds = time.perf_counter() - start
 
-    # extract URL between `__`s (e.g., /v3/__https://www.example.com__;Iw!![organization_id]![unique_identifier]$)
-    p = re.compile("__(.*)__;(.*)!!")
-    ps = p.search(parsed_url)
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "engine": self.engine,
+            "sha256": hashlib.sha256(
+                text.encode("utf-8", "surrogateescape")
+            ).hexdigest(),
+            "length": len(text),
+            "seconds": {"current": seconds, "candidate": candidate_seconds},
+            "diverged": candidate != output,
+        }
+        if record["diverged"]:
+            record.update(current=output, candidate=candidate, error=error)
 
-    if ps is None:
-        DEBUG and print("%s is not a valid URL?" % parsed_url)
+        # one write per record, under a lock, so that records from
+        # concurrent processes don't interleave
+        with open(self.log, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + "\n")
 
-        # return as is
-        return parsed_url
 
-    url = ps.group(1)
-    DEBUG and print(url)
+def process_payload(e, limits=None, urls=None, part="", stats=None, shadow=None):
+    """Decodes URLs in every text part of `e`, in place.
 
-    # get string of b64-encoded replacement characters (e.g., "Iw" in  /v3/__https://www.example.com__;Iw!![organization_id]![unique_identifier]$)
-    replacement_b64 = ps.group(2)
+    The MIME tree is walked with an explicit stack (not recursion), so huge
+    digests and deeply nested messages don't hit Python's recursion limit.
+    Leaves that aren't text and opaque subtrees (message/partial,
+    message/external-body) are skipped without decoding their contents.
 
-    # if the replacement string is empty, return extracted URL
-    if len(replacement_b64) == 0:
-        return url
+    `part` is the (IMAP-style) section number of e, e.g., "2.1" for the first
+    subpart of the second part of a multipart message. If `stats` is a
+    Counter, the number of parts at each depth ("mime_depth_<n>") and of
+    skipped parts ("mime_parts_skipped") are added to it, as are the
+    mangled URLs by the number of layers unwrapped (see process_text()).
+    """
+    max_depth = None if limits is None else limits.max_depth
+    max_parts = None if limits is None else limits.max_parts
 
-    DEBUG and print("replacement b64 = %s" % replacement_b64)
+    num_parts = 0
+    stack = [(e, part, 0)]
+    while stack:
+        e, part, depth = stack.pop()
 
-    # base64 decode replacement string
+        num_parts += 1
+        if max_parts is not None and num_parts > max_parts:
+            raise BudgetExceeded("parts")
+        if max_depth is not None and depth > max_depth:
+            raise BudgetExceeded("depth")
+        if stats is not None:
+            stats[f"mime_depth_{depth}"] += 1
+
+        t = e.get_content_type()
+        if e.is_multipart():
+            if t in OPAQUE_TYPES:
+                if stats is not None:
+                    stats["mime_parts_skipped"] += 1
+                continue
+            # push in reverse, so that parts are processed in order
+            subparts = e.get_payload()
+            for i in range(len(subparts), 0, -1):
+                subpart = f"{part}.{i}" if part else str(i)
+                stack.append((subparts[i - 1], subpart, depth + 1))
+        elif t in TEXT_TYPES:
+            _process_text_part(e, t, limits, urls, part, shadow, stats)
+        elif stats is not None:
+            stats["mime_parts_skipped"] += 1
+
+
+_PRINTABLE_ASCII = bytes(range(0x20, 0x7F))
+
+
+def _ascii_compatible(charset):
+    # True if printable ASCII (and so any URL) is encoded the same in
+    # `charset` as in ASCII
+    try:
+        return _PRINTABLE_ASCII.decode("ascii").encode(charset) == _PRINTABLE_ASCII
+    except (LookupError, UnicodeError):
+        return False
+
+
+def _process_text_part(e, t, limits, urls, part, shadow=None, stats=None):
+    encoding = e.get("Content-Transfer-Encoding")
+    if encoding != None:
+        encoding = encoding.strip().lower()
+
+    # unless we're logging every URL, leave parts that can't contain a
+    # mangled URL as they are, without decoding (and re-encoding) them
+    if (
+        urls is None
+        and _ascii_compatible(e.get_content_charset("us-ascii"))
+        and not may_contain_anchor(e.get_payload(), encoding)
+    ):
+        return
+
+    payload = e.get_content()
+
+    # only clean URLs handled by a registered decoder
+    num_urls = 0 if urls is None else len(urls)
+    payload_clean = process_text(payload, limits, urls, shadow, stats)
+    if urls is not None:
+        for url in urls[num_urls:]:
+            url["part"] = part or "1"
+            url["content_type"] = t
+
+    # nothing decoded (e.g., the part was only scanned for --urls): leave it
+    # as it is, rather than re-encode it
+    if payload_clean == payload:
+        return
+
+    # modify the payload in place, which also sets the following:
+    #
+    #   Content-Type: text/plain, charset="utf-8"
+    #   Content-Transfer-Encoding: 7bit
+    e.set_content(payload_clean)
+
+    # set content-type correctly, if we originally had text/html
+    del e["Content-Type"]
+    charset = e.get_content_charset()
+    if charset == None:
+        charset = "utf-8"
+    e.add_header("Content-Type", t, charset=charset)
+
+    # XXX reset content-transfer-encoding header?
     #
-    # use `urlsafe_b64decode` as the base64-encoded string
-    # uses - and _ instead of + and /, respectively.
+    # set_content should take care of encoding, although it defaults to
+    # 7bit. this might be problematic if we processed base64-encoded
+    # parts and re-encoded to 7bit, but text/plain and text/html
+    # _shouldn't_ be in base64 encoding anyways?
     #
-    # See Section 5 in RFC4648
-    # <https://www.rfc-editor.org/rfc/rfc4648.html#page-7>.
-    replacement_str = (base64.urlsafe_b64decode(replacement_b64 + "==")).decode(
-        "utf-8"
-    )  # b64decode ignores any extra padding
-    DEBUG and print(
-        "replacement string = %s (%d)"
-        % (replacement_str, len(replacement_str.encode("utf-8")))
-    )
+    # python3.7 email APIs doesn't seem to have an easy way to deal
+    # with changing the cte?
 
-    # XXX just some debugging code
-    # for i in range(len(replacement_str)+1):
-    #    test = replacement_str[0:i]
-    #    print(f"{test} {len(test.encode('utf-8'))}")
-
-    # replace `*` with actual symbols
-    replacement_list = list(replacement_str)
-    url_list = list(url)
-
-    DEBUG and print("replacement list = %s" % replacement_list)
-
-    offset = 0
-    save_bytes = 0
-    # this regex says: find ("*" but not "**") or ("**A", "**B", "**C", ..., "**-", "**_")
-    for m in re.finditer(r"(?<!\*)\*(?!\*)|\*{2}[A-Za-z0-9-_]", url):
-        DEBUG and print("%d %d %s" % (m.start(), m.end(), m.group(0)))
-
-        if m.group(0) == "*":
-            # we only need to replace one character here
-            url_list[m.start() + offset] = replacement_list.pop(0)
-        elif m.group(0).startswith("**"):
-            # we need to replace a certain number of bytes
-            # e.g., "foobar**Dfoo" --> "foobar#####foo"
-            num_bytes = replacement_str_mapping[m.group(0)[-1]]
-
-            DEBUG and print(f"replacing {num_bytes} + {save_bytes} bytes")
-
-            if save_bytes != 0:
-                num_bytes += save_bytes
-                save_bytes = 0  # reset
-            DEBUG and print(f"replacing {num_bytes} bytes total")
-
-            # replace "**[A-Za-z0-9-_]" with replacement characters
-            replacement_chars = list()
-
-            i = 0
-            while i < num_bytes:
-                # previously we assumed that the replacement_str_mapping
-                # referred to the number of characters, but it actually
-                # represents the number of bytes to copy over, given the UTF-8
-                # encoding. so we replace the for loop with a while loop and
-                # increment a counter with the size of each character being
-                # replaced.
-                replacement_char = replacement_list.pop(0)
-                replacement_chars.append(replacement_char)
-                i += len(replacement_char.encode("utf-8"))
-
-                DEBUG and print(
-                    f"the character {replacement_char} takes {len(replacement_char.encode('utf-8'))} bytes - running total: {i}"
-                )
 
-                # there seems to be an edge case at the boundaries: if we have
-                # a long consecutive list of non-ascii characters to replace,
-                # pp seems to break it up into segments of length 65 (e.g.,
-                # num_bytes % 65). this doesn't quite work if each character is
-                # of size 2, and we'll hit an empty list sooner than later and
-                # get an error.
-                #
-                # we will resolve this by checking the _next_ character in the
-                # list and checking if its size will be greater than (num_bytes
-                # - i), where `i` is the current number of bytes we've replaced
-                # so far. if so, "save" the difference and add it on to the
-                # next segment.
-                #
-                # for example, if we have 124 bytes to replace, pp will break
-                # it up into 65 (`**_`) and 59 (`**5`). all of the replacement
-                # characters are 2 bytes, which means when we get to byte 64,
-                # we have 1 byte left. similarly the 59 bytes in the next
-                # segment doesn't make sense, because again all replacement
-                # characters are 2 bytes. so we'll "save" the 1 byte and add it
-                # on to the next segment (i.e., we're really treating this as
-                # segments of 64 (`**-`) and 60 (`**6`)
-                #
-                # (presumably we could also search for and combine sequences of
-                # replacement strings, i.e., if we see `**_**5`, we can combine
-                # the two and add them together to get 65+59=124, and so on.)
-                #
-                if len(replacement_list) != 0:
-                    next_replacement_char = replacement_list[0]
-                    next_replacement_char_size = len(
-                        next_replacement_char.encode("utf-8")
-                    )
-
-                    if next_replacement_char_size > (num_bytes - i):
-                        # save the difference and add it to the next segment.
-                        save_bytes = num_bytes - i
-                        # break out of loop
-                        i += save_bytes
-
-            # replace a sub-list with a replacement list
-            # works nicely even if the replacement list is shorter than the sub-list
-            url_list[m.start() + offset : m.end() + offset] = replacement_chars
-
-            # update offset as we're modifying url_list in place
-            # (m.start() and m.end() refer to positions in the original `url` string)
-            offset += len(replacement_chars) - 3
-        else:
-            # shouldn't get here
-            DEBUG and print("shouldn't get here")
-            pass
+def process_text(e, limits=None, urls=None, shadow=None, stats=None):
+    """Returns `e` with mangled URLs decoded.
 
-    cleaned_url = "".join(url_list)
+    If `urls` is a list, a dict describing each URL found (mangled or not) is
+    appended to it, with the offset of the URL in `e`, its decoder version,
+    and the original and cleaned URL. If `shadow` is a Shadow, its candidate
+    engine may also be run on `e`, for comparison. If `stats` is a Counter,
+    each mangled URL is counted by the number of layers of mangling that
+    were unwrapped ("unwrap_depth_<n>", see decode.unwrap()).
+    """
+    if shadow is not None and shadow.sample():
+        start = time.perf_counter()
+        output = process_text(e, limits, urls, stats=stats)
+        shadow.compare(e, output, time.perf_counter() - start)
+        return output
 
-    # we don't know whether the original URL was quoted or not, so
-    # give the option to unquote the URL.
-    if unquote_url:
-        cleaned_url = urllib.parse.unquote(cleaned_url)
+    anchors = anchor_regex()
 
-    return cleaned_url
+    # a single pass over the text for every registered decoder's anchors:
+    # if none of them appear, there's nothing to decode and we can skip the
+    # (much more expensive) URL scan altogether.
+    if urls is None and anchors.search(e) is None:
+        return e
 
+    if limits is None:
+        limits = Limits()
 
-def decode(mangled_url, unquote_url=False):
-    parsed_url = urllib.parse.urlparse(mangled_url)
+    num_urls = 0
+    parts = []
+    pos = 0
+    for url in iter_urls(e):
+        num_urls += 1
+        if limits.max_urls is not None and num_urls > limits.max_urls:
+            raise BudgetExceeded("urls")
 
-    if (
-        (
-            (
-                parsed_url.netloc == "urldefense.proofpoint.com"
-                or parsed_url.netloc == "urldefense.com"
-                or parsed_url.netloc == "urldefense.us"
+        if url.version is None:
+            if urls is not None:
+                urls.append(
+                    {
+                        "offset": url.start,
+                        "version": None,
+                        "original": url.raw,
+                        "cleaned": url.raw,
+                    }
+                )
+            continue
+
+        # (so that a bogus long `**_` chain, or base64 string, isn't decoded
+        # only to be thrown away)
+        if (
+            limits.max_replacement is not None
+            and min_length(url.raw) > limits.max_replacement
+        ):
+            raise BudgetExceeded("replacement")
+
+        cleaned_url, depth = unwrap(url.raw)
+        if stats is not None:
+            stats[f"unwrap_depth_{depth}"] += 1
+        if (
+            limits.max_replacement is not None
+            and len(cleaned_url) > limits.max_replacement
+        ):
+            raise BudgetExceeded("replacement")
+
+        if urls is not None:
+            urls.append(
+                {
+                    "offset": url.start,
+                    "version": url.version,
+                    "original": url.raw,
+                    "cleaned": cleaned_url,
+                }
             )
-            and parsed_url.path.startswith("/v2/")
+
+        parts.append(e[pos : url.start])
+        parts.append(cleaned_url)
+        pos = url.end
+
+    parts.append(e[pos:])
+    return "".join(parts)
+
+
+# matches everything up to (and including) the last whitespace character
+_UP_TO_LAST_WHITESPACE = re.compile(r".*\s", re.DOTALL)
+
+
+def _split_point(text):
+    # URLs never contain whitespace, so everything up to the last whitespace
+    # character can be processed without knowing what comes next. returns 0
+    # if there's no whitespace at all.
+    m = _UP_TO_LAST_WHITESPACE.match(text)
+    return 0 if m is None else m.end()
+
+
+def process_text_stream(
+    infile, outfile, chunk_size=1 << 20, max_carry=1 << 20, shadow=None
+):
+    """Decodes URLs in text read from `infile` in chunks of `chunk_size`
+    characters, writing the result to `outfile` as it goes.
+
+    Text after the last whitespace character of each chunk is carried over to
+    the next one, so URLs crossing chunk boundaries are decoded as if the
+    whole input had been passed to process_text(). A run of more than
+    `max_carry` characters without any whitespace is flushed as is (and may
+    be split) to keep memory use bounded.
+    """
+    carry = ""
+    while True:
+        chunk = infile.read(chunk_size)
+        if chunk == "":
+            break
+
+        buf = carry + chunk
+        split = _split_point(buf)
+        if split == 0 and len(buf) > max_carry:
+            split = len(buf)
+
+        if split > 0:
+            outfile.write(process_text(buf[:split], shadow=shadow))
+        carry = buf[split:]
+
+    if carry != "":
+        outfile.write(process_text(carry, shadow=shadow))
+
+
+def _line_aligned_ranges(path, num_ranges):
+    # split the file at roughly `num_ranges` equally spaced offsets, moving
+    # each offset forward to just after the next newline. a URL never spans a
+    # newline, so each range can be decoded on its own.
+    size = os.path.getsize(path)
+    offsets = [0]
+
+    with open(path, "rb") as f:
+        for i in range(1, num_ranges):
+            pos = max(offsets[-1], size * i // num_ranges)
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _process_range(job):
+    path, start, end, encoding, shadow = job
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.pread(fd, end - start, start)
+    finally:
+        os.close(fd)
+
+    # decode the same way reading the file from STDIN would (i.e., without
+    # translating newlines)
+    text = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline="").read()
+
+    return process_text(text, shadow=shadow)
+
+
+def free_threaded():
+    """Returns True on a free-threaded (no-GIL) build of Python, with the
+    GIL disabled."""
+    return not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+def process_text_parallel(
+    path, outfile, jobs, range_size=8 << 20, shadow=None, threads=None
+):
+    """Decodes URLs in the text file at `path` using `jobs` worker
+    processes (or threads, if `threads` is true, or by default on
+    free-threaded builds of Python), writing the result to `outfile` in
+    order.
+
+    The file is split into line-aligned byte ranges of about `range_size`
+    bytes, which each worker reads directly from the file. The output is the
+    same as process_text() on the whole file.
+    """
+    encoding = locale.getpreferredencoding(False)
+
+    size = os.path.getsize(path)
+    num_ranges = max(jobs, -(-size // range_size))
+    ranges = _line_aligned_ranges(path, num_ranges)
+    work = [(path, start, end, encoding, shadow) for start, end in ranges]
+
+    if threads is None:
+        threads = free_threaded()
+
+    # threads share the decoder (see decode.UrlDecoder), and neither fork
+    # nor pickle anything, but only run in parallel without the GIL
+    if threads:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            for text in executor.map(_process_range, work):
+                outfile.write(text)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        for text in pool.imap(_process_range, work):
+            outfile.write(text)
+
+
+def process_message(
+    e, preserve_mbox_from=False, limits=None, urls=None, stats=None, shadow=None
+):
+    # Email messages stored in an mbox file are delimited by a new line
+    # and text following the format:
+    #
+    #   From <email> <timestamp>
+    #
+    # For example:
+    #
+    #   From calvin@localhost  Thu Jan 01 00:00:00 1970
+    #
+    # Python's email package has support for this type of message
+    # (mailbox.mboxMessage) but may not preserve the timestamp.
+    # One could also use `formail` (part of procmail) to regenerate this line,
+    # but `formail` also refreshes the timestamp.
+    #
+    # We'll simply preserve the first line if it starts with "From ".
+    # Adding a more complex regex seems unnecessary here.
+    #
+    mbox_from = ""
+    if preserve_mbox_from:
+        if e.startswith("From "):
+            mbox_from = e.partition("\n")[0]
+            mbox_from += "\n"
+
+    # convert text to an email message
+    e = email.message_from_string(e, policy=email.policy.default)
+
+    # process and replace URLs in place
+    num_urls = 0 if urls is None else len(urls)
+    process_payload(e, limits, urls, stats=stats, shadow=shadow)
+    if urls is not None:
+        for url in urls[num_urls:]:
+            url["message_id"] = e["Message-ID"]
+
+    return f"{mbox_from}{e}"
+
+
+def _vm_size():
+    # current size of our address space, in bytes
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+
+def process_message_with_budget(
+    raw,
+    encoding="utf-8",
+    errors="strict",
+    preserve_mbox_from=False,
+    limits=Limits(),
+    urls=None,
+    stats=None,
+    shadow=None,
+):
+    """Like process_message(), but for the raw bytes of a message, and
+    within the given limits. Nothing is added to `urls` or `stats` if a limit
+    is exceeded.
+
+    Returns (output, None) on success. If a limit is exceeded, gives up and
+    returns (raw, reason), where `raw` is the original message unchanged and
+    `reason` is one of "time", "memory", "urls", "replacement", "depth" or
+    "parts".
+    """
+    old_alarm = None
+    old_rlimit = None
+
+    def alarm(signum, frame):
+        raise BudgetExceeded("time")
+
+    try:
+        if limits.seconds is not None:
+            old_alarm = signal.signal(signal.SIGALRM, alarm)
+            signal.setitimer(signal.ITIMER_REAL, limits.seconds)
+
+        if limits.memory is not None:
+            old_rlimit = resource.getrlimit(resource.RLIMIT_AS)
+            soft = _vm_size() + limits.memory
+            if old_rlimit[1] != resource.RLIM_INFINITY:
+                soft = min(soft, old_rlimit[1])
+            resource.setrlimit(resource.RLIMIT_AS, (soft, old_rlimit[1]))
+
+        found = None if urls is None else []
+        counts = None if stats is None else collections.Counter()
+        output = process_message(
+            raw.decode(encoding, errors),
+            preserve_mbox_from,
+            limits,
+            found,
+            counts,
+            shadow,
         )
-        or (parsed_url.path.startswith("urldefense.proofpoint.com/v2/"))
-        or (parsed_url.path.startswith("urldefense.com/v2/"))
-        or (parsed_url.path.startswith("urldefense.us/v2/"))
-    ):
-        cleaned_url = decode_ppv2(mangled_url)
-    elif (
-        (
-            (
-                parsed_url.netloc == "urldefense.com"
-                or parsed_url.netloc == "urldefense.us"
-            )
-            and parsed_url.path.startswith("/v3/")
+        if urls is not None:
+            urls.extend(found)
+        if stats is not None:
+            stats.update(counts)
+        return output, None
+    except BudgetExceeded as err:
+        return raw, err.args[0]
+    except MemoryError:
+        return raw, "memory"
+    except RecursionError:
+        # the email package itself recurses when parsing and generating
+        # nested messages, so very deep nesting can still end up here
+        return raw, "depth"
+    finally:
+        if limits.seconds is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_alarm)
+        if old_rlimit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, old_rlimit)
+
+
+#
+# rewriting messages in place (maildir_rewrite.py, mbox_rewrite.py,
+# imap_rewrite.py, spool_queue.py)
+#
+# a message is only rewritten if a mangled URL in it was actually decoded:
+# the email package's output for any other message may still differ from
+# the original (long headers refolded, 8bit parts re-encoded, ...), which
+# isn't worth a write and breaks DKIM signatures. messages that can't
+# contain a mangled URL aren't even parsed.
+#
+
+# content-transfer-encodings that hide the anchors, and charsets in which
+# even a plain anchor isn't ASCII (both searched for in lowercased text, and
+# each starting with a literal, which the regex engine can skip ahead to)
+ENCODED_REGEX = re.compile(rb"content-transfer-encoding:\s*(?:base64|quoted-printable)")
+WIDE_CHARSET_REGEX = re.compile(rb"charset=\W?(?:utf-?16|utf-?32|ucs-?[24])")
+
+
+def may_contain_mangled(raw):
+    """Returns False if the message `raw` (bytes) can't contain a mangled
+    URL, without parsing it."""
+    text = raw.decode("latin-1")
+    if may_contain_anchor(text, None):
+        return True
+    lower = raw.lower()
+    if WIDE_CHARSET_REGEX.search(lower) is not None:
+        return True
+    if ENCODED_REGEX.search(lower) is None:
+        return False
+    return may_contain_anchor(text, "base64") or may_contain_anchor(
+        text, "quoted-printable"
+    )
+
+
+def rewrite_raw_message(
+    raw, label, limits=Limits(), counts=None, preserve_mbox_from=False
+):
+    """Returns the message `raw` (bytes) with mangled URLs decoded, or None to
+    leave it as it is: if no mangled URL was decoded, if a limit was exceeded
+    (counted in `counts` as "budget_exceeded_<reason>"), or if it couldn't be
+    processed (counted as "errors", and reported on stderr after `label`)."""
+    if counts is None:
+        counts = collections.Counter()
+    if not may_contain_mangled(raw):
+        return None
+
+    stats = collections.Counter()
+    try:
+        output, reason = process_message_with_budget(
+            raw, "utf-8", "surrogateescape", preserve_mbox_from, limits, stats=stats
         )
-        or (parsed_url.path.startswith("urldefense.com/v3/"))
-        or (parsed_url.path.startswith("urldefense.us/v3/"))
+    except Exception as err:
+        # leave it as it is, and carry on with the others
+        print(f"{label}: {err}", file=sys.stderr)
+        counts["errors"] += 1
+        return None
+    if reason is not None:
+        counts[f"budget_exceeded_{reason}"] += 1
+        return None
+
+    # a part that only mentions a gateway (with no mangled URL in it) comes
+    # out reformatted too
+    if stats["unwrap_depth_0"] == sum(
+        n for key, n in stats.items() if key.startswith("unwrap_depth_")
     ):
-        cleaned_url = decode_ppv3(mangled_url, unquote_url)
-    else:
-        # assume URL hasn't been mangled
-        return mangled_url
+        return None
 
-    return cleaned_url
+    # process_message_with_budget() returns str on success
+    output = output.encode("utf-8", "surrogateescape")
+    return None if output == raw else output
 
 
-def process_payload(e):
-    if e.is_multipart():
-        for p in e.get_payload():
-            process_payload(p)
-    else:
-        t = e.get_content_type()
-        # XXX are there any more formats we should consider?
-        if t in ["text/plain", "text/html"]:
-            encoding = e.get("Content-Transfer-Encoding")
-            if encoding != None:
-                encoding = encoding.lower()
-
-            payload = e.get_content()
-
-            # only clean proofpoint-encoded URLs--the "urldefense"
-            # prefix might be different across installations
-            payload_clean = re.sub(
-                URL_REGEX,
-                lambda match: (
-                    decode(match.group())
-                    if "urldefense" in match.group()
-                    else match.group()
-                ),
-                payload,
-            )
+def fsync_dir(path):
+    """Makes the renames (and new or removed files) in the directory at
+    `path` durable."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-            # modify the payload in place, which also sets the following:
-            #
-            #   Content-Type: text/plain, charset="utf-8"
-            #   Content-Transfer-Encoding: 7bit
-            e.set_content(payload_clean)
-
-            # set content-type correctly, if we originally had text/html
-            del e["Content-Type"]
-            charset = e.get_content_charset()
-            if charset == None:
-                charset = "utf-8"
-            e.add_header("Content-Type", t, charset=charset)
-
-            # XXX reset content-transfer-encoding header?
-            #
-            # set_content should take care of encoding, although it defaults to
-            # 7bit. this might be problematic if we processed base64-encoded
-            # parts and re-encoded to 7bit, but text/plain and text/html
-            # _shouldn't_ be in base64 encoding anyways?
-            #
-            # python3.7 email APIs doesn't seem to have an easy way to deal
-            # with changing the cte?
-
-
-def process_text(e):
-    e_clean = re.sub(
-        URL_REGEX,
-        lambda match: (
-            decode(match.group()) if "urldefense" in match.group() else match.group()
-        ),
-        e,
-    )
-    return e_clean
+
+def update_counters_file(path, counts):
+    """Adds `counts` (a dict of counter names to integers) to the counters
+    stored as JSON in the file at `path`, creating it if needed.
+
+    The file is locked while it's updated, so many processes (e.g., one per
+    message delivered by procmail) can share the same file.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        data = f.read()
+        totals = collections.Counter(json.loads(data) if data else {})
+        totals.update(counts)
+
+        f.seek(0)
+        f.truncate()
+        json.dump(totals, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    return totals
 
 
 if __name__ == "__main__":
@@ -454,43 +736,316 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--stream",
+        "-s",
+        help="with --plaintext, read and decode input in chunks instead of all at once (constant memory)",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="with --plaintext and FILE, decode using this many worker processes",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--threads",
+        help="with --jobs, use threads instead of processes (the default on free-threaded builds of Python)",
+        action="store_true",
+        default=None,
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="write output to this file instead of STDOUT",
+        default=None,
+    )
+    parser.add_argument(
+        "file",
+        nargs="?",
+        help="read input from this file instead of STDIN",
+        default=None,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="give up on a message after this many seconds and output it unchanged",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="give up on a message that needs more than this many MiB of memory and output it unchanged",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-urls",
+        help="give up on a message with more than this many URLs in a part and output it unchanged",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-replacement",
+        help="give up on a message with a decoded URL longer than this and output it unchanged",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-depth",
+        help="give up on a message with MIME parts nested deeper than this and output it unchanged",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-parts",
+        help="give up on a message with more MIME parts than this and output it unchanged",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--urls",
+        help="also append the URLs found in the message, as JSON lines, to this file (e.g., /dev/fd/3)",
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        help="add counters (messages processed, limits exceeded, MIME parts per depth) to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "--shadow",
+        metavar="ENGINE",
+        help=f"also run this engine ({', '.join(SHADOW_ENGINES)} or module:function) and log how its output compares, without using it",
+        default=None,
+    )
+    parser.add_argument(
+        "--shadow-log",
+        metavar="FILE",
+        help="with --shadow, append comparisons to this file as JSON lines",
+        default=None,
+    )
+    parser.add_argument(
+        "--shadow-rate",
+        metavar="RATE",
+        help="with --shadow, fraction of texts to compare (default: %(default)s)",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--unwrap-depth",
+        metavar="N",
+        help=f"unwrap at most N layers of nested mangled URLs (default: {DEFAULT_UNWRAP_DEPTH})",
+        type=int,
+        default=DEFAULT_UNWRAP_DEPTH,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="read the input file as an mbox, and only decode the messages appended since the checkpoint in FILE (appending them to --output), and update it",
+        default=None,
+    )
+    parser.add_argument(
+        "--follow",
+        metavar="SECONDS",
+        help="with --checkpoint, keep checking for new messages every SECONDS",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="look up and store decoded URLs in this database, shared with other processes (see decode_cache.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="MIB",
+        help="with --cache, evict the least recently used URLs beyond this many MiB (default: %(default)s)",
+        type=int,
+        default=64,
+    )
     args = parser.parse_args()
 
-    # read email from STDIN
-    e = "".join(sys.stdin.readlines())
+    if args.stream and not args.plaintext:
+        parser.error("--stream requires --plaintext")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.jobs > 1 and not (args.plaintext and args.file):
+        parser.error("--jobs requires --plaintext and FILE")
+    if args.threads and args.jobs == 1:
+        parser.error("--threads requires --jobs")
+    if args.threads and args.cache is not None:
+        parser.error("--threads can't be used with --cache")
+    if args.shadow is not None and args.shadow_log is None:
+        parser.error("--shadow requires --shadow-log")
+    if args.checkpoint is not None and (args.file is None or args.plaintext):
+        parser.error("--checkpoint requires FILE, and no --plaintext")
+    if args.follow is not None and args.checkpoint is None:
+        parser.error("--follow requires --checkpoint")
+    if args.unwrap_depth < 1:
+        parser.error("--unwrap-depth must be at least 1")
+    set_unwrap_depth(args.unwrap_depth)
+
+    shadow = None
+    if args.shadow is not None:
+        try:
+            shadow = Shadow(args.shadow, args.shadow_log, args.shadow_rate)
+        except (ValueError, ImportError, AttributeError) as err:
+            parser.error(f"--shadow: {err}")
+
+    cache = None
+    if args.cache is not None:
+        try:
+            cache = DecodeCache(args.cache, args.cache_size << 20)
+        except sqlite3.Error as err:
+            # decode without it
+            print(f"decode_email.py: --cache: {err}", file=sys.stderr)
+        set_cache(cache)
+
+    limits = Limits(
+        seconds=args.timeout,
+        memory=None if args.max_memory is None else args.max_memory << 20,
+        max_urls=args.max_urls,
+        max_replacement=args.max_replacement,
+        max_depth=args.max_depth,
+        max_parts=args.max_parts,
+    )
+
+    if args.checkpoint is not None:
+        # append each new message to the output, and update the counters and
+        # URLs log before each checkpoint
+        outfile = sys.stdout if args.output is None else open(args.output, "ab")
+        out = outfile.buffer if outfile is sys.stdout else outfile
+        urls = None if args.urls is None else []
+        counts = collections.Counter()
+
+        def process(raw):
+            counts["messages"] += 1
+            output, reason = process_message_with_budget(
+                raw, "utf-8", "surrogateescape", True, limits, urls, counts, shadow
+            )
+            if reason is None:
+                output = output.encode("utf-8", "surrogateescape")
+            else:
+                counts["budget_exceeded"] += 1
+                counts[f"budget_exceeded_{reason}"] += 1
+
+            # messages in an mbox end with a blank line
+            if not output.endswith(b"\n"):
+                output += b"\n"
+            if not output.endswith(b"\n\n"):
+                output += b"\n"
+            out.write(output)
+
+        def commit():
+            if urls:
+                with open(args.urls, "a") as f:
+                    for url in urls:
+                        f.write(json.dumps(url) + "\n")
+                urls.clear()
+            if cache is not None:
+                hits, misses = cache.hits, cache.misses
+                cache.flush()
+                counts["cache_hits"] += hits
+                counts["cache_misses"] += misses
+                cache.hits = cache.misses = 0
+            if args.stats is not None and counts:
+                update_counters_file(args.stats, counts)
+            counts.clear()
+
+        try:
+            follow(
+                args.file,
+                args.checkpoint,
+                process,
+                output=out,
+                commit=commit,
+                poll=args.follow,
+            )
+        except AlreadyFollowed as err:
+            parser.exit(1, f"decode_email.py: {err}\n")
+        except KeyboardInterrupt:
+            pass
+
+        if cache is not None:
+            cache.close()
+        outfile.close()
+        sys.exit(0)
+
+    # like STDIN, don't translate newlines
+    infile = sys.stdin if args.file is None else open(args.file, newline="")
+    outfile = sys.stdout if args.output is None else open(args.output, "w")
+
+    if args.plaintext and args.jobs > 1:
+        # (a DecodeCache can't be shared between threads)
+        threads = False if cache is not None else args.threads
+        process_text_parallel(
+            args.file, outfile, args.jobs, shadow=shadow, threads=threads
+        )
+        # print() adds a trailing newline in the in-memory mode below
+        outfile.write("\n")
+    elif args.plaintext and args.stream:
+        process_text_stream(infile, outfile, shadow=shadow)
+        # print() adds a trailing newline in the in-memory mode below
+        outfile.write("\n")
+    elif args.plaintext:
+        # read text from STDIN
+        e = "".join(infile.readlines())
 
-    if args.plaintext:
-        e_clean = process_text(e)
-        print(e_clean)
+        e_clean = process_text(e, shadow=shadow)
+        print(e_clean, file=outfile)
     else:
-        # Email messages stored in an mbox file are delimited by a new line
-        # and text following the format:
-        #
-        #   From <email> <timestamp>
-        #
-        # For example:
-        #
-        #   From calvin@localhost  Thu Jan 01 00:00:00 1970
-        #
-        # Python's email package has support for this type of message
-        # (mailbox.mboxMessage) but may not preserve the timestamp.
-        # One could also use `formail` (part of procmail) to regenerate this line,
-        # but `formail` also refreshes the timestamp.
-        #
-        # We'll simply preserve the first line if it starts with "From ".
-        # Adding a more complex regex seems unnecessary here.
-        #
-        mbox_from = ""
-        if args.preserve_mbox_from:
-            if e.startswith("From "):
-                mbox_from = e.partition("\n")[0]
-                mbox_from += "\n"
-
-        # convert text to an email message
-        e = email.message_from_string(e, policy=email.policy.default)
-
-        # process and replace URLs in place
-        process_payload(e)
-
-        # write email to STDOUT
-        print(f"{mbox_from}{e}")
+        # read email from STDIN
+        raw = infile.buffer.read()
+
+        urls = None if args.urls is None else []
+
+        counts = collections.Counter(messages=1)
+
+        start = time.monotonic()
+        e_clean, reason = process_message_with_budget(
+            raw,
+            infile.encoding,
+            infile.errors,
+            args.preserve_mbox_from,
+            limits,
+            urls,
+            counts,
+            shadow,
+        )
+
+        if reason is None:
+            # write email to STDOUT
+            print(e_clean, file=outfile)
+        else:
+            # fail open: write the original message, byte for byte
+            outfile.flush()
+            outfile.buffer.write(e_clean)
+
+            counts["budget_exceeded"] += 1
+            counts[f"budget_exceeded_{reason}"] += 1
+            print(
+                f"decode_email.py: {reason} limit exceeded after "
+                f"{time.monotonic() - start:.3f}s, message ({len(raw)} bytes) "
+                "written unchanged",
+                file=sys.stderr,
+            )
+
+        if urls:
+            with open(args.urls, "a") as f:
+                for url in urls:
+                    f.write(json.dumps(url) + "\n")
+
+        if cache is not None:
+            cache.flush()
+            counts["cache_hits"] += cache.hits
+            counts["cache_misses"] += cache.misses
+
+        if args.stats is not None:
+            update_counters_file(args.stats, counts)
+
+    if cache is not None:
+        cache.close()
+    outfile.close()
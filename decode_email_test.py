@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import base64
+import collections
+import email, email.message, email.policy
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from parameterized import parameterized
+
+from decode_email import process_text, process_text_stream, process_text_parallel
+from decode_email import process_message, process_message_with_budget, Limits
+from decode_email import update_counters_file
+from decode_email import Shadow, process_text_regex
+from decode_test import mangle_v2, mangle_v3
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "decode_email.py")
+
+V2_URL = "https://urldefense.com/v2/url?u=https-3A__www.example.com_-23-23-23-23-23foobar&d=&c=&r=&m=&s=&e="
+V3_URL = "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+V3_URL_UTF8 = (
+    "https://urldefense.com/v3/__http://www.example.com/**E.html__;5L2g5aW9!!foo!bar$"
+)
+
+TEXT = (
+    f"Hello World!\n\n{V3_URL}\n\n"
+    f"see <{V2_URL}> and ({V3_URL_UTF8}).\n"
+    f"unmangled: https://www.example.org/path and www.example.com\n"
+    f" {V3_URL} {V2_URL}"
+)
+
+
+class TestProcessText(unittest.TestCase):
+    def test_decodes(self):
+        out = process_text(TEXT)
+        self.assertNotIn("urldefense", out)
+        self.assertIn("http://www.example.com/你好.html", out)
+        self.assertIn("https://www.example.com/#####foobar", out)
+        self.assertIn("https://example.com/#newsletter", out)
+
+    def test_no_urls(self):
+        self.assertEqual(process_text("Hello World!\n"), "Hello World!\n")
+
+    def test_nested(self):
+        stats = collections.Counter()
+        text = f"{V3_URL}\n{mangle_v3(V3_URL)}\n{mangle_v3(mangle_v2(V3_URL))}\n"
+        self.assertEqual(
+            process_text(text, stats=stats),
+            "https://example.com/#newsletter\n" * 3,
+        )
+        self.assertEqual(
+            stats, {"unwrap_depth_1": 1, "unwrap_depth_2": 1, "unwrap_depth_3": 1}
+        )
+
+
+class TestProcessTextStream(unittest.TestCase):
+    @parameterized.expand([[1], [2], [7], [64], [100], [1 << 20]])
+    def test_identical(self, chunk_size):
+        out = io.StringIO()
+        process_text_stream(io.StringIO(TEXT * 3), out, chunk_size=chunk_size)
+        self.assertEqual(out.getvalue(), process_text(TEXT * 3))
+
+    def test_max_carry(self):
+        # a run without any whitespace longer than max_carry is still
+        # written out, and nothing is lost
+        text = "x" * 1000
+        out = io.StringIO()
+        process_text_stream(io.StringIO(text), out, chunk_size=10, max_carry=100)
+        self.assertEqual(out.getvalue(), text)
+
+
+class TestProcessTextParallel(unittest.TestCase):
+    @parameterized.expand([[1, 1 << 20], [2, 100], [3, 7]])
+    def test_identical(self, jobs, range_size):
+        text = (TEXT + "\r\n") * 20
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input.txt")
+            with open(path, "w", newline="") as f:
+                f.write(text)
+
+            out = io.StringIO()
+            process_text_parallel(path, out, jobs, range_size=range_size)
+            self.assertEqual(out.getvalue(), process_text(text))
+
+    @parameterized.expand([[2, 100], [4, 7]])
+    def test_threads(self, jobs, range_size):
+        text = (TEXT + "\r\n") * 20
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "input.txt")
+            with open(path, "w", newline="") as f:
+                f.write(text)
+
+            out = io.StringIO()
+            process_text_parallel(path, out, jobs, range_size=range_size, threads=True)
+            self.assertEqual(out.getvalue(), process_text(text))
+
+
+MESSAGE = f"""From: calvin@localhost
+To: calvin@localhost
+Subject: testing
+MIME-Version: 1.0
+Content-Type: text/plain; charset=utf-8
+
+{TEXT}
+"""
+
+
+class TestProcessMessageWithBudget(unittest.TestCase):
+    def test_within_budget(self):
+        raw = MESSAGE.encode("utf-8")
+        limits = Limits(seconds=60, memory=1 << 30, max_urls=100, max_replacement=1000)
+        output, reason = process_message_with_budget(raw, limits=limits)
+        self.assertIsNone(reason)
+        self.assertEqual(output, process_message(MESSAGE))
+        self.assertNotIn("urldefense", output)
+
+    @parameterized.expand(
+        [
+            ["urls", Limits(max_urls=3)],
+            ["replacement", Limits(max_replacement=20)],
+            ["time", Limits(seconds=0.01)],
+            ["memory", Limits(memory=1 << 20)],
+        ]
+    )
+    def test_fail_open(self, expected, limits):
+        # big enough to take a while and need some memory
+        raw = (MESSAGE + TEXT * 20000).encode("utf-8")
+        output, reason = process_message_with_budget(raw, limits=limits)
+        self.assertEqual(reason, expected)
+        self.assertEqual(output, raw)
+
+    def test_replacement_before_decoding(self):
+        # a URL bound to decode to more than max_replacement isn't decoded
+        url = "https://urldefense.com/v3/__http://a" + "**_" * 1000 + "__;Iw!!foo!bar$"
+        raw = MESSAGE.replace(TEXT, f"see {url}\n").encode("utf-8")
+        with mock.patch("decode_email.unwrap", side_effect=AssertionError):
+            output, reason = process_message_with_budget(
+                raw, limits=Limits(max_replacement=1000)
+            )
+        self.assertEqual(reason, "replacement")
+        self.assertEqual(output, raw)
+
+    def test_urls_not_collected_on_fail_open(self):
+        urls = []
+        raw = MESSAGE.encode("utf-8")
+        output, reason = process_message_with_budget(
+            raw, limits=Limits(max_urls=1), urls=urls
+        )
+        self.assertEqual(reason, "urls")
+        self.assertEqual(urls, [])
+
+
+class TestUpdateCountersFile(unittest.TestCase):
+    def test_add(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stats.json")
+            update_counters_file(path, {"messages": 1, "budget_exceeded": 1})
+            totals = update_counters_file(path, {"messages": 2})
+            self.assertEqual(totals, {"messages": 3, "budget_exceeded": 1})
+            with open(path) as f:
+                self.assertEqual(json.load(f), totals)
+
+
+class TestUrlSidecar(unittest.TestCase):
+    def test_process_text(self):
+        urls = []
+        output = process_text(TEXT, urls=urls)
+        self.assertEqual(output, process_text(TEXT))
+        self.assertEqual(len(urls), 7)
+        for url in urls:
+            self.assertEqual(TEXT[url["offset"] :].index(url["original"]), 0)
+            self.assertIn(url["cleaned"], output)
+        self.assertEqual(
+            [url["version"] for url in urls],
+            ["ppv3", "ppv2", "ppv3", None, None, "ppv3", "ppv2"],
+        )
+        self.assertEqual(urls[0]["cleaned"], "https://example.com/#newsletter")
+
+    def test_unmangled_only(self):
+        urls = []
+        text = "see https://www.example.org/path"
+        self.assertEqual(process_text(text, urls=urls), text)
+        self.assertEqual(
+            urls,
+            [
+                {
+                    "offset": 4,
+                    "version": None,
+                    "original": "https://www.example.org/path",
+                    "cleaned": "https://www.example.org/path",
+                }
+            ],
+        )
+
+    def test_multipart(self):
+        message = (
+            "From: a@example.com\n"
+            "Message-ID: <1@example.com>\n"
+            "MIME-Version: 1.0\n"
+            'Content-Type: multipart/alternative; boundary="XX"\n\n'
+            "--XX\nContent-Type: text/plain\n\n"
+            f"see {V3_URL}\n"
+            "--XX\nContent-Type: text/html\n\n"
+            f'<a href="{V2_URL}">x</a>\n'
+            "--XX--\n"
+        )
+        urls = []
+        output = process_message(message, urls=urls)
+        self.assertEqual(output, process_message(message))
+        self.assertEqual(
+            [
+                (u["message_id"], u["part"], u["content_type"], u["offset"])
+                for u in urls
+            ],
+            [
+                ("<1@example.com>", "1", "text/plain", 4),
+                ("<1@example.com>", "2", "text/html", 9),
+            ],
+        )
+        self.assertEqual(
+            [u["cleaned"] for u in urls],
+            ["https://example.com/#newsletter", "https://www.example.com/#####foobar"],
+        )
+
+    def test_stdout_unchanged(self):
+        # the sidecar doesn't change the output: a base64 part without a
+        # mangled URL is scanned, but left as it is
+        text = base64.encodebytes(b"see https://www.example.org/path\n" * 10)
+        message = (
+            "From: a@example.com\n"
+            "MIME-Version: 1.0\n"
+            'Content-Type: multipart/mixed; boundary="XX"\n\n'
+            "--XX\nContent-Type: text/plain; charset=utf-8\n"
+            "Content-Transfer-Encoding: base64\n\n"
+            f"{text.decode()}"
+            "--XX\nContent-Type: text/plain\n\n"
+            f"see {V3_URL}\n"
+            "--XX--\n"
+        ).encode()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "urls.jsonl")
+            outputs = [
+                subprocess.run(
+                    [sys.executable, SCRIPT, *args],
+                    input=message,
+                    capture_output=True,
+                    check=True,
+                ).stdout
+                for args in [[], ["--urls", path]]
+            ]
+            with open(path) as f:
+                urls = [json.loads(line) for line in f]
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn(text, outputs[1])
+        self.assertEqual([u["version"] for u in urls], [None] * 10 + ["ppv3"])
+
+
+def nested(depth, text=f"see {V3_URL}\n"):
+    # a text/plain part inside `depth` levels of multipart/mixed
+    message = f"Content-Type: text/plain\n\n{text}"
+    for i in range(depth):
+        message = (
+            f'Content-Type: multipart/mixed; boundary="b{i}"\n\n'
+            f"--b{i}\n{message}--b{i}--\n"
+        )
+    return "MIME-Version: 1.0\n" + message
+
+
+def digest(num_parts, text=f"see {V3_URL}\n"):
+    # a multipart/digest of `num_parts` message/rfc822 parts
+    parts = "".join(
+        f"--d\n\nSubject: {i}\nContent-Type: text/plain\n\n{text}"
+        for i in range(num_parts)
+    )
+    return (
+        "MIME-Version: 1.0\n"
+        'Content-Type: multipart/digest; boundary="d"\n\n'
+        f"{parts}--d--\n"
+    )
+
+
+class TestMimeWalker(unittest.TestCase):
+    def test_digest(self):
+        urls = []
+        stats = collections.Counter()
+        output = process_message(digest(500), urls=urls, stats=stats)
+        self.assertNotIn("urldefense", output)
+        self.assertEqual(output.count("https://example.com/#newsletter"), 500)
+        self.assertEqual(urls[0]["part"], "1.1")
+        self.assertEqual(urls[-1]["part"], "500.1")
+        self.assertEqual(
+            stats,
+            {
+                "mime_depth_0": 1,
+                "mime_depth_1": 500,
+                "mime_depth_2": 500,
+                "unwrap_depth_1": 500,
+            },
+        )
+
+    def test_nested(self):
+        urls = []
+        stats = collections.Counter()
+        output = process_message(nested(50), urls=urls, stats=stats)
+        self.assertNotIn("urldefense", output)
+        self.assertEqual(urls[0]["part"], ".".join(["1"] * 50))
+        self.assertEqual(stats["mime_depth_50"], 1)
+
+    def test_skipped(self):
+        message = (
+            "MIME-Version: 1.0\n"
+            'Content-Type: multipart/mixed; boundary="b"\n\n'
+            "--b\nContent-Type: image/png\nContent-Transfer-Encoding: base64\n\n"
+            "iVBORw0KGgo=\n"
+            "--b\nContent-Type: message/partial; id=x; number=1\n\n"
+            f"Content-Type: text/plain\n\n{V3_URL}\n"
+            f"--b\nContent-Type: text/plain\n\n{V3_URL}\n"
+            "--b--\n"
+        )
+        stats = collections.Counter()
+        output = process_message(message, stats=stats)
+        self.assertEqual(output.count("urldefense"), 1)
+        self.assertEqual(stats["mime_parts_skipped"], 2)
+
+    @parameterized.expand(
+        [
+            ["depth", nested(10), Limits(max_depth=9)],
+            ["depth", nested(1000), Limits()],
+            ["parts", digest(100), Limits(max_parts=200)],
+        ]
+    )
+    def test_fail_open(self, expected, message, limits):
+        raw = message.encode("utf-8")
+        output, reason = process_message_with_budget(raw, limits=limits)
+        self.assertEqual(reason, expected)
+        self.assertEqual(output, raw)
+
+    @parameterized.expand(
+        [
+            [nested(10), Limits(max_depth=10)],
+            [digest(100), Limits(max_parts=201)],
+        ]
+    )
+    def test_within_limits(self, message, limits):
+        output, reason = process_message_with_budget(
+            message.encode("utf-8"), limits=limits
+        )
+        self.assertIsNone(reason)
+        self.assertNotIn("urldefense", output)
+
+
+class TestEncodedParts(unittest.TestCase):
+    def message(self, text, cte, charset="utf-8"):
+        e = email.message.EmailMessage()
+        e["Subject"] = "testing"
+        e.set_content(text, subtype="html", charset=charset, cte=cte)
+        return str(e)
+
+    @parameterized.expand([["base64"], ["quoted-printable"]])
+    def test_unchanged(self, cte):
+        # parts without a mangled URL are left as they are
+        message = self.message("<p>see https://www.example.org/path</p>\n" * 100, cte)
+        self.assertEqual(process_message(message), message)
+
+    @parameterized.expand(
+        [
+            ["base64", "utf-8"],
+            ["quoted-printable", "utf-8"],
+            ["base64", "utf-16"],
+        ]
+    )
+    def test_decoded(self, cte, charset):
+        text = "<p>x</p>\n" * 100 + f'<a href="{V3_URL}">newsletter</a>\n'
+        output = process_message(self.message(text, cte, charset))
+        e = email.message_from_string(output, policy=email.policy.default)
+        self.assertIn("https://example.com/#newsletter", e.get_content())
+        self.assertNotIn("urldefense", e.get_content())
+
+
+def upper(text):
+    # a (bad) candidate engine, for TestShadow
+    return text.upper()
+
+
+def broken(text):
+    raise RuntimeError("broken engine")
+
+
+def slow(text):
+    time.sleep(10)
+    return text
+
+
+class TestShadow(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, "shadow.log")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def records(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def test_regex_engine(self):
+        self.assertEqual(process_text_regex(TEXT), process_text(TEXT))
+
+    @parameterized.expand(
+        [
+            ["regex", False, None],
+            ["decode_email_test:upper", True, None],
+            ["decode_email_test:broken", True, "RuntimeError: broken engine"],
+        ]
+    )
+    def test_process_text(self, engine, diverged, error):
+        shadow = Shadow(engine, self.log)
+        self.assertEqual(process_text(TEXT, shadow=shadow), process_text(TEXT))
+
+        (record,) = self.records()
+        self.assertEqual(record["engine"], engine)
+        self.assertEqual(record["length"], len(TEXT))
+        self.assertEqual(record["diverged"], diverged)
+        self.assertEqual(set(record["seconds"]), {"current", "candidate"})
+        if diverged:
+            self.assertEqual(record["current"], process_text(TEXT))
+            self.assertEqual(record["error"], error)
+        else:
+            self.assertNotIn("current", record)
+
+    def test_sampling(self):
+        shadow = Shadow("regex", self.log, rate=0)
+        process_text(TEXT, shadow=shadow)
+        self.assertEqual(self.records(), [])
+
+        shadow = Shadow("regex", self.log, rate=0.5)
+        for _ in range(200):
+            process_text(TEXT, shadow=shadow)
+        self.assertTrue(50 < len(self.records()) < 150)
+
+    def test_message(self):
+        shadow = Shadow("decode_email_test:upper", self.log)
+        output, reason = process_message_with_budget(
+            MESSAGE.encode("utf-8"), shadow=shadow
+        )
+        self.assertIsNone(reason)
+        self.assertEqual(output, process_message(MESSAGE))
+        self.assertEqual(len(self.records()), 1)
+
+    def test_budget_exceeded(self):
+        # the message's timeout goes off in the candidate engine: the message
+        # is left as it is, and nothing is logged
+        shadow = Shadow("decode_email_test:slow", self.log)
+        start = time.monotonic()
+        output, reason = process_message_with_budget(
+            MESSAGE.encode("utf-8"), limits=Limits(seconds=0.2), shadow=shadow
+        )
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(reason, "time")
+        self.assertEqual(output, MESSAGE.encode("utf-8"))
+        self.assertEqual(self.records(), [])
+
+    def test_bulk(self):
+        shadow = Shadow("regex", self.log)
+        text = TEXT * 100
+
+        outfile = io.StringIO()
+        process_text_stream(io.StringIO(text), outfile, chunk_size=1000, shadow=shadow)
+        self.assertEqual(outfile.getvalue(), process_text(text))
+
+        path = os.path.join(self.tmp.name, "input.txt")
+        with open(path, "w") as f:
+            f.write(text)
+        outfile = io.StringIO()
+        process_text_parallel(path, outfile, 2, range_size=1000, shadow=shadow)
+        self.assertEqual(outfile.getvalue(), process_text(text))
+
+        records = self.records()
+        self.assertGreater(len(records), 2)
+        self.assertFalse(any(r["diverged"] for r in records))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            Shadow("bogus", self.log)
+
+
+if __name__ == "__main__":
+    unittest.main()
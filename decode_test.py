@@ -13,11 +13,29 @@
 # If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
 #
 
+import base64
+import os
+import quopri
+import random
+import re
+import subprocess
+import sys
+import threading
+import urllib.parse
 import unittest
 from parameterized import parameterized
 
 from decode import decode_ppv3
 from decode import decode_ppv2
+from decode import decode, find_decoder, anchor_regex
+from decode import register_decoder, unregister_decoder
+from decode import iter_urls, UrlMatch
+from decode import may_contain_anchor, identify, decode_host, min_length
+from decode import replacement_str_mapping
+from decode import unwrap, set_unwrap_depth, set_cache, DEFAULT_UNWRAP_DEPTH
+from decode import UrlDecoder, decoders
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "decode.py")
 
 
 class TestDecodeV2Methods(unittest.TestCase):
@@ -39,6 +57,10 @@ class TestDecodeV2Methods(unittest.TestCase):
 
         self.assertEqual(decode_ppv2(url), expected)
 
+    def test_no_u(self):
+        with self.assertRaises(ValueError):
+            decode_ppv2("https://urldefense.com/v2/url?x=1")
+
 
 class TestDecodeV3Methods(unittest.TestCase):
     def test_simple(self):
@@ -189,5 +211,457 @@ class TestSequenceUTF8(unittest.TestCase):
         self.assertEqual(decode_ppv3(url), expected)
 
 
+class TestDecoderRegistry(unittest.TestCase):
+    def tearDown(self):
+        try:
+            unregister_decoder("test")
+        except KeyError:
+            pass
+
+    @parameterized.expand(
+        [
+            ["https://urldefense.proofpoint.com/v2/url?u=x", "ppv2"],
+            ["https://urldefense.us/v2/url?u=x", "ppv2"],
+            ["urldefense.com/v2/url?u=x", "ppv2"],
+            ["https://urldefense.com/v3/__x__;!!foo!bar$", "ppv3"],
+            ["urldefense.us/v3/__x__;!!foo!bar$", "ppv3"],
+            ["https://urldefense.proofpoint.com/v3/__x__;!!foo!bar$", None],
+            ["https://www.example.com/v3/__x__;!!foo!bar$", None],
+        ]
+    )
+    def test_builtin(self, url, name):
+        decoder = find_decoder(url)
+        self.assertEqual(decoder and decoder.name, name)
+
+    def test_register(self):
+        url = "https://gateway.example.net/r/?url=http%3A%2F%2Fwww.example.com"
+        self.assertEqual(decode(url), url)
+        self.assertIsNone(anchor_regex().search(url))
+
+        register_decoder(
+            "test",
+            ["gateway.example.net"],
+            "/r/",
+            lambda mangled_url, unquote_url: "http://www.example.com",
+        )
+        self.assertEqual(decode(url), "http://www.example.com")
+        self.assertIsNotNone(anchor_regex().search(url))
+
+        unregister_decoder("test")
+        self.assertEqual(decode(url), url)
+        self.assertIsNone(anchor_regex().search(url))
+
+
+class TestIdentify(unittest.TestCase):
+    @parameterized.expand(
+        [
+            [
+                "https://urldefense.com/v3/__https://www.example.com__;!!ORG!RCPT$",
+                {"org_id": "ORG", "recipient": "RCPT", "extra": {}},
+            ],
+            [
+                "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$",
+                {"org_id": "foo", "recipient": "bar", "extra": {}},
+            ],
+            [
+                "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com&d=DwMF&c=ORG&r=RCPT&m=M&s=S&e=",
+                {
+                    "org_id": "ORG",
+                    "recipient": "RCPT",
+                    "extra": {"d": "DwMF", "m": "M", "s": "S"},
+                },
+            ],
+            [
+                "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com&d=&c=&r=&m=&s=&e=",
+                {"org_id": None, "recipient": None, "extra": {}},
+            ],
+            ["https://www.example.com/", None],
+        ]
+    )
+    def test_identify(self, url, expected):
+        self.assertEqual(identify(url), expected)
+
+
+def mangle_v3(url):
+    # replaces "special" characters in `url` like proofpoint does: one with
+    # `*`, and a run of them with `**` and the number of bytes in the run
+    counts = {n: c for c, n in replacement_str_mapping.items()}
+    mangled = []
+    for run in re.findall(r"[^A-Za-z0-9./_-]+|[A-Za-z0-9./_-]+", url):
+        if re.match(r"[A-Za-z0-9./_-]", run):
+            mangled.append(run)
+        elif len(run) == 1:
+            mangled.append("*")
+        else:
+            # (runs over 65 bytes are split by proofpoint; we don't generate them)
+            mangled.append("**" + counts[len(run.encode("utf-8"))])
+    replacement = "".join(re.findall(r"[^A-Za-z0-9./_-]", url))
+    replacement_b64 = base64.urlsafe_b64encode(replacement.encode("utf-8"))
+    return (
+        f"https://urldefense.com/v3/__{''.join(mangled)}__;"
+        f"{replacement_b64.decode().rstrip('=')}!!foo!bar$"
+    )
+
+
+class TestMinLength(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["https://www.example.com/"],
+            ["https://www.example.com/a#b?c=d%7Be"],
+            ["https://www.example.com/" + "%" * 60],
+            ["https://www.example.com/你好/#ü"],
+        ]
+    )
+    def test_lower_bound(self, url):
+        mangled = mangle_v3(url)
+        self.assertLessEqual(min_length(mangled), len(decode(mangled)))
+        self.assertGreater(min_length(mangled), len("https://www.example.com/") - 5)
+
+    def test_bogus_runs(self):
+        # far more bytes asked for than the (short) base64 string holds
+        url = "https://urldefense.com/v3/__http://a" + "**_" * 1000 + "__;Iw!!foo!bar$"
+        self.assertGreater(min_length(url), 1000 * 65 // 4)
+
+    def test_not_mangled(self):
+        self.assertEqual(min_length("https://www.example.com/"), 0)
+
+
+class TestDecodeHost(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["https://urldefense.com/v3/__https://www.example.com__;!!foo!bar$"],
+            [
+                "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+            ],
+            [
+                "https://urldefense.com/v3/__http://www.example.com/**E.html__;5L2g5aW9!!foo!bar$"
+            ],
+            [mangle_v3("https://user:p@ss@www.Example.com:8443/#x?y")],
+            [mangle_v3("http://www.example.com#fragment")],
+            [mangle_v3("http://ex%41mple.com?q")],
+            [mangle_v3("https://b\u00fccher.example/")],
+            ["https://urldefense.com/v3/__http://bücher.example/**Aa__;w6w!!foo!bar$"],
+            [
+                "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com_a&d=&c=&r=&m=&s=&e="
+            ],
+            ["urldefense.com/v3/__http://www.example.com__;!!foo!bar$"],
+            ["https://www.example.org/path"],
+            ["www.example.org/path"],
+        ]
+    )
+    def test_decode_host(self, url):
+        self.assertEqual(decode_host(url), urllib.parse.urlparse(decode(url)).hostname)
+
+    def test_random(self):
+        rng = random.Random(0)
+        chars = "abcXYZ019.-_/:@#?&=%!*[]\u00e9\u4f60"
+        for _ in range(2000):
+            url = rng.choice(["http://", "https://", "ftp:/", ""]) + "".join(
+                rng.choice(chars) for _ in range(rng.randrange(30))
+            )
+            mangled = mangle_v3(url)
+            try:
+                expected = urllib.parse.urlparse(decode(mangled)).hostname
+            except ValueError:
+                # e.g., an invalid IPv6 address
+                continue
+            self.assertEqual(decode_host(mangled), expected, mangled)
+
+
+def mangle_v2(url):
+    # like proofpoint v2: `/` as `_`, and other special characters as `-XX`
+    u = "".join(
+        "_" if c == "/" else c if re.match(r"[A-Za-z0-9.]", c) else f"-{b:02X}"
+        for c in url
+        for b in (c.encode("utf-8") if c != "/" else b"/")
+    )
+    return f"https://urldefense.proofpoint.com/v2/url?u={u}&d=D&c=C&r=R&m=M&s=S&e="
+
+
+class CountingCache(dict):
+    # a decode cache (see set_cache()) that counts lookups
+    gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return super().get(key)
+
+    def put(self, key, value):
+        self[key] = value
+
+
+class TestUnwrap(unittest.TestCase):
+    URL = "https://www.example.com/a#b?c=d%7Be"
+
+    def tearDown(self):
+        set_unwrap_depth(DEFAULT_UNWRAP_DEPTH)
+
+    @parameterized.expand(
+        [
+            ["v3", [mangle_v3]],
+            ["v3 in v3", [mangle_v3, mangle_v3]],
+            ["v2 in v3", [mangle_v2, mangle_v3]],
+            ["v3 in v2", [mangle_v3, mangle_v2]],
+            ["v2 in v2", [mangle_v2, mangle_v2]],
+            ["v3 in v2 in v3", [mangle_v3, mangle_v2, mangle_v3]],
+        ]
+    )
+    def test_nested(self, _, layers):
+        url = self.URL
+        for mangle in layers:
+            url = mangle(url)
+        self.assertEqual(unwrap(url), (self.URL, len(layers)))
+        self.assertEqual(decode(url), self.URL)
+        self.assertEqual(decode_host(url), "www.example.com")
+
+    def test_unquote_innermost(self):
+        url = mangle_v3(mangle_v3(self.URL))
+        self.assertEqual(decode(url, True), urllib.parse.unquote(self.URL))
+
+        # the inner URL would be broken by unquoting it first
+        inner = mangle_v3("https://www.example.com/%2A")
+        self.assertEqual(decode(mangle_v3(inner), True), "https://www.example.com/*")
+
+    def test_unquote_once(self):
+        # each layer is decoded (and looked up in the cache) once
+        cache = CountingCache()
+        set_cache(cache)
+        try:
+            url = mangle_v3(mangle_v2(mangle_v3(self.URL)))
+            self.assertEqual(decode(url, True), urllib.parse.unquote(self.URL))
+            self.assertEqual(cache.gets, 3)
+        finally:
+            set_cache(None)
+
+    @parameterized.expand(
+        [
+            [
+                "https://urldefense.com/v2/url?u=http-3A__x.com_a-2520b&d=D&c=C&r=R&m=M&s=S&e=",
+                "http://x.com/a%20b",
+            ],
+            [
+                "https://urldefense.com/v2/url?u=http-3A__x.com_-3Fq-3Da-2526b-3Dc&d=D&e=",
+                "http://x.com/?q=a%26b=c",
+            ],
+            [
+                mangle_v2("https://www.example.com/a%7Bb"),
+                "https://www.example.com/a%7Bb",
+            ],
+            [
+                mangle_v3(mangle_v2("https://www.example.com/a%26b")),
+                "https://www.example.com/a%26b",
+            ],
+        ]
+    )
+    def test_unquote_v2(self, url, expected):
+        # v2 URLs are unquoted as they're decoded, and not again (the same
+        # output as before nested URLs were unwrapped)
+        self.assertEqual(decode(url, True), expected)
+
+        result = subprocess.run(
+            [sys.executable, SCRIPT, "--unquote", url],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout, expected + "\n")
+
+    def test_depth(self):
+        url = self.URL
+        layers = []
+        for _ in range(10):
+            url = mangle_v3(url)
+            layers.append(url)
+
+        self.assertEqual(unwrap(url), (layers[-1 - DEFAULT_UNWRAP_DEPTH], 4))
+        self.assertEqual(unwrap(url, max_depth=1), (layers[-2], 1))
+        self.assertEqual(unwrap(url, max_depth=10), (self.URL, 10))
+
+        set_unwrap_depth(1)
+        self.assertEqual(decode(url), layers[-2])
+        self.assertEqual(decode_host(url), urllib.parse.urlparse(layers[-2]).hostname)
+        with self.assertRaises(ValueError):
+            set_unwrap_depth(0)
+
+    @parameterized.expand(
+        [
+            # can't be decoded
+            ["https://urldefense.com/v3/__http://a/*__;I!!foo!bar$"],
+            # (decode_ppv2() exits)
+            ["https://urldefense.proofpoint.com/v2/url?x=y"],
+            # not a mangled URL, just a link to the gateway
+            ["https://urldefense.com/v3/"],
+        ]
+    )
+    def test_inner_not_decoded(self, inner):
+        self.assertEqual(unwrap(mangle_v3(inner)), (inner, 1))
+
+    def test_outer_errors(self):
+        with self.assertRaises(Exception):
+            unwrap("https://urldefense.com/v3/__http://a/*__;I!!foo!bar$")
+        self.assertEqual(unwrap(self.URL), (self.URL, 0))
+
+
+class TestIterUrls(unittest.TestCase):
+    def test_matches(self):
+        v2 = "https://urldefense.com/v2/url?u=https-3A__www.example.com&d=&c=&r=&m=&s=&e="
+        v3 = "https://urldefense.com/v3/__http://www.example.com__;!!foo!bar$"
+        text = f"see {v3} and <{v2}> or www.example.org."
+
+        self.assertEqual(
+            list(iter_urls(text)),
+            [
+                UrlMatch(4, 4 + len(v3), v3, "ppv3"),
+                UrlMatch(text.index(v2), text.index(v2) + len(v2), v2, "ppv2"),
+                UrlMatch(text.rindex("www"), len(text) - 1, "www.example.org", None),
+            ],
+        )
+
+    def test_lazy(self):
+        urls = iter_urls("http://www.example.com " * 100000)
+        self.assertEqual(next(urls).raw, "http://www.example.com")
+        self.assertEqual(next(urls).start, 23)
+
+
+class TestMayContainAnchor(unittest.TestCase):
+    def tearDown(self):
+        try:
+            unregister_decoder("test")
+        except KeyError:
+            pass
+
+    @parameterized.expand(
+        [
+            [host, prefix]
+            for host in ["urldefense.com", "urldefense.proofpoint.com", "urldefense.us"]
+            for prefix in ["", "a", "ab", "a" * 56, "a" * 57, "a" * 58]
+        ]
+    )
+    def test_base64(self, host, prefix):
+        # every alignment, with the anchor split across lines
+        text = f"{prefix} <a href=https://{host}/v3/__x>\n".encode("ascii")
+        body = base64.encodebytes(text).decode("ascii")
+        self.assertTrue(may_contain_anchor(body, "base64"))
+        self.assertTrue(may_contain_anchor(body.replace("\n", "\r\n"), "base64"))
+
+    @parameterized.expand([[n] for n in range(60, 80)])
+    def test_quoted_printable(self, n):
+        text = ("=" * n + "https://urldefense.com/v3/__x").encode("ascii")
+        body = quopri.encodestring(text).decode("ascii")
+        self.assertIn("=\n", body)
+        self.assertTrue(may_contain_anchor(body, "quoted-printable"))
+
+    def test_quoted_printable_dot(self):
+        body = "see https://urldefense=\n=2Ecom/v3/__x"
+        self.assertTrue(may_contain_anchor(body, "quoted-printable"))
+
+    @parameterized.expand([["base64"], ["quoted-printable"], ["7bit"], [None]])
+    def test_no_anchor(self, encoding):
+        text = b"see https://www.example.com/ and https://urldefense\n" * 10
+        body = text.decode("ascii")
+        if encoding == "base64":
+            body = base64.encodebytes(text).decode("ascii")
+        elif encoding == "quoted-printable":
+            body = quopri.encodestring(text).decode("ascii")
+        self.assertFalse(may_contain_anchor(body, encoding))
+
+    def test_register(self):
+        text = b"see https://gateway.example.net/r/?url=x"
+        body = base64.encodebytes(text).decode("ascii")
+        self.assertFalse(may_contain_anchor(body, "base64"))
+
+        register_decoder("test", ["gateway.example.net"], "/r/", lambda u, q: u)
+        self.assertTrue(may_contain_anchor(body, "base64"))
+
+        unregister_decoder("test")
+        self.assertFalse(may_contain_anchor(body, "base64"))
+
+
+class TestUrlDecoder(unittest.TestCase):
+    URL = "https://gateway.example.net/r/?url=http%3A%2F%2Fwww.example.com"
+
+    def tearDown(self):
+        try:
+            unregister_decoder("test")
+        except KeyError:
+            pass
+        set_unwrap_depth(DEFAULT_UNWRAP_DEPTH)
+
+    def test_decoders(self):
+        decoder = UrlDecoder([decoders["ppv2"]])
+        v2 = "https://urldefense.proofpoint.com/v2/url?u=http-3A__www.example.com&d=x"
+        v3 = "https://urldefense.com/v3/__http://www.example.com__;!!foo!bar$"
+        self.assertEqual(decoder.decode(v2), "http://www.example.com")
+        self.assertEqual(decoder.decode(v3), v3)
+        self.assertIsNone(decoder.find_decoder(v3))
+
+    def test_unwrap_depth(self):
+        with self.assertRaises(ValueError):
+            UrlDecoder(unwrap_depth=0)
+
+        url = mangle_v3(mangle_v3("https://www.example.com/"))
+        self.assertEqual(UrlDecoder(unwrap_depth=1).unwrap(url)[1], 1)
+        self.assertEqual(UrlDecoder().unwrap(url)[1], 2)
+
+    def test_snapshot(self):
+        # a decoder keeps the registry as it was when it was made
+        before = UrlDecoder()
+        register_decoder(
+            "test",
+            ["gateway.example.net"],
+            "/r/",
+            lambda mangled_url, unquote_url: "http://www.example.com",
+        )
+        after = UrlDecoder()
+        self.assertEqual(before.decode(self.URL), self.URL)
+        self.assertEqual(after.decode(self.URL), "http://www.example.com")
+
+        unregister_decoder("test")
+        self.assertEqual(after.decode(self.URL), "http://www.example.com")
+        self.assertEqual(decode(self.URL), self.URL)
+
+    def test_threads(self):
+        # threads decoding while another one keeps changing the registry and
+        # the unwrap depth (in ways that don't affect these URLs) always get
+        # the same results
+        urls = [mangle_v3(f"https://www.example.com/{i}") for i in range(50)]
+        urls += [
+            mangle_v2(mangle_v3(f"https://www.example.com/{i}")) for i in range(50)
+        ]
+        expected = [f"https://www.example.com/{i % 50}" for i in range(100)]
+        shared = UrlDecoder()
+        done = threading.Event()
+        errors = []
+
+        def churn():
+            while not done.is_set():
+                register_decoder("test", ["gateway.example.net"], "/r/", lambda u, q: u)
+                set_unwrap_depth(3)
+                unregister_decoder("test")
+                set_unwrap_depth(DEFAULT_UNWRAP_DEPTH)
+
+        def work():
+            try:
+                for _ in range(20):
+                    self.assertEqual([decode(u) for u in urls], expected)
+                    self.assertEqual([shared.decode(u) for u in urls], expected)
+                    for u in urls:
+                        self.assertIsNotNone(anchor_regex().search(u))
+            except Exception as err:
+                errors.append(err)
+
+        churner = threading.Thread(target=churn)
+        churner.start()
+        workers = [threading.Thread(target=work) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        done.set()
+        churner.join()
+
+        self.assertEqual(errors, [])
+
+
 if __name__ == "__main__":
     unittest.main()
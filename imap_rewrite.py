@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# imap_rewrite.py - decode mangled URLs in the messages of folders on an IMAP
+# server
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#
+#   ./imap_rewrite.py --host imap.example.com --user alice \
+#       --progress ~/.imap_rewrite.json INBOX Archive
+#
+# the password is read from $IMAP_PASSWORD, --password-file, or the terminal.
+#
+
+import argparse
+import collections
+import getpass
+import imaplib
+import json
+import os
+import re
+import socket
+import sys
+
+from decode import _decoder
+from decode_email import Limits, fsync_dir, rewrite_raw_message
+
+#
+# IMAP messages can't be changed, only replaced: for each folder,
+# rewrite_folder()
+#
+#  1. searches for the messages that mention a registered host (`BODY
+#     urldefense.com`, ...; servers search the decoded text of base64 and
+#     quoted-printable parts too), skipping ones marked \Deleted and, when
+#     resuming, the ones up to the last UID done (see below).
+#  2. fetches them `batch_size` at a time, with one UID FETCH of a UID set
+#     (`3:7,9,12:20`) for their flags, internal date and contents, rather
+#     than a command (and a round trip) per message. the contents are
+#     fetched with BODY.PEEK[], so \Seen isn't set.
+#  3. rewrites them with decode_email.rewrite_raw_message().
+#  4. APPENDs the changed ones to the folder, with the flags (but \Recent,
+#     which only the server sets) and internal date of the originals. the
+#     APPENDs are pipelined: each is sent without waiting for the server to
+#     store the one before (imaplib waits for each command to complete, so
+#     this uses its _command() and _command_complete() directly), and
+#     their results are collected at the end.
+#  5. marks the originals whose copies were stored \Deleted, and expunges
+#     them with UID EXPUNGE (RFC 4315, UIDPLUS), which leaves any other
+#     message marked \Deleted alone. on servers without UIDPLUS, they're
+#     expunged with EXPUNGE only if no other message is marked \Deleted;
+#     otherwise they're left marked for the user's mail client to expunge.
+#  6. records the last UID of the batch in the progress file, and once the
+#     folder is done, the last UID it had when it was selected.
+#
+# one connection is used for every folder (SELECTed in turn).
+#
+# a message is never lost: its original is only deleted once the server has
+# stored its copy. if it's killed between the two, the next run leaves a
+# duplicate (the original is rewritten and appended again).
+#
+# progress is a JSON file with, for each folder, the UIDVALIDITY of the
+# folder and the last UID done. a run with the same progress file picks up
+# after that UID, unless the UIDVALIDITY changed (the server renumbered the
+# folder), in which case the folder is searched from the start again.
+# (copies appended by earlier runs have higher UIDs, so they're searched
+# again, but are left as they are.)
+#
+# mailbox names are given as the server lists them (i.e., non-ASCII names in
+# modified UTF-7).
+#
+
+
+def _quote(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _uid_set(uids):
+    # a sorted list of UIDs as an IMAP sequence set, e.g. "3:7,9,12:20"
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def _search_key(hosts):
+    # OR BODY a OR BODY b BODY c (imaplib doesn't quote arguments for us)
+    terms = [f"BODY {_quote(host)}" for host in sorted(hosts)]
+    key = terms[-1]
+    for term in reversed(terms[:-1]):
+        key = f"OR {term} {key}"
+    return key
+
+
+_UID_REGEX = re.compile(rb"\bUID (\d+)")
+_FLAGS_REGEX = re.compile(rb"\bFLAGS \(([^)]*)\)")
+_INTERNALDATE_REGEX = re.compile(rb'\bINTERNALDATE ("[^"]*")')
+
+FetchedMessage = collections.namedtuple(
+    "FetchedMessage", ["uid", "flags", "internal_date", "raw"]
+)
+
+
+def _parse_fetch(data):
+    # imaplib returns a FETCH response with a literal as a tuple of the text
+    # up to the literal and the literal, followed by the rest of the text
+    # (which may have more items, e.g., FLAGS after BODY[] for some servers)
+    messages = []
+    meta = raw = None
+    for item in data + [None]:
+        if isinstance(item, tuple) or item is None:
+            if raw is not None:
+                uid = _UID_REGEX.search(meta)
+                flags = _FLAGS_REGEX.search(meta)
+                date = _INTERNALDATE_REGEX.search(meta)
+                messages.append(
+                    FetchedMessage(
+                        int(uid.group(1)),
+                        flags.group(1).decode("ascii").split() if flags else [],
+                        date.group(1).decode("ascii") if date else None,
+                        raw,
+                    )
+                )
+            if item is not None:
+                meta, raw = item
+        elif raw is not None:
+            meta += item
+    return messages
+
+
+def _check(typ, data, command):
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"{command} failed: {data}")
+    return data
+
+
+def load_progress(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_progress(path, progress):
+    """Replaces the progress file at `path` atomically and durably."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(progress, f, sort_keys=True)
+        f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def _rewrite(folder, message, limits, counts):
+    # the message, rewritten (with LF line endings), or None to leave it as it
+    # is
+    raw = message.raw.replace(b"\r\n", b"\n")
+    return rewrite_raw_message(raw, f"{folder}: UID {message.uid}", limits, counts)
+
+
+def _append_all(imap, folder, messages):
+    # APPENDs (message, output) pairs to `folder`, pipelined. returns the
+    # messages whose copies were stored
+    tags = []
+    for message, output in messages:
+        flags = [flag for flag in message.flags if flag.lower() != "\\recent"]
+        # (imaplib.IMAP4.append(), without waiting for the result)
+        imap.literal = imaplib.MapCRLF.sub(imaplib.CRLF, output)
+        tag = imap._command(
+            "APPEND",
+            _quote(folder),
+            f"({' '.join(flags)})",
+            message.internal_date,
+        )
+        tags.append((message, tag))
+
+    stored = []
+    for message, tag in tags:
+        typ, data = imap._command_complete("APPEND", tag)
+        if typ == "OK":
+            stored.append(message)
+        else:
+            print(f"{folder}: UID {message.uid}: APPEND: {data}", file=sys.stderr)
+    return stored
+
+
+def _expunge(imap, uids, capabilities):
+    # expunges the messages with `uids`, and no others. returns whether they
+    # were expunged
+    uid_set = _uid_set(uids)
+    _check(*imap.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)"), "STORE")
+    if "UIDPLUS" in capabilities:
+        _check(*imap.uid("EXPUNGE", uid_set), "UID EXPUNGE")
+        return True
+
+    deleted = _check(*imap.uid("SEARCH", "DELETED"), "SEARCH")[0].split()
+    if set(map(int, deleted)) <= set(uids):
+        _check(*imap.expunge(), "EXPUNGE")
+        return True
+    return False
+
+
+def rewrite_folder(
+    imap, folder, progress=None, progress_path=None, batch_size=100, limits=Limits()
+):
+    """Decodes mangled URLs in the messages of `folder`, on the IMAP server
+    that `imap` (an authenticated imaplib.IMAP4) is connected to, replacing
+    the messages that changed.
+
+    `progress` (see load_progress()) is updated after each batch, and saved
+    to `progress_path` if given. Returns a Counter of messages fetched,
+    rewritten, and left unchanged because a limit was exceeded or they
+    couldn't be processed, and of rewritten messages left marked \\Deleted
+    rather than expunged."""
+    counts = collections.Counter()
+    if progress is None:
+        progress = {}
+
+    # (imaplib keeps the capabilities from before logging in, which may be
+    # fewer)
+    capabilities = _check(*imap.capability(), "CAPABILITY")[0].upper().split()
+    capabilities = [c.decode("ascii") for c in capabilities]
+
+    # imaplib sends an APPEND's literal and the CRLF after it separately:
+    # with Nagle's algorithm, the CRLF waits for the server to acknowledge
+    # the literal, which it may delay (by 40 ms on Linux) for every APPEND
+    if imap.sock.family in (socket.AF_INET, socket.AF_INET6):
+        imap.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    _check(*imap.select(_quote(folder)), "SELECT")
+    uidvalidity = int(imap.response("UIDVALIDITY")[1][0])
+    uidnext = imap.response("UIDNEXT")[1][0]
+
+    done = progress.get(folder)
+    if done is not None and done["uidvalidity"] != uidvalidity:
+        done = None
+    criteria = ["UNDELETED", _search_key(_decoder().decoders_by_host)]
+    if done is not None:
+        criteria.insert(0, f"UID {done['uid'] + 1}:*")
+    uids = _check(*imap.uid("SEARCH", *criteria), "SEARCH")[0].split()
+    # ("UID n:*" always matches the last message, even if it's below n)
+    start = 0 if done is None else done["uid"] + 1
+    uids = sorted(uid for uid in map(int, uids) if uid >= start)
+
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i : i + batch_size]
+        # (as a set, to look up UIDs in)
+        in_batch = set(batch)
+        data = _check(
+            *imap.uid("FETCH", _uid_set(batch), "(UID FLAGS INTERNALDATE BODY.PEEK[])"),
+            "FETCH",
+        )
+
+        changed = []
+        for message in _parse_fetch(data):
+            if message.uid not in in_batch:
+                # (a response the server sent unasked)
+                continue
+            counts["messages"] += 1
+            output = _rewrite(folder, message, limits, counts)
+            if output is not None:
+                changed.append((message, output))
+
+        stored = _append_all(imap, folder, changed)
+        counts["errors"] += len(changed) - len(stored)
+        counts["rewritten"] += len(stored)
+        stored_uids = sorted(m.uid for m in stored)
+        if stored and not _expunge(imap, stored_uids, capabilities):
+            counts["not_expunged"] += len(stored)
+
+        progress[folder] = {"uidvalidity": uidvalidity, "uid": batch[-1]}
+        if progress_path is not None:
+            save_progress(progress_path, progress)
+
+    # every message there was when the folder was selected has been searched
+    if uidnext is not None:
+        last = max(int(uidnext) - 1, uids[-1] if uids else 0, start - 1)
+        progress[folder] = {"uidvalidity": uidvalidity, "uid": last}
+        if progress_path is not None:
+            save_progress(progress_path, progress)
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="decode proofpoint-mangled URLs in the messages of folders on an IMAP server"
+    )
+    parser.add_argument("--host", help="IMAP server", required=True)
+    parser.add_argument(
+        "--port",
+        help="port (default: 993 with --security ssl, 143 otherwise)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--security",
+        help="connect with TLS, STARTTLS or neither (default: %(default)s)",
+        choices=["ssl", "starttls", "none"],
+        default="ssl",
+    )
+    parser.add_argument("--user", help="user name", required=True)
+    parser.add_argument(
+        "--password-file",
+        help="read the password from this file (default: $IMAP_PASSWORD, or ask)",
+        default=None,
+    )
+    parser.add_argument(
+        "--progress",
+        help="record progress in this file, and resume from it",
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="number of messages to fetch (and append) at a time",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="leave a message unchanged if it takes more than this many seconds",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "folder",
+        nargs="*",
+        default=["INBOX"],
+        help="folder to rewrite (default: INBOX)",
+    )
+    args = parser.parse_args()
+
+    if args.password_file is not None:
+        with open(args.password_file) as f:
+            password = f.read().rstrip("\n")
+    elif "IMAP_PASSWORD" in os.environ:
+        password = os.environ["IMAP_PASSWORD"]
+    else:
+        password = getpass.getpass(f"password for {args.user}@{args.host}: ")
+
+    try:
+        if args.security == "ssl":
+            imap = imaplib.IMAP4_SSL(args.host, args.port or 993)
+        else:
+            imap = imaplib.IMAP4(args.host, args.port or 143)
+            if args.security == "starttls":
+                imap.starttls()
+        imap.login(args.user, password)
+    except (OSError, imaplib.IMAP4.error) as err:
+        parser.exit(1, f"imap_rewrite.py: {args.host}: {err}\n")
+
+    status = 0
+    try:
+        progress = {} if args.progress is None else load_progress(args.progress)
+        for folder in args.folder:
+            try:
+                counts = rewrite_folder(
+                    imap,
+                    folder,
+                    progress,
+                    args.progress,
+                    args.batch_size,
+                    Limits(seconds=args.timeout),
+                )
+            except imaplib.IMAP4.error as err:
+                print(f"{folder}: {err}", file=sys.stderr)
+                status = 1
+                continue
+            print(
+                f"{folder}: {counts['rewritten']} of {counts['messages']} messages rewritten",
+                file=sys.stderr,
+            )
+            if counts["not_expunged"]:
+                print(
+                    f"{folder}: {counts['not_expunged']} originals marked \\Deleted, not expunged",
+                    file=sys.stderr,
+                )
+    finally:
+        imap.logout()
+    sys.exit(status)
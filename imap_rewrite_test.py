@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import base64
+import email
+import heapq
+import imaplib
+import json
+import os
+import re
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from parameterized import parameterized
+
+from imap_rewrite import _search_key, _uid_set, load_progress, rewrite_folder
+
+V3_URL = "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+CLEAN_URL = "https://example.com/#newsletter"
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "imap_rewrite.py")
+
+#
+# a stand-in IMAP server, with just enough of RFC 3501 (and UIDPLUS) for
+# imap_rewrite.py: LOGIN, SELECT, APPEND, EXPUNGE, and UID SEARCH, FETCH,
+# STORE and EXPUNGE, with the search keys and fetch items it uses. every
+# response is sent `latency` seconds after the command it answers was read,
+# as if over a slow network (so that commands sent without waiting for the
+# one before overlap).
+#
+
+
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []  # [uid, flags, internal date, raw], by UID
+
+    def add(self, raw, flags=(), internal_date='"01-Jan-2024 00:00:00 +0000"'):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.messages.append([uid, set(flags), internal_date, raw])
+        return uid
+
+    def by_uid(self):
+        return {m[0]: m for m in self.messages}
+
+
+def _tokenize(parts):
+    # the text parts and literals of a command as (nested) lists of tokens
+    stack = [[]]
+    for part in parts:
+        if isinstance(part, bytes) and not isinstance(part, Literal):
+            for m in re.finditer(rb'"((?:[^"\\]|\\.)*)"|\(|\)|[^\s()]+', part):
+                if m.group(0) == b"(":
+                    stack.append([])
+                elif m.group(0) == b")":
+                    inner = stack.pop()
+                    stack[-1].append(inner)
+                elif m.group(1) is not None:
+                    stack[-1].append(re.sub(rb"\\(.)", rb"\1", m.group(1)).decode())
+                else:
+                    stack[-1].append(m.group(0).decode())
+        else:
+            stack[-1].append(bytes(part))
+    return stack[0]
+
+
+class Literal(bytes):
+    pass
+
+
+def _parse_set(text, last):
+    uids = set()
+    for item in text.split(","):
+        first, _, end = item.partition(":")
+        first = last if first == "*" else int(first)
+        end = first if end == "" else last if end == "*" else int(end)
+        uids.update(range(min(first, end), max(first, end) + 1))
+    return uids
+
+
+def _body_text(raw):
+    # the decoded text of every part, for BODY searches
+    text = b""
+    for part in email.message_from_bytes(raw).walk():
+        if not part.is_multipart():
+            text += part.get_payload(decode=True) or b""
+    return text.decode("latin-1").lower()
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+        self.mailbox = None
+        self.outbox = []
+        self.outbox_ready = threading.Condition()
+        self.held = []
+        self.release_timer = None
+        self.sender = threading.Thread(target=self._send_loop, daemon=True)
+        self.closed = False
+        self.sender.start()
+
+    def finish(self):
+        with self.outbox_ready:
+            self.closed = True
+            self.outbox_ready.notify()
+        self.sender.join()
+        super().finish()
+
+    def _send_loop(self):
+        while True:
+            with self.outbox_ready:
+                while not self.outbox and not self.closed:
+                    self.outbox_ready.wait()
+                if not self.outbox:
+                    return
+                send_at, _, data = heapq.heappop(self.outbox)
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def send(self, line, received):
+        # `line` (str or bytes) as if it left when `received` was read
+        if isinstance(line, str):
+            line = line.encode()
+        with self.outbox_ready:
+            send_at = received + self.server.latency
+            heapq.heappush(self.outbox, (send_at, self.server.sequence(), line))
+            self.outbox_ready.notify()
+
+    def hold(self, line):
+        # holds back an APPEND's tagged response until server.hold_appends
+        # of them are outstanding, so that they are only all outstanding at
+        # once if the client pipelines them (and releases them after a
+        # second, so that a client that waits for each one fails rather than
+        # hangs)
+        with self.outbox_ready:
+            self.held.append(line)
+            self.server.max_held_appends = max(
+                self.server.max_held_appends, len(self.held)
+            )
+            if len(self.held) >= self.server.hold_appends:
+                self.release()
+            elif self.release_timer is None:
+                self.release_timer = threading.Timer(1, self.release)
+                self.release_timer.daemon = True
+                self.release_timer.start()
+
+    def release(self):
+        with self.outbox_ready:
+            if self.release_timer is not None:
+                self.release_timer.cancel()
+                self.release_timer = None
+            held, self.held = self.held, []
+            for line in held:
+                self.send(line, time.monotonic())
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        received = time.monotonic()
+        if not line:
+            return None, received
+        parts = []
+        while True:
+            m = re.search(rb"\{(\d+)\}\r\n$", line)
+            if m is None:
+                parts.append(line.rstrip(b"\r\n"))
+                return parts, received
+            parts.append(line[: m.start()])
+            self.send(b"+ go ahead\r\n", received)
+            parts.append(Literal(self.rfile.read(int(m.group(1)))))
+            line = self.rfile.readline()
+            received = time.monotonic()
+
+    def handle(self):
+        self.send("* OK stand-in IMAP server ready\r\n", time.monotonic())
+        while True:
+            parts, received = self._read_command()
+            if parts is None:
+                return
+            tokens = _tokenize(parts)
+            tag, name, args = tokens[0], tokens[1].upper(), tokens[2:]
+            self.server.commands.append((name, args))
+            with self.server.lock:
+                try:
+                    status = getattr(self, f"do_{name}")(args, received)
+                except Exception as err:
+                    status = f"BAD {err}"
+            if name == "APPEND" and self.server.hold_appends:
+                self.hold(f"{tag} {status}\r\n")
+                continue
+            self.send(f"{tag} {status}\r\n", received)
+            if name == "LOGOUT":
+                return
+
+    def do_CAPABILITY(self, args, received):
+        capabilities = "IMAP4rev1" + (" UIDPLUS" if self.server.uidplus else "")
+        self.send(f"* CAPABILITY {capabilities}\r\n", received)
+        return "OK CAPABILITY completed"
+
+    def do_LOGIN(self, args, received):
+        return "OK LOGIN completed"
+
+    def do_LOGOUT(self, args, received):
+        self.send("* BYE logging out\r\n", received)
+        return "OK LOGOUT completed"
+
+    def do_NOOP(self, args, received):
+        return "OK NOOP completed"
+
+    def do_SELECT(self, args, received):
+        if args[0] not in self.server.mailboxes:
+            self.mailbox = None
+            return "NO no such mailbox"
+        self.mailbox = self.server.mailboxes[args[0]]
+        self.send(f"* {len(self.mailbox.messages)} EXISTS\r\n", received)
+        self.send(f"* OK [UIDVALIDITY {self.mailbox.uidvalidity}]\r\n", received)
+        self.send(f"* OK [UIDNEXT {self.mailbox.uidnext}]\r\n", received)
+        return "OK [READ-WRITE] SELECT completed"
+
+    def do_APPEND(self, args, received):
+        mailbox = self.server.mailboxes.get(args[0])
+        if mailbox is None:
+            return "NO [TRYCREATE] no such mailbox"
+        if self.server.reject_append:
+            return "NO [OVERQUOTA] quota exceeded"
+        flags = args[1] if isinstance(args[1], list) else []
+        date = args[2] if isinstance(args[2], str) else '"01-Jan-2000 00:00:00 +0000"'
+        if not date.startswith('"'):
+            date = f'"{date}"'
+        uid = mailbox.add(args[-1], flags, date)
+        return f"OK [APPENDUID {mailbox.uidvalidity} {uid}] APPEND completed"
+
+    def do_EXPUNGE(self, args, received, uids=None):
+        for seq in range(len(self.mailbox.messages), 0, -1):
+            uid, flags, _, _ = self.mailbox.messages[seq - 1]
+            if "\\Deleted" in flags and (uids is None or uid in uids):
+                del self.mailbox.messages[seq - 1]
+                self.send(f"* {seq} EXPUNGE\r\n", received)
+        return "OK EXPUNGE completed"
+
+    def do_UID(self, args, received):
+        command, args = args[0].upper(), args[1:]
+        last = self.mailbox.messages[-1][0] if self.mailbox.messages else 0
+
+        if command == "SEARCH":
+            uids = self._search(args, last)
+            self.send(f"* SEARCH {' '.join(map(str, sorted(uids)))}\r\n", received)
+            return "OK SEARCH completed"
+
+        uids = _parse_set(args[0], last)
+        if command == "FETCH":
+            if self.server.fail_fetch_after is not None:
+                if len(self.server.fetched) >= self.server.fail_fetch_after:
+                    return "NO fetch failed"
+            for seq, (uid, flags, date, raw) in enumerate(self.mailbox.messages, 1):
+                if uid not in uids:
+                    continue
+                self.server.fetched.append(uid)
+                self.send(
+                    f"* {seq} FETCH (UID {uid} FLAGS ({' '.join(sorted(flags))}) "
+                    f"INTERNALDATE {date} BODY[] {{{len(raw)}}}\r\n".encode()
+                    + raw
+                    + b")\r\n",
+                    received,
+                )
+            return "OK FETCH completed"
+
+        if command == "STORE":
+            for uid, flags, _, _ in self.mailbox.messages:
+                if uid in uids:
+                    flags.update(args[2])
+            return "OK STORE completed"
+
+        if command == "EXPUNGE" and self.server.uidplus:
+            return self.do_EXPUNGE([], received, uids)
+
+        return f"BAD unknown command UID {command}"
+
+    def _search(self, args, last):
+        def key(args):
+            name = args.pop(0).upper()
+            if name == "OR":
+                return key(args) | key(args)
+            if name == "BODY":
+                needle = args.pop(0).lower()
+                return {m[0] for m in messages if needle in _body_text(m[3])}
+            if name == "UID":
+                return _parse_set(args.pop(0), last) & set(by_uid)
+            if name == "DELETED":
+                return {m[0] for m in messages if "\\Deleted" in m[1]}
+            if name == "UNDELETED":
+                return {m[0] for m in messages if "\\Deleted" not in m[1]}
+            raise ValueError(f"unknown search key {name}")
+
+        messages = self.mailbox.messages
+        by_uid = self.mailbox.by_uid()
+        args = list(args)
+        uids = set(by_uid)
+        while args:
+            uids &= key(args)
+        return uids
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, uidplus=True, latency=0):
+        super().__init__(("127.0.0.1", 0), FakeImapHandler)
+        self.uidplus = uidplus
+        self.latency = latency
+        self.mailboxes = {"INBOX": Mailbox()}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.commands = []
+        self.fetched = []
+        self.reject_append = False
+        self.fail_fetch_after = None
+        # see FakeImapHandler.hold()
+        self.hold_appends = 0
+        self.max_held_appends = 0
+        self._sequence = 0
+
+    def sequence(self):
+        self._sequence += 1
+        return self._sequence
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def message(i, body, encoding=None):
+    headers = (
+        f"From: a@example.com\r\nSubject: message {i}\r\nMIME-Version: 1.0\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n"
+    )
+    if encoding == "base64":
+        headers += "Content-Transfer-Encoding: base64\r\n"
+        body = base64.encodebytes(body.encode()).decode().replace("\n", "\r\n")
+    return f"{headers}\r\n{body}\r\n".encode()
+
+
+class TestImapRewrite(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeImapServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.imap = imaplib.IMAP4("127.0.0.1", self.server.port)
+        self.imap.login("alice", "secret")
+        self.addCleanup(self.imap.logout)
+
+    def inbox(self):
+        return self.server.mailboxes["INBOX"]
+
+    def bodies(self, mailbox):
+        return sorted(
+            email.message_from_bytes(m[3]).get_payload(decode=True).decode().rstrip()
+            for m in mailbox.messages
+        )
+
+    def test_rewrite(self):
+        inbox = self.inbox()
+        inbox.add(message(1, f"see {V3_URL}"), ["\\Seen", "\\Flagged"])
+        inbox.add(message(2, "nothing to see here"))
+        inbox.add(message(3, f"see {V3_URL}", "base64"))
+        inbox.add(message(4, f"see {V3_URL}"), [], '"17-Jul-1996 02:44:25 -0700"')
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["messages"], 3)
+        self.assertEqual(counts["rewritten"], 3)
+
+        # the copies replace the originals, with their flags and dates
+        messages = {m[0]: m for m in inbox.messages}
+        self.assertEqual(sorted(messages), [2, 5, 6, 7])
+        self.assertEqual(messages[5][1], {"\\Seen", "\\Flagged"})
+        self.assertEqual(messages[7][2], '"17-Jul-1996 02:44:25 -0700"')
+        for uid in [5, 6, 7]:
+            raw = messages[uid][3]
+            self.assertIn(b"\r\n", raw)
+            self.assertNotIn(b"\n", raw.replace(b"\r\n", b""))
+            body = email.message_from_bytes(raw).get_payload(decode=True)
+            self.assertEqual(body.decode().rstrip(), f"see {CLEAN_URL}")
+
+        # running again finds nothing to change
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["rewritten"], 0)
+
+    def test_skipped(self):
+        inbox = self.inbox()
+        # already marked \Deleted
+        inbox.add(message(1, f"see {V3_URL}"), ["\\Deleted"])
+        # mentions the gateway, but has nothing to decode
+        inbox.add(message(2, "urldefense.com is a gateway"))
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["messages"], 1)
+        self.assertEqual(counts["rewritten"], 0)
+        self.assertEqual([m[0] for m in inbox.messages], [1, 2])
+        self.assertNotIn("APPEND", [name for name, _ in self.server.commands])
+
+    def test_malformed_url(self):
+        inbox = self.inbox()
+        inbox.add(message(1, "see https://urldefense.com/v2/url?x=1"))
+        inbox.add(message(2, f"see {V3_URL}"))
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual((counts["errors"], counts["rewritten"]), (1, 1))
+        self.assertEqual([m[0] for m in inbox.messages], [1, 3])
+
+    def test_batches(self):
+        for i in range(7):
+            self.inbox().add(message(i, f"see {V3_URL}" if i != 3 else "no URL"))
+
+        counts = rewrite_folder(self.imap, "INBOX", batch_size=3)
+        self.assertEqual(counts["rewritten"], 6)
+
+        fetches = [args for name, args in self.server.commands if name == "UID"]
+        fetches = [args[1] for args in fetches if args[0] == "FETCH"]
+        self.assertEqual(fetches, ["1:3", "5:7"])
+        self.assertEqual(
+            self.bodies(self.inbox()), ["no URL"] + 6 * [f"see {CLEAN_URL}"]
+        )
+
+    def test_folders(self):
+        self.server.mailboxes["Archive"] = Mailbox()
+        self.server.mailboxes["Old Mail"] = Mailbox()
+        for name in ["INBOX", "Archive", "Old Mail"]:
+            self.server.mailboxes[name].add(message(1, f"see {V3_URL}"))
+
+        for name in ["INBOX", "Archive", "Old Mail"]:
+            counts = rewrite_folder(self.imap, name)
+            self.assertEqual(counts["rewritten"], 1)
+            self.assertEqual(
+                self.bodies(self.server.mailboxes[name]), [f"see {CLEAN_URL}"]
+            )
+        self.assertEqual(self.server.connections, 1)
+
+    def test_resume(self):
+        inbox = self.inbox()
+        for i in range(4):
+            inbox.add(message(i, f"see {V3_URL}"))
+        self.server.fail_fetch_after = 2
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "progress.json")
+            with self.assertRaises(imaplib.IMAP4.error):
+                rewrite_folder(self.imap, "INBOX", {}, path, batch_size=2)
+            self.assertEqual(
+                load_progress(path), {"INBOX": {"uidvalidity": 1, "uid": 2}}
+            )
+
+            # picks up after the first batch
+            self.server.fail_fetch_after = None
+            self.server.fetched.clear()
+            rewrite_folder(self.imap, "INBOX", load_progress(path), path, batch_size=2)
+            self.assertEqual(self.server.fetched, [3, 4])
+            self.assertEqual(self.bodies(inbox), 4 * [f"see {CLEAN_URL}"])
+
+            # and then only looks at new messages (and the copies)
+            inbox.add(message(9, f"see {V3_URL}"))
+            self.server.fetched.clear()
+            rewrite_folder(self.imap, "INBOX", load_progress(path), path)
+            self.assertEqual(self.server.fetched, [9])
+
+            # unless the server renumbered the folder
+            inbox.uidvalidity = 2
+            self.server.fetched.clear()
+            counts = rewrite_folder(self.imap, "INBOX", load_progress(path), path)
+            self.assertEqual(counts["rewritten"], 0)
+            self.assertEqual(load_progress(path)["INBOX"]["uidvalidity"], 2)
+
+    def test_append_rejected(self):
+        self.inbox().add(message(1, f"see {V3_URL}"))
+        self.server.reject_append = True
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["rewritten"], 0)
+        self.assertEqual(counts["errors"], 1)
+        # the original is kept
+        self.assertEqual([m[0] for m in self.inbox().messages], [1])
+        self.assertEqual(self.inbox().messages[0][1], set())
+
+    @parameterized.expand([["alone", False], ["with others deleted", True]])
+    def test_no_uidplus(self, _, others_deleted):
+        self.server.uidplus = False
+        inbox = self.inbox()
+        inbox.add(message(1, "deleted by the user"), ["\\Deleted"] * others_deleted)
+        inbox.add(message(2, f"see {V3_URL}"))
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["rewritten"], 1)
+        if others_deleted:
+            # the user's \Deleted message isn't expunged, so neither is ours
+            self.assertEqual(counts["not_expunged"], 1)
+            self.assertEqual([m[0] for m in inbox.messages], [1, 2, 3])
+            self.assertIn("\\Deleted", inbox.messages[1][1])
+        else:
+            self.assertEqual([m[0] for m in inbox.messages], [1, 3])
+
+    def test_pipelined(self):
+        # the APPENDs of a batch don't each wait for the one before: all 10
+        # are outstanding before the server answers any of them
+        self.server.hold_appends = 10
+        for i in range(10):
+            self.inbox().add(message(i, f"see {V3_URL}"))
+
+        counts = rewrite_folder(self.imap, "INBOX")
+        self.assertEqual(counts["rewritten"], 10)
+        self.assertEqual(self.server.max_held_appends, 10)
+        self.assertEqual(len(self.inbox().messages), 10)
+
+
+class TestHelpers(unittest.TestCase):
+    @parameterized.expand(
+        [
+            [[1], "1"],
+            [[1, 2, 3], "1:3"],
+            [[1, 3, 4, 5, 9, 10], "1,3:5,9:10"],
+        ]
+    )
+    def test_uid_set(self, uids, expected):
+        self.assertEqual(_uid_set(uids), expected)
+
+    def test_search_key(self):
+        self.assertEqual(_search_key(["b.com"]), 'BODY "b.com"')
+        self.assertEqual(
+            _search_key(["c.com", "a.com", "b.com"]),
+            'OR BODY "a.com" OR BODY "b.com" BODY "c.com"',
+        )
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_folders(self):
+        with FakeImapServer() as server, tempfile.TemporaryDirectory() as tmp:
+            server.mailboxes["Archive"] = Mailbox()
+            for name in ["INBOX", "Archive"]:
+                server.mailboxes[name].add(message(1, f"see {V3_URL}"))
+
+            progress = os.path.join(tmp, "progress.json")
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    SCRIPT,
+                    "--host",
+                    "127.0.0.1",
+                    "--port",
+                    str(server.port),
+                    "--security",
+                    "none",
+                    "--user",
+                    "alice",
+                    "--progress",
+                    progress,
+                    "INBOX",
+                    "Archive",
+                    "Missing",
+                ],
+                env=dict(os.environ, IMAP_PASSWORD="secret"),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(result.returncode, 1)
+            self.assertIn("INBOX: 1 of 1 messages rewritten", result.stderr)
+            self.assertIn("Archive: 1 of 1 messages rewritten", result.stderr)
+            self.assertIn("Missing: SELECT failed", result.stderr)
+            self.assertEqual(server.connections, 1)
+            with open(progress) as f:
+                self.assertEqual(sorted(json.load(f)), ["Archive", "INBOX"])
+
+
+if __name__ == "__main__":
+    unittest.main()
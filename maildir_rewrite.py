@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# maildir_rewrite.py - decode mangled URLs in the messages of existing
+# Maildirs, in place
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: ./maildir_rewrite.py ~/Mail/inbox ~/Mail/archive
+#
+
+import argparse
+import collections
+import fcntl
+import os
+import re
+import socket
+import sys
+import time
+
+from decode_email import Limits, fsync_dir, rewrite_raw_message
+
+#
+# rewriting a message safely takes an fsync of the new file, an atomic
+# rename over the old one, and an fsync of the directory. one at a time,
+# that's three synchronous round trips per message. instead, BatchWriter
+# stages up to `batch_size` rewritten messages in tmp/, then:
+#
+#   1. fsyncs all of the staged files,
+#   2. renames each of them over the message it replaces, and
+#   3. fsyncs cur/ and new/ once.
+#
+# crash consistency (e.g., kill -9 or power loss at any point):
+#
+#  - every message is always either its complete original or its complete
+#    rewritten version, never a mix or a truncated file: the new version is
+#    durable before the rename, and rename is atomic.
+#  - once commit() returns, the whole batch is durable.
+#  - if the size in the file name (",S=" or ",W=", used by e.g. dovecot)
+#    changes, the new version is renamed to the new name before the old name
+#    is unlinked, so a crash in between leaves a duplicate, never a lost
+#    message.
+#  - staged files left in tmp/ by a crash are removed on the next run.
+#  - running again after a crash finishes the job: messages that are already
+#    rewritten come out unchanged, and are skipped.
+#
+# messages that change while they're staged (e.g., a mail client sets a flag,
+# renaming the file) are left alone, and picked up on the next run.
+#
+# a BatchWriter normally has the Maildir to itself. several `shared` ones
+# (e.g., spool_queue.py workers, each rewriting some of the messages) can
+# write to the same Maildir at once: they don't remove each other's staged
+# files, only ones older than STALE_STAGED seconds (the Maildir convention
+# for tmp/), and a writer that isn't shared waits for them all to finish.
+#
+
+# marks the files we stage in tmp/, so that stale ones can be removed
+STAGED = ".decode_email."
+
+# 36 hours
+STALE_STAGED = 36 * 60 * 60
+
+_SIZE_REGEX = re.compile(r",([SW])=\d+")
+
+
+def unique_name(name):
+    """Returns the part of the Maildir file name `name` that identifies the
+    message: without its info (":2,<flags>"), which changes when it's moved
+    from new/ to cur/ or its flags change, or its sizes, which change when
+    it's rewritten."""
+    return _SIZE_REGEX.sub("", name.partition(":")[0])
+
+
+def _new_name(name, data):
+    # update the sizes in a Maildir file name, if any
+    def size(m):
+        if m.group(1) == "S":
+            return f",S={len(data)}"
+        # W= is the size with CRLF line endings
+        crlf_size = len(data) + data.count(b"\n") - data.count(b"\r\n")
+        return f",W={crlf_size}"
+
+    return _SIZE_REGEX.sub(size, name)
+
+
+class BatchWriter:
+    def __init__(self, maildir, batch_size=256, shared=False):
+        self.maildir = maildir
+        self.batch_size = batch_size
+        self.staged = []  # (tmp path, path replaced, its inode, new path)
+        self.count = 0
+
+        # one writer per Maildir (or any number of shared ones): if we're
+        # the only one, anything staged in tmp/ is ours
+        self.lock = open(os.path.join(maildir, "tmp", STAGED + "lock"), "a+")
+        fcntl.flock(self.lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        tmp = os.path.join(maildir, "tmp")
+        now = time.time()
+        for name in os.listdir(tmp):
+            if STAGED in name and not name.endswith(STAGED + "lock"):
+                path = os.path.join(tmp, name)
+                try:
+                    if not shared or now - os.stat(path).st_mtime > STALE_STAGED:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    # removed by another shared writer
+                    pass
+
+    def replace(self, path, inode, data):
+        """Stages `data` to replace the message at `path` (whose inode was
+        `inode` when read). Commits the batch once it's full."""
+        self.count += 1
+        # (unique across hosts and processes, as the Maildir spec asks)
+        tmp = os.path.join(
+            self.maildir,
+            "tmp",
+            f"{int(time.time())}.{os.getpid()}_{self.count}{STAGED}{socket.gethostname()}",
+        )
+        with open(tmp, "wb") as f:
+            f.write(data)
+
+        directory, name = os.path.split(path)
+        new_path = os.path.join(directory, _new_name(name, data))
+        self.staged.append((tmp, path, inode, new_path))
+
+        if len(self.staged) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if not self.staged:
+            return
+
+        # 1. make the new versions durable, all before any rename
+        for tmp, _, _, _ in self.staged:
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        # 2. replace the messages that haven't changed since we read them
+        directories = set()
+        for tmp, path, inode, new_path in self.staged:
+            try:
+                current = os.stat(path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != inode:
+                os.unlink(tmp)
+                continue
+
+            os.rename(tmp, new_path)
+            if new_path != path:
+                os.unlink(path)
+            directories.add(os.path.dirname(path))
+
+        # 3. make the renames durable
+        for directory in directories:
+            fsync_dir(directory)
+        fsync_dir(os.path.join(self.maildir, "tmp"))
+
+        self.staged = []
+
+    def close(self):
+        self.commit()
+        self.lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def rewrite_message(writer, path, limits=Limits(), counts=None):
+    """Decodes mangled URLs in the message at `path`, staging the result in
+    `writer` (a BatchWriter for its Maildir) if a mangled URL was decoded.
+    Adds the message to `counts` (see rewrite_maildir()), if given."""
+    if counts is None:
+        counts = collections.Counter()
+    try:
+        with open(path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            raw = f.read()
+    except FileNotFoundError:
+        # moved by a mail client since we listed the directory
+        return
+
+    counts["messages"] += 1
+    output = rewrite_raw_message(raw, path, limits, counts)
+    if output is None:
+        return
+
+    writer.replace(path, inode, output)
+    counts["rewritten"] += 1
+
+
+def rewrite_maildir(maildir, batch_size=256, limits=Limits()):
+    """Decodes mangled URLs in every message in the Maildir at `maildir`, in
+    place. Returns a Counter of messages seen, rewritten, and left unchanged
+    because a limit was exceeded or they couldn't be processed."""
+    counts = collections.Counter()
+    with BatchWriter(maildir, batch_size) as writer:
+        for subdir in ["new", "cur"]:
+            directory = os.path.join(maildir, subdir)
+            for name in sorted(os.listdir(directory)):
+                rewrite_message(writer, os.path.join(directory, name), limits, counts)
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="decode proofpoint-mangled URLs in the messages of Maildirs, in place"
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="number of rewritten messages to commit (and fsync) at a time",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--timeout",
+        help="leave a message unchanged if it takes more than this many seconds",
+        type=float,
+        default=None,
+    )
+    parser.add_argument("maildir", nargs="+", help="Maildir to rewrite")
+    args = parser.parse_args()
+
+    for maildir in args.maildir:
+        counts = rewrite_maildir(maildir, args.batch_size, Limits(seconds=args.timeout))
+        print(
+            f"{maildir}: {counts['rewritten']} of {counts['messages']} messages rewritten",
+            file=sys.stderr,
+        )
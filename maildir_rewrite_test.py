@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import mailbox
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from decode_email import process_message
+from maildir_rewrite import STAGED, STALE_STAGED, BatchWriter, rewrite_maildir
+
+V3_URL = "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maildir_rewrite.py")
+
+
+def message(i):
+    return (
+        f"From: a@example.com\nSubject: message {i}\nMIME-Version: 1.0\n"
+        f"Content-Type: text/plain; charset=utf-8\n\nsee {V3_URL}\n"
+    ).encode("utf-8")
+
+
+class TestMaildirRewrite(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "Maildir")
+        self.maildir = mailbox.Maildir(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def files(self):
+        # name -> contents, for every message
+        files = {}
+        for subdir in ["new", "cur"]:
+            directory = os.path.join(self.path, subdir)
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), "rb") as f:
+                    files[name] = f.read()
+        return files
+
+    def staged(self):
+        return [
+            name
+            for name in os.listdir(os.path.join(self.path, "tmp"))
+            if STAGED in name and not name.endswith("lock")
+        ]
+
+    def test_rewrite(self):
+        for i in range(10):
+            self.maildir.add(message(i))
+        self.maildir.add(b"Subject: plain\n\nno URLs here\n")
+        before = self.files()
+
+        counts = rewrite_maildir(self.path, batch_size=3)
+        self.assertEqual(counts["messages"], 11)
+        self.assertEqual(counts["rewritten"], 10)
+
+        after = self.files()
+        self.assertEqual(set(after), set(before))
+        for name, data in after.items():
+            self.assertNotIn(b"urldefense", data)
+            self.assertEqual(data.decode(), process_message(before[name].decode()))
+        self.assertEqual(self.staged(), [])
+
+        # already rewritten
+        self.assertEqual(rewrite_maildir(self.path)["rewritten"], 0)
+
+    def test_nothing_decoded(self):
+        # the email package would refold the header, turn CRLF into LF and
+        # re-encode the 8bit part: none of that is worth breaking DKIM for
+        long_header = "Subject: " + " ".join(["word"] * 40)
+        messages = [
+            f"{long_header}\r\nMIME-Version: 1.0\r\n\r\nno URLs here\r\n",
+            "Subject: 8bit\nMIME-Version: 1.0\n"
+            "Content-Type: text/plain; charset=utf-8\n"
+            "Content-Transfer-Encoding: 8bit\n\n"
+            f"caf\u00e9 {'x' * 1000} https://urldefense.com/\n",
+        ]
+        for m in messages:
+            self.maildir.add(m.encode("utf-8"))
+        before = self.files()
+
+        counts = rewrite_maildir(self.path)
+        self.assertEqual((counts["messages"], counts["rewritten"]), (2, 0))
+        self.assertEqual(self.files(), before)
+
+    def test_size_in_name(self):
+        key = self.maildir.add(message(0))
+        old = os.path.join(self.path, "new", key)
+        new = os.path.join(self.path, "new", f"{key},S=1,W=2")
+        os.rename(old, new)
+
+        rewrite_maildir(self.path)
+        (name,) = self.files()
+        data = self.files()[name]
+        crlf_size = len(data) + data.count(b"\n")
+        self.assertEqual(name, f"{key},S={len(data)},W={crlf_size}")
+
+    def test_changed_while_staged(self):
+        key = self.maildir.add(message(0))
+        path = os.path.join(self.path, "new", key)
+
+        with BatchWriter(self.path) as writer:
+            writer.replace(path, os.stat(path).st_ino, b"rewritten")
+            # a mail client moves the message (e.g., marks it as seen)
+            os.rename(path, os.path.join(self.path, "cur", key + ":2,S"))
+
+        self.assertEqual(self.files(), {key + ":2,S": message(0)})
+        self.assertEqual(self.staged(), [])
+
+    def test_stale_staged_files(self):
+        stale = os.path.join(self.path, "tmp", f"1.2_3{STAGED}host")
+        with open(stale, "wb") as f:
+            f.write(b"partial")
+        rewrite_maildir(self.path)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_shared_writers(self):
+        stale = os.path.join(self.path, "tmp", f"1.2_3{STAGED}host")
+        staged = os.path.join(self.path, "tmp", f"4.5_6{STAGED}host")
+        for path in [stale, staged]:
+            with open(path, "wb") as f:
+                f.write(b"partial")
+        t = time.time() - STALE_STAGED - 1
+        os.utime(stale, (t, t))
+
+        # another writer's staged file is left alone, and both can write
+        with BatchWriter(self.path, shared=True):
+            with BatchWriter(self.path, shared=True):
+                pass
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(staged))
+
+    def test_kill(self):
+        # kill -9 a rewrite at various points: every message must always be
+        # either its original or its rewritten version, and running again
+        # must finish the job
+        originals = {self.maildir.add(message(i)): message(i) for i in range(300)}
+        expected = {
+            k: process_message(v.decode()).encode() for k, v in originals.items()
+        }
+
+        for delay in [0.15, 0.2, 0.25, 0.3, 0.4, 0.6]:
+            p = subprocess.Popen(
+                [sys.executable, SCRIPT, "--batch-size", "7", self.path],
+                stderr=subprocess.DEVNULL,
+            )
+            time.sleep(delay)
+            p.send_signal(signal.SIGKILL)
+            p.wait()
+
+            files = self.files()
+            self.assertEqual(set(files), set(originals))
+            for key, data in files.items():
+                self.assertIn(data, [originals[key], expected[key]])
+
+        rewrite_maildir(self.path)
+        self.assertEqual(self.files(), expected)
+        self.assertEqual(self.staged(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
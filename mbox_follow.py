@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# mbox_follow.py - process only the messages appended to an mbox file since
+# the last run
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage (see get_urls.py and decode_email.py):
+#   ./get_urls.py --checkpoint spool.ckpt /var/spool/mail/alice >> urls.txt
+#   ./decode_email.py --checkpoint spool.ckpt --follow 5 -o clean.mbox /var/spool/mail/alice
+#
+
+import collections
+import fcntl
+import json
+import os
+import stat
+import time
+
+#
+# mbox spools are only ever appended to, so rather than reading the whole
+# file on every run, follow() reads from where the last run stopped. the
+# checkpoint file records:
+#
+#   inode, size  of the mbox when the checkpoint was taken
+#   offset       the end of the last message processed, which is always the
+#                start of a message ("From ...") or the end of the file
+#   output_inode, output_size
+#                of the output file (if it's a regular file) at that point
+#
+# on the next run:
+#
+#  - if the mbox has a new inode (it was rotated), or is smaller than it was
+#    (truncated), or `offset` no longer starts a message (rewritten in
+#    place, e.g., by a mail client), it's read from the start again.
+#    (messages appended to the old file after the last run aren't seen, so
+#    run once more before rotating, e.g., in logrotate's prerotate.)
+#  - otherwise, only messages from `offset` on are read, so a run costs
+#    O(new data).
+#  - anything written to the output after the checkpoint (by a run that
+#    crashed before its next checkpoint) is truncated away first, so the
+#    output has each message exactly once. outputs that can't be truncated
+#    (pipes, terminals, --stats files) may see the messages since the last
+#    checkpoint twice after a crash; never none.
+#
+# a message is only processed once it's complete: mail delivery agents lock
+# an mbox while they append to it, so we take a shared lock, note the size,
+# and release it again: everything up to that size is complete. while a
+# dotlock (`mbox.lock`) is held, the last message may still be growing, so
+# it's left for the next run.
+#
+Checkpoint = collections.namedtuple(
+    "Checkpoint",
+    ["inode", "size", "offset", "output_inode", "output_size"],
+    defaults=[None, None],
+)
+
+
+class AlreadyFollowed(Exception):
+    pass
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return Checkpoint(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    """Replaces the checkpoint file at `path` atomically and durably."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint._asdict(), f)
+        f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _complete_size(f, path):
+    # returns the size up to which the mbox is complete, and whether the
+    # last message in it may not be
+    fcntl.flock(f, fcntl.LOCK_SH)
+    fcntl.lockf(f, fcntl.LOCK_SH)
+    try:
+        size = os.fstat(f.fileno()).st_size
+    finally:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return size, os.path.exists(f"{path}.lock")
+
+
+def _start(f, st, checkpoint):
+    # where to start reading, given the checkpoint
+    if checkpoint is None:
+        return 0
+    if checkpoint.inode != st.st_ino or st.st_size < checkpoint.size:
+        return 0
+    if checkpoint.offset < st.st_size:
+        f.seek(checkpoint.offset)
+        if f.read(5) != b"From ":
+            return 0
+    return checkpoint.offset
+
+
+def read_messages(f, offset, end, hold_last=False):
+    """Yields (start, end, raw) for each message in the mbox file `f`
+    between `offset` and `end`, where `raw` includes the "From " line. Skips
+    anything before the first "From " line. The last message is only
+    yielded if it ends with a newline, and `hold_last` is false."""
+    f.seek(offset)
+    start = pos = offset
+    lines = []
+    while pos < end:
+        line = f.readline(end - pos)
+        if not line:
+            # shrank while we were reading
+            break
+        if line.startswith(b"From "):
+            if lines:
+                yield start, pos, b"".join(lines)
+            start = pos
+            lines = [line]
+        elif lines:
+            lines.append(line)
+        else:
+            start = pos + len(line)
+        pos += len(line)
+
+    if lines and not hold_last and lines[-1].endswith(b"\n"):
+        yield start, pos, b"".join(lines)
+
+
+def _output_state(output):
+    # (inode, size) of the output, if it's a regular file
+    if output is None:
+        return None, None
+    output.flush()
+    st = os.fstat(output.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        return None, None
+    os.fsync(output.fileno())
+    return st.st_ino, st.st_size
+
+
+def _rewind_output(output, checkpoint):
+    # drop what a crashed run wrote after its last checkpoint
+    if output is None or checkpoint is None or checkpoint.output_size is None:
+        return
+    output.flush()
+    st = os.fstat(output.fileno())
+    if (
+        stat.S_ISREG(st.st_mode)
+        and st.st_ino == checkpoint.output_inode
+        and st.st_size > checkpoint.output_size
+    ):
+        os.ftruncate(output.fileno(), checkpoint.output_size)
+        output.seek(checkpoint.output_size)
+
+
+def follow(
+    path,
+    checkpoint_path,
+    process,
+    output=None,
+    commit=None,
+    batch_size=100,
+    poll=None,
+):
+    """Calls process(raw) for each complete message appended to the mbox at
+    `path` since the checkpoint in `checkpoint_path` (or for every message,
+    if there is none), where `raw` is the message as bytes, including its
+    "From " line. `output` is the file that `process` writes to, if any.
+
+    Every `batch_size` messages, and after the last one, the output is
+    flushed (and fsynced), commit() is called (if given), and then the
+    checkpoint is saved. If `poll` is None, returns the number of messages
+    processed once it reaches the end of the mbox; otherwise, checks for new
+    messages every `poll` seconds, forever."""
+    lock = open(f"{checkpoint_path}.lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise AlreadyFollowed(
+            f"{path} is already being followed with {checkpoint_path}"
+        )
+
+    try:
+        checkpoint = load_checkpoint(checkpoint_path)
+        _rewind_output(output, checkpoint)
+
+        total = 0
+        while True:
+            n, checkpoint = _follow_once(
+                path, checkpoint_path, checkpoint, process, output, commit, batch_size
+            )
+            total += n
+            if poll is None:
+                return total
+            time.sleep(poll)
+    finally:
+        lock.close()
+
+
+def _follow_once(
+    path, checkpoint_path, checkpoint, process, output, commit, batch_size
+):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        # e.g., between rotation and the next delivery
+        return 0, checkpoint
+
+    with f:
+        st = os.fstat(f.fileno())
+        end, hold_last = _complete_size(f, path)
+        offset = _start(f, st, checkpoint)
+
+        def save(pos):
+            nonlocal checkpoint
+            output_inode, output_size = _output_state(output)
+            if commit is not None:
+                commit()
+            checkpoint = Checkpoint(st.st_ino, end, pos, output_inode, output_size)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+        n = 0
+        pos = offset
+        for _, stop, raw in read_messages(f, offset, end, hold_last):
+            process(raw)
+            n += 1
+            pos = stop
+            if n % batch_size == 0:
+                save(pos)
+
+        if checkpoint is None or (
+            checkpoint.inode,
+            checkpoint.size,
+            checkpoint.offset,
+        ) != (st.st_ino, end, pos):
+            save(pos)
+
+    return n, checkpoint
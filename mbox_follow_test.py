@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from parameterized import parameterized
+
+from mbox_follow import (
+    follow,
+    load_checkpoint,
+    read_messages,
+    AlreadyFollowed,
+)
+
+V3_URL = "https://urldefense.com/v3/__https://www.example.com/{}__;!!foo!bar$"
+
+
+def message(n):
+    return (
+        f"From sender@example.com Mon Jan  1 00:00:00 2024\n"
+        f"Subject: {n}\n\n{V3_URL.format(n)}\n\n"
+    ).encode()
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mbox = os.path.join(self.tmp.name, "mbox")
+        self.checkpoint = os.path.join(self.tmp.name, "mbox.ckpt")
+        self.seen = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def append(self, *ns):
+        with open(self.mbox, "ab") as f:
+            for n in ns:
+                f.write(message(n))
+
+    def process(self, raw):
+        self.seen.append(raw.split(b"Subject: ")[1].split(b"\n")[0].decode())
+
+    def follow(self, **kwargs):
+        self.seen = []
+        follow(self.mbox, self.checkpoint, self.process, **kwargs)
+        return self.seen
+
+    def test_only_new_messages(self):
+        self.append("a", "b")
+        self.assertEqual(self.follow(), ["a", "b"])
+        self.assertEqual(self.follow(), [])
+        self.append("c")
+        self.assertEqual(self.follow(), ["c"])
+        self.assertEqual(
+            load_checkpoint(self.checkpoint).offset, os.path.getsize(self.mbox)
+        )
+
+    @parameterized.expand(
+        [
+            # rotated: a new file
+            ["rotated", lambda self: os.unlink(self.mbox)],
+            # truncated, e.g., by a mail client
+            ["truncated", lambda self: open(self.mbox, "w").close()],
+        ]
+    )
+    def test_restart(self, _, change):
+        self.append("a", "b")
+        self.follow()
+        change(self)
+        self.append("c")
+        self.assertEqual(self.follow(), ["c"])
+
+    def test_rewritten(self):
+        # same inode, and no smaller, but the checkpoint is no longer at the
+        # start of a message
+        self.append("a", "b")
+        self.follow()
+        with open(self.mbox, "wb") as f:
+            f.write(message("rewritten") + message("c") + message("d"))
+        self.assertEqual(self.follow(), ["rewritten", "c", "d"])
+
+    def test_incomplete_message(self):
+        self.append("a")
+        with open(self.mbox, "ab") as f:
+            f.write(message("b")[:-5])
+        self.assertEqual(self.follow(), ["a"])
+        with open(self.mbox, "ab") as f:
+            f.write(message("b")[-5:])
+        self.assertEqual(self.follow(), ["b"])
+
+    def test_dotlock_holds_last_message(self):
+        self.append("a", "b")
+        open(self.mbox + ".lock", "w").close()
+        self.assertEqual(self.follow(), ["a"])
+        os.unlink(self.mbox + ".lock")
+        self.assertEqual(self.follow(), ["b"])
+
+    def test_batches(self):
+        commits = []
+        self.append(*"abcde")
+        self.follow(batch_size=2, commit=lambda: commits.append(list(self.seen)))
+        self.assertEqual(commits, [["a", "b"], ["a", "b", "c", "d"], list("abcde")])
+
+    def test_crash_rewinds_output(self):
+        output_path = os.path.join(self.tmp.name, "out")
+        self.append("a", "b")
+
+        def process(raw):
+            self.process(raw)
+            output.write(raw)
+            if self.seen[-1] == "d":
+                raise RuntimeError("crash")
+
+        with open(output_path, "ab") as output:
+            follow(self.mbox, self.checkpoint, process, output=output)
+
+        self.append("c", "d")
+        with open(output_path, "ab") as output:
+            with self.assertRaises(RuntimeError):
+                follow(self.mbox, self.checkpoint, process, output=output, batch_size=1)
+
+        # "d" was written, but not checkpointed
+        self.append("e")
+        self.seen = []
+        with open(output_path, "ab") as output:
+            follow(
+                self.mbox, self.checkpoint, lambda raw: output.write(raw), output=output
+            )
+        with open(output_path, "rb") as f, open(self.mbox, "rb") as mbox:
+            self.assertEqual(f.read(), mbox.read())
+
+    def test_already_followed(self):
+        self.append("a")
+        with open(self.checkpoint + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self.assertRaises(AlreadyFollowed):
+                self.follow()
+        self.assertEqual(self.follow(), ["a"])
+
+    def test_missing_mbox(self):
+        self.assertEqual(self.follow(), [])
+        self.assertIsNone(load_checkpoint(self.checkpoint))
+
+
+class TestReadMessages(unittest.TestCase):
+    def test_leading_garbage(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"garbage\n" + message("a") + message("b"))
+            end = f.tell()
+            starts = [start for start, _, _ in read_messages(f, 0, end)]
+        self.assertEqual(starts, [8, 8 + len(message("a"))])
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mbox = os.path.join(self.tmp.name, "mbox")
+        self.checkpoint = os.path.join(self.tmp.name, "mbox.ckpt")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def append(self, *ns):
+        with open(self.mbox, "ab") as f:
+            for n in ns:
+                f.write(message(n))
+
+    def run_script(self, *args):
+        out = subprocess.run(
+            [sys.executable, *args],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return [line for line in out.splitlines() if line.startswith("https:")]
+
+    def test_get_urls(self):
+        self.append("a", "b")
+        out = self.run_script("get_urls.py", "--checkpoint", self.checkpoint, self.mbox)
+        self.assertEqual(
+            out, ["https://www.example.com/a", "https://www.example.com/b"]
+        )
+        self.append("c")
+        out = self.run_script("get_urls.py", "--checkpoint", self.checkpoint, self.mbox)
+        self.assertEqual(out, ["https://www.example.com/c"])
+
+    def test_decode_email(self):
+        output = os.path.join(self.tmp.name, "clean.mbox")
+        stats = os.path.join(self.tmp.name, "stats.json")
+        args = [
+            "decode_email.py",
+            "--checkpoint",
+            self.checkpoint,
+            "--stats",
+            stats,
+            "-o",
+            output,
+            self.mbox,
+        ]
+        self.append("a", "b")
+        self.run_script(*args)
+        self.append("c")
+        self.run_script(*args)
+
+        with open(output) as f:
+            text = f.read()
+        self.assertEqual(text.count("From sender@example.com"), 3)
+        self.assertNotIn("urldefense", text)
+        self.assertIn("https://www.example.com/c", text)
+        with open(stats) as f:
+            self.assertEqual(json.load(f)["messages"], 3)
+
+    def test_checkpoint_requires_one_mbox(self):
+        p = subprocess.run(
+            [sys.executable, "get_urls.py", "--checkpoint", self.checkpoint],
+            capture_output=True,
+        )
+        self.assertNotEqual(p.returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
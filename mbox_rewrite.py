@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# mbox_rewrite.py - decode mangled URLs in the messages of existing mbox
+# files, in place
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: ./mbox_rewrite.py ~/Mail/archive.mbox /var/spool/mail/alice
+#
+
+import argparse
+import collections
+import errno
+import fcntl
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+
+from decode import _decoder
+from decode_email import ENCODED_REGEX, WIDE_CHARSET_REGEX, Limits
+from decode_email import fsync_dir, rewrite_raw_message
+
+#
+# rewriting an mbox with the email package (or through decode_email.py, one
+# message at a time) copies every byte of it through Python, though most
+# messages have no mangled URL in them. rewrite_mbox() instead:
+#
+#  1. locks the mbox the way mail delivery agents do: a dotlock (`mbox.lock`,
+#     created with O_EXCL; one older than STALE_DOTLOCK seconds is taken
+#     over), then fcntl() and flock() locks on the file itself. deliveries
+#     wait until we're done.
+#  2. maps the mbox into memory, and finds the messages ("From " lines) and
+#     the ones that may contain a mangled URL, in a pass over the whole
+#     mapping (like decode_email.py does per part, base64 and
+#     quoted-printable messages are searched for the encoded anchors).
+#  3. writes a temporary file next to the mbox: runs of messages with nothing
+#     to change are copied with os.copy_file_range() (or os.sendfile()),
+#     which copy in the kernel (or on the file system, e.g., with reflinks)
+#     without passing the bytes through Python; only the other messages go
+#     through decode_email.rewrite_raw_message(), and only those in which a
+#     mangled URL was decoded are rewritten.
+#  4. fsyncs it, gives it the mbox's mode, owner and times, renames it over
+#     the mbox, and fsyncs the directory.
+#
+# if nothing changes, the mbox isn't touched at all. if it's killed at any
+# point, the mbox is either the original or the rewritten version; a
+# temporary file left behind is removed by the next run.
+#
+# delivery agents that open the mbox before locking it (rather than taking
+# the dotlock first, like procmail does) and are waiting on the lock while
+# the mbox is replaced may append to the old file. rewrite mboxes that are
+# still being delivered to when mail is quiet, or stop delivery first.
+#
+
+# a dotlock older than this (in seconds) is assumed to be left by a crash
+STALE_DOTLOCK = 300
+
+# marks our temporary files, so that stale ones can be removed
+TEMPORARY = ".decode_email."
+
+_FROM_REGEX = re.compile(rb"\nFrom ")
+
+# bytes searched at a time for ENCODED_REGEX
+_CHUNK_SIZE = 1 << 20
+
+
+class MboxLocked(Exception):
+    pass
+
+
+def _dotlock(path, timeout):
+    # returns the path of the dotlock, once it's ours
+    lock = f"{path}.lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return lock
+        except FileExistsError:
+            pass
+
+        try:
+            if time.time() - os.stat(lock).st_mtime > STALE_DOTLOCK:
+                os.unlink(lock)
+                continue
+        except FileNotFoundError:
+            continue
+
+        if time.monotonic() > deadline:
+            raise MboxLocked(f"{lock} exists")
+        time.sleep(0.1)
+
+
+def _lock(f, timeout):
+    deadline = time.monotonic() + timeout
+    for lock in [fcntl.lockf, fcntl.flock]:
+        while True:
+            try:
+                lock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (BlockingIOError, PermissionError):
+                if time.monotonic() > deadline:
+                    raise MboxLocked(f"{f.name} is locked")
+                time.sleep(0.1)
+
+
+def _candidates(data):
+    # sorted offsets in `data` of anything that may make a message need
+    # rewriting: anchors, and the headers above. (finding them in one pass
+    # over the whole mbox, with bytes.find() and a regex that starts with a
+    # literal, is many times faster than a regex search per message.)
+    hosts = sorted(_decoder().decoders_by_host, key=len, reverse=True)
+    prefix = os.path.commonprefix(hosts)
+    if len(prefix) >= 8:
+        hosts = [prefix]
+
+    positions = []
+    for host in hosts:
+        host = host.encode("ascii")
+        i = data.find(host)
+        while i >= 0:
+            positions.append(i)
+            i = data.find(host, i + 1)
+
+    # (with a little overlap, for matches across chunks; headers are
+    # case-insensitive)
+    for start in range(0, len(data), _CHUNK_SIZE):
+        chunk = data[start : start + _CHUNK_SIZE + 64].lower()
+        for regex in [ENCODED_REGEX, WIDE_CHARSET_REGEX]:
+            for m in regex.finditer(chunk):
+                if m.start() < _CHUNK_SIZE:
+                    positions.append(start + m.start())
+
+    positions.sort()
+    return positions
+
+
+def _candidate_messages(data, candidates):
+    # yields (start, end) for each message in the mbox `data` with a
+    # candidate in it, including its "From " line (or, for anything before
+    # the first "From " line, from the start)
+    size = len(data)
+    end = 0
+    for pos in candidates:
+        if pos < end:
+            continue
+        start = data.rfind(b"\nFrom ", 0, pos) + 1
+        end = data.find(b"\nFrom ", pos)
+        end = size if end < 0 else end + 1
+        yield start, end
+
+
+def _copy_range(src, dst, offset, count):
+    # copies `count` bytes at `offset` in the file `src` to the current
+    # position of the file `dst` (both file descriptors), in the kernel if
+    # we can
+    end = offset + count
+    while offset < end:
+        try:
+            n = os.copy_file_range(src, dst, end - offset, offset)
+        except (AttributeError, OSError) as err:
+            # not on this platform, or not between these file systems
+            if isinstance(err, OSError) and err.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ):
+                raise
+            try:
+                n = os.sendfile(dst, src, offset, end - offset)
+            except OSError:
+                n = os.write(dst, os.pread(src, min(end - offset, 1 << 20), offset))
+        if n == 0:
+            raise OSError(f"unexpected end of file at {offset}")
+        offset += n
+
+
+class _Rewriter:
+    # writes the new version of the mbox: copies ranges of the original,
+    # coalescing adjacent ones, and writes the rewritten messages. the
+    # temporary file is only created once a message changes.
+    def __init__(self, src, path):
+        self.src = src
+        self.path = path
+        self.tmp = None
+        self.pending = (0, 0)  # range of the original not copied yet
+        self.copied = 0  # bytes of the original kept as they were
+
+    def copy(self, start, end):
+        self.copied += end - start
+        if self.pending[1] == start:
+            self.pending = (self.pending[0], end)
+        else:
+            self._flush()
+            self.pending = (start, end)
+
+    def write(self, data):
+        if self.tmp is None:
+            directory, name = os.path.split(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(prefix=f".{name}{TEMPORARY}", dir=directory)
+            self.tmp = os.fdopen(fd, "wb")
+            self.tmp_path = tmp_path
+        self._flush()
+        self.tmp.write(data)
+
+    def _flush(self):
+        start, end = self.pending
+        self.pending = (end, end)
+        if self.tmp is not None and end > start:
+            self.tmp.flush()
+            _copy_range(self.src.fileno(), self.tmp.fileno(), start, end - start)
+
+    def commit(self, st):
+        # returns whether the mbox was replaced
+        if self.tmp is None:
+            return False
+        self._flush()
+        with self.tmp:
+            self.tmp.flush()
+            fd = self.tmp.fileno()
+            os.fchmod(fd, st.st_mode & 0o7777)
+            try:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except PermissionError:
+                # e.g., a spool file owned by another group; keep ours
+                pass
+            os.fsync(fd)
+            # (mail clients compare the times to tell if there's new mail)
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(self.tmp_path, self.path)
+        fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+        return True
+
+    def abort(self):
+        if self.tmp is not None:
+            self.tmp.close()
+            os.unlink(self.tmp_path)
+
+
+def _remove_stale(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    for stale in os.listdir(directory):
+        if stale.startswith(f".{name}{TEMPORARY}"):
+            os.unlink(os.path.join(directory, stale))
+
+
+def rewrite_mbox(path, limits=Limits(), lock_timeout=10, progress=None):
+    """Decodes mangled URLs in every message in the mbox file at `path`, in
+    place. Returns a Counter of messages seen, rewritten, and left unchanged
+    because a limit was exceeded or they couldn't be processed, and of the
+    bytes copied as they were.
+
+    If given, `progress` is called (without arguments) before each message
+    that may need rewriting, e.g., to renew a lease; if it raises, the mbox
+    is left as it was."""
+    counts = collections.Counter()
+    dotlock = _dotlock(path, lock_timeout)
+    try:
+        with open(path, "r+b") as f:
+            _lock(f, lock_timeout)
+            # (no other rewrite can be running: we hold the dotlock)
+            _remove_stale(path)
+
+            st = os.fstat(f.fileno())
+            if st.st_size == 0:
+                return counts
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # (and one for anything before the first "From " line)
+                counts["messages"] = len(_FROM_REGEX.findall(data)) + 1
+                writer = _Rewriter(f, path)
+                try:
+                    pos = 0  # end of the last message rewritten
+                    for start, end in _candidate_messages(data, _candidates(data)):
+                        if progress is not None:
+                            progress()
+                        raw = data[start:end]
+                        output = _rewrite(path, start, raw, limits, counts)
+                        if output is None or output == raw:
+                            continue
+                        writer.copy(pos, start)
+                        writer.write(output)
+                        pos = end
+                        counts["rewritten"] += 1
+                    writer.copy(pos, len(data))
+
+                    if writer.commit(st):
+                        counts["bytes_copied"] = writer.copied
+                except BaseException:
+                    writer.abort()
+                    raise
+    finally:
+        os.unlink(dotlock)
+
+    return counts
+
+
+def _rewrite(path, offset, raw, limits, counts):
+    # the message, rewritten, or None to leave it as it is
+    output = rewrite_raw_message(
+        raw, f"{path}: message at {offset}", limits, counts, preserve_mbox_from=True
+    )
+    if output is None:
+        return None
+
+    # keep the blank line that ends each message in an mbox
+    if raw.endswith(b"\n\n") and not output.endswith(b"\n\n"):
+        output += b"\n" if output.endswith(b"\n") else b"\n\n"
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="decode proofpoint-mangled URLs in the messages of mbox files, in place"
+    )
+    parser.add_argument(
+        "--timeout",
+        help="leave a message unchanged if it takes more than this many seconds",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        help="give up on an mbox if it can't be locked within this many seconds",
+        type=float,
+        default=10,
+    )
+    parser.add_argument("mbox", nargs="+", help="mbox file to rewrite")
+    args = parser.parse_args()
+
+    status = 0
+    for mbox in args.mbox:
+        try:
+            counts = rewrite_mbox(mbox, Limits(seconds=args.timeout), args.lock_timeout)
+        except MboxLocked as err:
+            print(f"{mbox}: {err}", file=sys.stderr)
+            status = 1
+            continue
+        print(
+            f"{mbox}: {counts['rewritten']} of {counts['messages']} messages rewritten",
+            file=sys.stderr,
+        )
+    sys.exit(status)
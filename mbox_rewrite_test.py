@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import base64
+import errno
+import fcntl
+import mailbox
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from parameterized import parameterized
+
+import mbox_rewrite
+from mbox_rewrite import TEMPORARY, MboxLocked, rewrite_mbox
+
+V3_URL = "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mbox_rewrite.py")
+
+
+def message(i, body):
+    return (
+        f"From a@example.com Mon Jan  1 00:00:0{i % 10} 2024\n"
+        f"From: a@example.com\nSubject: message {i}\nMIME-Version: 1.0\n"
+        f"Content-Type: text/plain; charset=utf-8\n\n{body}\n\n"
+    ).encode("utf-8")
+
+
+def base64_message(i, body):
+    return (
+        f"From a@example.com Mon Jan  1 00:00:00 2024\n"
+        f"From: a@example.com\nSubject: message {i}\nMIME-Version: 1.0\n"
+        f"Content-Type: text/plain; charset=utf-8\n"
+        f"Content-Transfer-Encoding: base64\n\n"
+        f"{base64.encodebytes(body.encode()).decode()}\n"
+    ).encode("utf-8")
+
+
+class TestMboxRewrite(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "mbox")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, *messages):
+        with open(self.path, "wb") as f:
+            f.write(b"".join(messages))
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_rewrite(self):
+        clean = [message(i, f"nothing to see {i}") for i in range(5)]
+        mangled = message(5, f"see {V3_URL}")
+        self.write(*clean[:3], mangled, *clean[3:])
+
+        counts = rewrite_mbox(self.path)
+        self.assertEqual(counts["messages"], 6)
+        self.assertEqual(counts["rewritten"], 1)
+        self.assertEqual(counts["bytes_copied"], sum(map(len, clean)))
+
+        data = self.read()
+        self.assertNotIn(b"urldefense", data)
+        self.assertIn(b"https://example.com/#newsletter", data)
+        # everything else byte for byte
+        self.assertTrue(data.startswith(b"".join(clean[:3])))
+        self.assertTrue(data.endswith(b"".join(clean[3:])))
+
+        subjects = [m["Subject"] for m in mailbox.mbox(self.path)]
+        self.assertEqual(subjects, [f"message {i}" for i in [0, 1, 2, 5, 3, 4]])
+        self.assertEqual(os.listdir(self.tmp.name), ["mbox"])
+
+    def test_base64(self):
+        self.write(message(0, "clean"), base64_message(1, f"see {V3_URL}"))
+        self.assertEqual(rewrite_mbox(self.path)["rewritten"], 1)
+        m = list(mailbox.mbox(self.path))[1]
+        self.assertIn(
+            "https://example.com/#newsletter", m.get_payload(decode=True).decode()
+        )
+
+    def test_malformed_url(self):
+        # a v2 URL without `u` is left as it is, and doesn't stop the run
+        broken = message(0, "see https://urldefense.com/v2/url?x=1")
+        self.write(broken, message(1, f"see {V3_URL}"))
+        counts = rewrite_mbox(self.path)
+        self.assertEqual((counts["errors"], counts["rewritten"]), (1, 1))
+        self.assertTrue(self.read().startswith(broken))
+
+    def test_progress(self):
+        mangled = [message(i, f"see {V3_URL}") for i in range(3)]
+        self.write(message(3, "clean"), *mangled)
+        calls = []
+        self.assertEqual(
+            rewrite_mbox(self.path, progress=lambda: calls.append(1))["rewritten"], 3
+        )
+        self.assertEqual(len(calls), 3)
+
+        # e.g., a lease lost: the mbox is left as it was
+        self.write(message(3, "clean"), *mangled)
+
+        def progress():
+            raise RuntimeError("lease lost")
+
+        with self.assertRaises(RuntimeError):
+            rewrite_mbox(self.path, progress=progress)
+        self.assertEqual(self.read(), message(3, "clean") + b"".join(mangled))
+        self.assertEqual(os.listdir(self.tmp.name), ["mbox"])
+
+    def test_nothing_to_change(self):
+        # (the email package would refold the long header of the last one)
+        self.write(
+            message(0, "clean"),
+            base64_message(1, "clean too"),
+            message(2, "https://urldefense.com/ " + " ".join(["word"] * 40)).replace(
+                b"Subject: message 2", b"Subject:" + b" word" * 40
+            ),
+        )
+        inode = os.stat(self.path).st_ino
+        counts = rewrite_mbox(self.path)
+        self.assertEqual((counts["messages"], counts["rewritten"]), (3, 0))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+    def test_keeps_mode_and_times(self):
+        self.write(message(0, V3_URL))
+        os.chmod(self.path, 0o600)
+        os.utime(self.path, (1000000000, 1000000001))
+        rewrite_mbox(self.path)
+        st = os.stat(self.path)
+        self.assertEqual(st.st_mode & 0o777, 0o600)
+        self.assertEqual((st.st_atime, st.st_mtime), (1000000000, 1000000001))
+
+    @parameterized.expand(
+        [
+            ["empty", b"", b""],
+            ["garbage only", b"not a message\n", b"not a message\n"],
+            ["leading garbage", b"garbage\n" + message(0, V3_URL), b"garbage\n"],
+            [
+                "no final newline",
+                message(0, "clean") + message(1, V3_URL)[:-2],
+                message(0, "clean"),
+            ],
+        ]
+    )
+    def test_edges(self, _, data, kept):
+        self.write(data)
+        rewrite_mbox(self.path)
+        output = self.read()
+        self.assertTrue(output.startswith(kept))
+        self.assertNotIn(b"urldefense", output)
+        self.assertEqual(output == data, b"urldefense" not in data)
+
+    def test_dotlock(self):
+        self.write(message(0, V3_URL))
+        open(self.path + ".lock", "w").close()
+        with self.assertRaises(MboxLocked):
+            rewrite_mbox(self.path, lock_timeout=0.2)
+        self.assertIn(b"urldefense", self.read())
+
+        # a stale one is taken over
+        old = time.time() - mbox_rewrite.STALE_DOTLOCK - 1
+        os.utime(self.path + ".lock", (old, old))
+        self.assertEqual(rewrite_mbox(self.path)["rewritten"], 1)
+        self.assertFalse(os.path.exists(self.path + ".lock"))
+
+    def test_flock(self):
+        self.write(message(0, V3_URL))
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            with self.assertRaises(MboxLocked):
+                rewrite_mbox(self.path, lock_timeout=0.2)
+        self.assertFalse(os.path.exists(self.path + ".lock"))
+
+    def test_fcntl_lock(self):
+        # fcntl() locks are per process, so take it in another one
+        self.write(message(0, V3_URL))
+        p = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import fcntl, sys, time\n"
+                f"f = open({self.path!r}, 'r+b')\n"
+                "fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                "print('locked', flush=True)\n"
+                "time.sleep(10)\n",
+            ],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            p.stdout.readline()
+            with self.assertRaises(MboxLocked):
+                rewrite_mbox(self.path, lock_timeout=0.2)
+        finally:
+            p.kill()
+            p.wait()
+            p.stdout.close()
+        self.assertEqual(rewrite_mbox(self.path)["rewritten"], 1)
+
+    def test_stale_temporary_file(self):
+        self.write(message(0, "clean"))
+        stale = os.path.join(self.tmp.name, f".mbox{TEMPORARY}abc")
+        open(stale, "w").close()
+        rewrite_mbox(self.path)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_failure_leaves_original(self):
+        data = message(0, "clean") + message(1, V3_URL) + message(2, "clean")
+        self.write(data)
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                rewrite_mbox(self.path)
+        self.assertEqual(self.read(), data)
+        self.assertEqual(os.listdir(self.tmp.name), ["mbox"])
+
+    @parameterized.expand(
+        [
+            ["sendfile", [OSError(errno.EXDEV, "cross-device")], []],
+            [
+                "read and write",
+                [OSError(errno.EXDEV, "cross-device")],
+                [OSError(errno.EINVAL, "invalid")],
+            ],
+        ]
+    )
+    def test_copy_fallbacks(self, _, copy_errors, sendfile_errors):
+        clean = [message(i, "clean" * 1000) for i in range(20)]
+        self.write(*clean, message(20, V3_URL), *clean)
+
+        def fail(errors, fn):
+            def wrapper(*args):
+                if errors:
+                    raise errors[0]
+                return fn(*args)
+
+            return wrapper
+
+        with mock.patch("os.copy_file_range", fail(copy_errors, os.copy_file_range)):
+            with mock.patch("os.sendfile", fail(sendfile_errors, os.sendfile)):
+                rewrite_mbox(self.path)
+        data = self.read()
+        self.assertTrue(data.startswith(b"".join(clean)))
+        self.assertTrue(data.endswith(b"".join(clean)))
+        self.assertNotIn(b"urldefense", data)
+
+    def test_command_line(self):
+        self.write(message(0, V3_URL), message(1, "clean"))
+        p = subprocess.run(
+            [sys.executable, SCRIPT, self.path], capture_output=True, text=True
+        )
+        self.assertEqual(p.returncode, 0)
+        self.assertIn("1 of 2 messages rewritten", p.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
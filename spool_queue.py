@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# spool_queue.py - split rewriting Maildirs and mbox files between workers on
+# any number of hosts, through a shared spool directory
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   ./spool_queue.py enqueue /nfs/spool /nfs/mail/*/Maildir
+#   ./spool_queue.py work --jobs 4 /nfs/spool      # on each host
+#   ./spool_queue.py status /nfs/spool
+#
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+from decode_email import Limits, fsync_dir
+from maildir_rewrite import BatchWriter, rewrite_message, unique_name
+from mbox_rewrite import MboxLocked, rewrite_mbox
+
+#
+# the spool is a directory (e.g., on the NFS file system that holds the
+# mail) with one subdirectory per state of a work item:
+#
+#   tmp/      items being written by the producer
+#   pending/  items waiting for a worker
+#   leased/   items a worker is working on, renamed to ITEM~HOST.PID
+#   done/     the results of finished items (as JSON)
+#
+# every change of state is a rename(), which is atomic (on NFS too): when
+# several workers rename the same pending item, exactly one succeeds, and it
+# holds the lease. no broker or lock server is needed.
+#
+# an item is a JSON file: either some messages of one Maildir,
+#
+#   {"maildir": "/nfs/mail/alice/Maildir", "messages": ["1234.host", ...]}
+#
+# or one mbox file, {"mbox": "/nfs/mail/alice/archive.mbox"}.
+#
+# messages are named by their unique names (see maildir_rewrite.unique_name()),
+# and looked up in new/ and cur/ when the item is worked on: a mail client
+# may have moved them, or changed their flags, in the meantime. messages
+# that are gone by then are counted as "missing".
+#
+# leases time out: a worker renews its lease (by touching the leased file)
+# while it works, and any worker that finds a lease that hasn't been renewed
+# for `lease_timeout` seconds renames it back to pending/, so items leased
+# by a worker that crashed (or whose host did) are picked up again. the
+# hosts' clocks must agree to well within `lease_timeout`.
+#
+# an item is done when its result is in done/ and its lease is gone. if a
+# worker loses its lease (it stalled for longer than the timeout), its work
+# isn't lost, but the item may be worked on twice: that's fine, as rewriting
+# a message again leaves it unchanged.
+#
+# workers pick pending items in random order, so that they rarely try for
+# the same one, and throughput grows with the number of workers until the
+# file system is the bottleneck.
+#
+STATES = ["tmp", "pending", "leased", "done"]
+
+# the separator between an item's name and the owner of its lease
+OWNER = "~"
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def _owner():
+    return f"{socket.gethostname()}.{os.getpid()}"
+
+
+def _write_json(spool, state, name, obj):
+    # writes `obj` to state/name atomically, through tmp/
+    tmp = os.path.join(spool, "tmp", f"{name}.{_owner()}")
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+        f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(spool, state, name))
+    fsync_dir(os.path.join(spool, state))
+
+
+def _sources(path):
+    # yields the work items for a Maildir or an mbox file
+    if os.path.isdir(os.path.join(path, "cur")):
+        for subdir in ["new", "cur"]:
+            for name in sorted(os.listdir(os.path.join(path, subdir))):
+                yield {"maildir": path, "message": unique_name(name)}
+    else:
+        yield {"mbox": path}
+
+
+def enqueue(spool, paths, batch_size=100):
+    """Adds work items for the Maildirs and mbox files in `paths` to the
+    spool (creating it if needed), with up to `batch_size` messages of a
+    Maildir in each. Returns the number of items added."""
+    for state in STATES:
+        os.makedirs(os.path.join(spool, state), exist_ok=True)
+
+    # (item names sort in the order they were added)
+    prefix = f"{int(time.time() * 1000):015d}.{_owner()}"
+    count = 0
+
+    def add(item):
+        nonlocal count
+        _write_json(spool, "pending", f"{prefix}.{count:08d}", item)
+        count += 1
+
+    for path in paths:
+        path = os.path.abspath(path)
+        batch = []
+        for source in _sources(path):
+            if "mbox" in source:
+                add(source)
+                continue
+            batch.append(source["message"])
+            if len(batch) == batch_size:
+                add({"maildir": path, "messages": batch})
+                batch = []
+        if batch:
+            add({"maildir": path, "messages": batch})
+
+    return count
+
+
+class Lease:
+    def __init__(self, spool, name, lease_timeout):
+        self.spool = spool
+        self.name = name
+        self.lease_timeout = lease_timeout
+        self.path = os.path.join(spool, "leased", f"{name}{OWNER}{_owner()}")
+        self.renewed = time.time()
+
+    def renew(self, force=False):
+        """Touches the leased item, if it's been a while. Raises LeaseLost
+        if it's no longer ours."""
+        now = time.time()
+        if not force and now - self.renewed < self.lease_timeout / 4:
+            return
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(self.name)
+        self.renewed = now
+
+    def item(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def complete(self, result):
+        # (the result first: if we crash in between, the item is redone)
+        self.renew(force=True)
+        _write_json(self.spool, "done", self.name, result)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(self.name)
+
+
+def claim(spool, lease_timeout, names=None):
+    """Leases a pending item, trying `names` (a list of pending item names,
+    which is consumed) or else all of them, in random order. Returns a
+    Lease, or None if there was nothing to claim."""
+    if names is None:
+        names = os.listdir(os.path.join(spool, "pending"))
+        random.shuffle(names)
+    while names:
+        name = names.pop()
+        pending = os.path.join(spool, "pending", name)
+        lease = Lease(spool, name, lease_timeout)
+        try:
+            # (touched first, so that the lease starts out fresh)
+            os.utime(pending)
+            os.rename(pending, lease.path)
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+        return lease
+    return None
+
+
+def recover(spool, lease_timeout):
+    """Puts items whose leases have timed out back in pending/. Returns
+    the number of leases recovered."""
+    leased = os.path.join(spool, "leased")
+    now = time.time()
+    count = 0
+    for leased_name in os.listdir(leased):
+        path = os.path.join(leased, leased_name)
+        try:
+            if now - os.stat(path).st_mtime < lease_timeout:
+                continue
+            name = leased_name.rpartition(OWNER)[0]
+            os.rename(path, os.path.join(spool, "pending", name))
+        except FileNotFoundError:
+            # completed, or recovered by another worker
+            continue
+        count += 1
+    return count
+
+
+def _find_messages(maildir):
+    # unique name -> path, for every message in the Maildir
+    paths = {}
+    for subdir in ["new", "cur"]:
+        directory = os.path.join(maildir, subdir)
+        for name in os.listdir(directory):
+            paths[unique_name(name)] = os.path.join(directory, name)
+    return paths
+
+
+def process(lease, item, limits=Limits(), batch_size=256):
+    """Rewrites the messages of a work item, renewing `lease` as it goes.
+    Returns a Counter, as rewrite_maildir() does, and of the messages that
+    were missing."""
+    counts = collections.Counter()
+    if "mbox" in item:
+        try:
+            counts.update(rewrite_mbox(item["mbox"], limits, progress=lease.renew))
+        except (MboxLocked, FileNotFoundError) as err:
+            print(f"{item['mbox']}: {err}", file=sys.stderr)
+            counts["errors"] += 1
+        return counts
+
+    with BatchWriter(item["maildir"], batch_size, shared=True) as writer:
+        paths = _find_messages(item["maildir"])
+        for message in item["messages"]:
+            lease.renew()
+            path = paths.get(message)
+            if path is None:
+                # deleted since the item was added
+                print(f"{item['maildir']}: {message}: not found", file=sys.stderr)
+                counts["missing"] += 1
+                continue
+            rewrite_message(writer, path, limits, counts)
+    return counts
+
+
+def work(spool, lease_timeout=300, limits=Limits(), poll=1.0):
+    """Works on pending items until there are none left, and none leased
+    (by any worker) either. Returns a Counter of the items completed, and
+    their messages."""
+    totals = collections.Counter()
+    names = []
+    while True:
+        lease = claim(spool, lease_timeout, names)
+        if lease is None:
+            # look again, including for leases that timed out
+            recover(spool, lease_timeout)
+            names = os.listdir(os.path.join(spool, "pending"))
+            random.shuffle(names)
+            if names:
+                continue
+            if not os.listdir(os.path.join(spool, "leased")):
+                return totals
+            time.sleep(poll)
+            continue
+
+        start = time.time()
+        result = {"worker": _owner()}
+        try:
+            try:
+                counts = process(lease, lease.item(), limits)
+            except LeaseLost:
+                raise
+            except Exception as err:
+                # e.g., the Maildir is gone: done, but with an error, rather
+                # than left for the next worker to fail on too
+                print(f"{lease.name}: {err}", file=sys.stderr)
+                counts = collections.Counter(errors=1)
+                result["error"] = str(err)
+            result["seconds"] = time.time() - start
+            result["counts"] = counts
+            lease.complete(result)
+        except LeaseLost as err:
+            print(f"lost the lease on {err}", file=sys.stderr)
+            totals["leases_lost"] += 1
+            continue
+        totals["items"] += 1
+        totals.update(counts)
+
+
+def status(spool, lease_timeout=300):
+    """Returns the number of items in each state (and how many of the leased
+    ones have timed out), and the total counts of the items done."""
+    result = collections.Counter()
+    now = time.time()
+    for state in ["pending", "leased", "done"]:
+        for name in os.listdir(os.path.join(spool, state)):
+            path = os.path.join(spool, state, name)
+            try:
+                if state == "done":
+                    with open(path) as f:
+                        result.update(json.load(f)["counts"])
+                elif state == "leased" and now - os.stat(path).st_mtime > lease_timeout:
+                    result["expired"] += 1
+            except FileNotFoundError:
+                # changed state while we looked
+                continue
+            result[state] += 1
+    return result
+
+
+def _work_job(job):
+    return work(*job)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="split rewriting Maildirs and mbox files between workers, through a shared spool directory"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser(
+        "enqueue", help="add work items for Maildirs and mbox files"
+    )
+    enqueue_parser.add_argument(
+        "--batch-size",
+        help="number of messages of a Maildir per work item",
+        type=int,
+        default=100,
+    )
+    enqueue_parser.add_argument("spool", help="spool directory")
+    enqueue_parser.add_argument("path", nargs="+", help="Maildir or mbox file")
+
+    work_parser = subparsers.add_parser(
+        "work", help="work on pending items until there are none left"
+    )
+    work_parser.add_argument(
+        "--jobs",
+        help="number of worker processes",
+        type=int,
+        default=1,
+    )
+    work_parser.add_argument(
+        "--timeout",
+        help="leave a message unchanged if it takes more than this many seconds",
+        type=float,
+        default=None,
+    )
+    work_parser.add_argument("spool", help="spool directory")
+
+    status_parser = subparsers.add_parser(
+        "status", help="print the number of items in each state, as JSON"
+    )
+    status_parser.add_argument("spool", help="spool directory")
+
+    for p in [work_parser, status_parser]:
+        p.add_argument(
+            "--lease-timeout",
+            help="seconds after which a worker's lease on an item is assumed lost",
+            type=float,
+            default=300,
+        )
+
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        count = enqueue(args.spool, args.path, args.batch_size)
+        print(f"{args.spool}: {count} items added", file=sys.stderr)
+    elif args.command == "work":
+        job = (args.spool, args.lease_timeout, Limits(seconds=args.timeout))
+        with multiprocessing.Pool(args.jobs) as pool:
+            totals = sum(pool.map(_work_job, [job] * args.jobs), collections.Counter())
+        print(
+            f"{args.spool}: {totals['items']} items, "
+            f"{totals['rewritten']} of {totals['messages']} messages rewritten",
+            file=sys.stderr,
+        )
+    else:
+        json.dump(status(args.spool, args.lease_timeout), sys.stdout)
+        print()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import json
+import mailbox
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from decode_email import process_message
+from spool_queue import (
+    LeaseLost,
+    claim,
+    enqueue,
+    process,
+    recover,
+    status,
+    work,
+)
+
+V3_URL = "https://urldefense.com/v3/__https://example.com/*newsletter__;Iw!!foo!bar$"
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool_queue.py")
+
+
+def message(i):
+    return (
+        f"From: a@example.com\nSubject: message {i}\nMIME-Version: 1.0\n"
+        f"Content-Type: text/plain; charset=utf-8\n\nsee {V3_URL}\n"
+    ).encode("utf-8")
+
+
+def backdate(path, seconds):
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+class TestSpoolQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = os.path.join(self.tmp.name, "spool")
+        self.maildirs = []
+        for m in range(3):
+            path = os.path.join(self.tmp.name, f"Maildir{m}")
+            maildir = mailbox.Maildir(path)
+            for i in range(25):
+                maildir.add(message(i))
+            maildir.add(b"Subject: plain\n\nno URLs here\n")
+            self.maildirs.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def files(self):
+        # every message, in every Maildir
+        files = {}
+        for path in self.maildirs:
+            for subdir in ["new", "cur"]:
+                directory = os.path.join(path, subdir)
+                for name in os.listdir(directory):
+                    with open(os.path.join(directory, name), "rb") as f:
+                        files[os.path.join(directory, name)] = f.read()
+        return files
+
+    def listdir(self, state):
+        return os.listdir(os.path.join(self.spool, state))
+
+    def assertAllRewritten(self):
+        files = self.files()
+        self.assertEqual(len(files), 3 * 26)
+        for data in files.values():
+            self.assertNotIn(b"urldefense", data)
+        for state in ["tmp", "pending", "leased"]:
+            self.assertEqual(self.listdir(state), [], state)
+
+    def test_enqueue(self):
+        self.assertEqual(enqueue(self.spool, self.maildirs, batch_size=10), 9)
+        items = []
+        for name in sorted(self.listdir("pending")):
+            with open(os.path.join(self.spool, "pending", name)) as f:
+                items.append(json.load(f))
+        self.assertEqual(sum(len(item["messages"]) for item in items), 3 * 26)
+        self.assertEqual(status(self.spool)["pending"], 9)
+
+    def test_work(self):
+        before = self.files()
+        enqueue(self.spool, self.maildirs, batch_size=10)
+        totals = work(self.spool)
+        self.assertEqual(totals["items"], 9)
+        self.assertEqual((totals["messages"], totals["rewritten"]), (78, 75))
+        self.assertAllRewritten()
+
+        for path, data in self.files().items():
+            self.assertEqual(data.decode(), process_message(before[path].decode()))
+
+        s = status(self.spool)
+        self.assertEqual((s["done"], s["messages"], s["rewritten"]), (9, 78, 75))
+
+    def test_mbox(self):
+        path = os.path.join(self.tmp.name, "mbox")
+        with open(path, "wb") as f:
+            f.write(b"From a@example.com Mon Jan  1 00:00:00 2024\n" + message(0))
+        enqueue(self.spool, [path])
+        self.assertEqual(work(self.spool)["rewritten"], 1)
+        with open(path, "rb") as f:
+            self.assertNotIn(b"urldefense", f.read())
+
+    def test_mbox_renews_lease(self):
+        path = os.path.join(self.tmp.name, "mbox")
+        with open(path, "wb") as f:
+            for i in range(3):
+                f.write(b"From a@example.com Mon Jan  1 00:00:00 2024\n" + message(i))
+
+        class Lease:
+            renewed = 0
+
+            def renew(self):
+                self.renewed += 1
+
+        lease = Lease()
+        self.assertEqual(process(lease, {"mbox": path})["rewritten"], 3)
+        self.assertEqual(lease.renewed, 3)
+
+    def test_moved_messages(self):
+        enqueue(self.spool, self.maildirs[:1])
+        # read by a mail client (new/ -> cur/, with a flag), and one deleted
+        new = os.path.join(self.maildirs[0], "new")
+        names = sorted(os.listdir(new))
+        for name in names[:10]:
+            os.rename(
+                os.path.join(new, name),
+                os.path.join(self.maildirs[0], "cur", f"{name}:2,S"),
+            )
+        os.unlink(os.path.join(new, names[-1]))
+
+        totals = work(self.spool)
+        self.assertEqual((totals["messages"], totals["missing"]), (25, 1))
+        for path, data in self.files().items():
+            if path.startswith(self.maildirs[0] + os.sep):
+                self.assertNotIn(b"urldefense", data)
+
+    def test_several_workers(self):
+        enqueue(self.spool, self.maildirs, batch_size=2)
+        with multiprocessing.Pool(4) as pool:
+            results = pool.starmap(work, [(self.spool,)] * 4)
+
+        # every item exactly once, between them
+        self.assertEqual(sum(r["items"] for r in results), 39)
+        self.assertEqual(sum(r["rewritten"] for r in results), 75)
+        self.assertAllRewritten()
+        self.assertEqual(len(self.listdir("done")), 39)
+
+    def test_expired_lease(self):
+        enqueue(self.spool, self.maildirs, batch_size=100)
+        # a worker claims an item, and crashes
+        lease = claim(self.spool, lease_timeout=60)
+        self.assertEqual(recover(self.spool, 60), 0)
+        self.assertEqual(status(self.spool, 60)["expired"], 0)
+
+        backdate(lease.path, 61)
+        self.assertEqual(status(self.spool, 60)["expired"], 1)
+        totals = work(self.spool, lease_timeout=60)
+        self.assertEqual(totals["items"], 3)
+        self.assertAllRewritten()
+
+        # the crashed worker comes back
+        with self.assertRaises(LeaseLost):
+            lease.renew(force=True)
+
+    def test_waits_for_leases(self):
+        enqueue(self.spool, self.maildirs[:1])
+        lease = claim(self.spool, lease_timeout=0.5)
+        # nothing pending, but the lease times out while we wait
+        totals = work(self.spool, lease_timeout=0.5, poll=0.1)
+        self.assertEqual(totals["items"], 1)
+        with self.assertRaises(LeaseLost):
+            lease.complete({})
+
+    def test_error(self):
+        enqueue(self.spool, self.maildirs[:1])
+        os.rename(self.maildirs[0], self.maildirs[0] + ".moved")
+        totals = work(self.spool)
+        self.assertEqual((totals["items"], totals["errors"]), (1, 1))
+        (name,) = self.listdir("done")
+        with open(os.path.join(self.spool, "done", name)) as f:
+            self.assertIn("error", json.load(f))
+
+    def test_command_line(self):
+        def run(*args):
+            return subprocess.run(
+                [sys.executable, SCRIPT, *args],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+
+        run("enqueue", "--batch-size", "5", self.spool, *self.maildirs)
+        p = run("work", "--jobs", "3", self.spool)
+        self.assertIn("75 of 78 messages rewritten", p.stderr)
+        s = json.loads(run("status", self.spool).stdout)
+        self.assertEqual((s["done"], s["rewritten"]), (18, 75))
+        self.assertAllRewritten()
+
+
+if __name__ == "__main__":
+    unittest.main()
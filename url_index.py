@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# url_index.py - an index of the mangled URLs in mail archives, and who they
+# were sent to
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   ./url_index.py index urls.db ~/Mail/inbox ~/Mail/archive.mbox
+#   ./url_index.py query urls.db --host www.example.com
+#
+
+import argparse
+import email, email.policy, email.utils
+import hashlib
+import json
+import mailbox
+import logging
+import os
+import sqlite3
+import sys
+import urllib.parse
+
+from decode import decode, identify, iter_urls
+from decode_email import TEXT_TYPES
+
+_log = logging.getLogger("url_index")
+
+# messages parsed per transaction
+BATCH_SIZE = 500
+
+#
+# one row in `urls` per distinct mangled URL in a message. `mailboxes` and
+# `messages` record what has been indexed already, so indexing the same
+# mailboxes again only parses new messages:
+#
+#  - Maildir messages are keyed by file name; messages that have gone away
+#    are dropped from the index.
+#  - mbox messages are keyed by their position in the file, which only stays
+#    the same while the file is appended to. `digest` is the SHA-256 of the
+#    first `size` bytes, i.e., of what was indexed: if an mbox shrinks, or
+#    those bytes have changed (e.g., a message was removed and another one
+#    appended), it's indexed again from scratch. if its size and mtime
+#    haven't changed, it isn't read at all.
+#
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    digest TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    key TEXT NOT NULL,
+    message_id TEXT,
+    date TEXT,
+    PRIMARY KEY (mailbox, key)
+);
+CREATE TABLE IF NOT EXISTS urls (
+    cleaned_url TEXT NOT NULL,
+    host TEXT,
+    version TEXT NOT NULL,
+    org_id TEXT,
+    recipient TEXT,
+    extra TEXT,
+    original TEXT NOT NULL,
+    message_id TEXT,
+    mailbox TEXT NOT NULL,
+    key TEXT NOT NULL,
+    date TEXT,
+    UNIQUE (mailbox, key, original)
+);
+CREATE INDEX IF NOT EXISTS urls_cleaned_url ON urls (cleaned_url);
+CREATE INDEX IF NOT EXISTS urls_host ON urls (host);
+CREATE INDEX IF NOT EXISTS urls_org_id ON urls (org_id);
+CREATE INDEX IF NOT EXISTS urls_recipient ON urls (recipient);
+CREATE INDEX IF NOT EXISTS urls_message_id ON urls (message_id);
+"""
+
+COLUMNS = [
+    "cleaned_url",
+    "host",
+    "version",
+    "org_id",
+    "recipient",
+    "extra",
+    "original",
+    "message_id",
+    "mailbox",
+    "key",
+    "date",
+]
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    # readers (queries) don't block the indexer, and vice versa
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def message_urls(e):
+    """Yields a dict for each distinct mangled URL in the text parts of the
+    message `e`."""
+    seen = set()
+    for part in e.walk():
+        if part.get_content_type() not in TEXT_TYPES:
+            continue
+        try:
+            text = part.get_content()
+        except (LookupError, UnicodeError):
+            _log.debug("skipping undecodable part")
+            continue
+
+        for url in iter_urls(text):
+            if url.version is None or url.raw in seen:
+                continue
+            seen.add(url.raw)
+
+            try:
+                cleaned_url = decode(url.raw)
+            except Exception as err:
+                # e.g., a v2 URL without `u`: nothing to index
+                _log.debug("skipping %s: %s", url.raw, err)
+                continue
+            try:
+                host = urllib.parse.urlsplit(cleaned_url).hostname
+            except ValueError:
+                # e.g., "http://[x/" (an invalid IPv6 address)
+                host = None
+
+            ids = identify(url.raw) or {"org_id": None, "recipient": None}
+            yield {
+                "cleaned_url": cleaned_url,
+                "host": host,
+                "version": url.version,
+                "org_id": ids["org_id"],
+                "recipient": ids["recipient"],
+                "extra": json.dumps(ids["extra"]) if ids.get("extra") else None,
+                "original": url.raw,
+            }
+
+
+def _date(e):
+    # ISO 8601, so dates sort and compare as strings
+    try:
+        return email.utils.parsedate_to_datetime(e["Date"]).isoformat()
+    except (TypeError, ValueError):
+        return e["Date"]
+
+
+def _prefix_digests(path, sizes):
+    """Returns the SHA-256 (in hex) of the first n bytes of the file at
+    `path`, for each n in `sizes` (in ascending order), in a single read."""
+    h = hashlib.sha256()
+    digests = []
+    pos = 0
+    with open(path, "rb") as f:
+        for size in sizes:
+            while pos < size:
+                chunk = f.read(min(1 << 20, size - pos))
+                if not chunk:
+                    break
+                h.update(chunk)
+                pos += len(chunk)
+            digests.append(h.hexdigest())
+    return digests
+
+
+def _open_mailbox(path):
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, factory=None, create=False)
+
+
+def index_mailbox(db, path):
+    """Adds the messages in the mbox or Maildir at `path` that aren't in the
+    index yet. Returns the number of messages parsed."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    is_mbox = not os.path.isdir(path)
+    digest = None
+
+    if is_mbox:
+        row = db.execute(
+            "SELECT size, mtime, digest FROM mailboxes WHERE path = ?", (path,)
+        ).fetchone()
+        if row is not None and row[:2] == (st.st_size, st.st_mtime):
+            return 0
+        if row is not None and st.st_size >= row[0]:
+            indexed_digest, digest = _prefix_digests(path, [row[0], st.st_size])
+        else:
+            indexed_digest = None
+            (digest,) = _prefix_digests(path, [st.st_size])
+        if row is not None and indexed_digest != row[2]:
+            # shrunk, or not just appended to: start over
+            with db:
+                db.execute("DELETE FROM urls WHERE mailbox = ?", (path,))
+                db.execute("DELETE FROM messages WHERE mailbox = ?", (path,))
+
+    mbox = _open_mailbox(path)
+    keys = [str(key) for key in mbox.keys()]
+    indexed = {
+        key
+        for (key,) in db.execute("SELECT key FROM messages WHERE mailbox = ?", (path,))
+    }
+
+    # drop messages that have gone away
+    gone = [(path, key) for key in indexed.difference(keys)]
+    with db:
+        db.executemany("DELETE FROM urls WHERE mailbox = ? AND key = ?", gone)
+        db.executemany("DELETE FROM messages WHERE mailbox = ? AND key = ?", gone)
+
+    new_keys = [key for key in keys if key not in indexed]
+    for i in range(0, len(new_keys), BATCH_SIZE):
+        messages = []
+        urls = []
+        for key in new_keys[i : i + BATCH_SIZE]:
+            raw = mbox.get_bytes(int(key) if is_mbox else key)
+            e = email.message_from_bytes(raw, policy=email.policy.default)
+            message_id = e["Message-ID"]
+            date = _date(e)
+
+            messages.append((path, key, message_id, date))
+            for url in message_urls(e):
+                url.update(message_id=message_id, mailbox=path, key=key, date=date)
+                urls.append(tuple(url[c] for c in COLUMNS))
+
+        with db:
+            db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?)", messages)
+            db.executemany(
+                f"INSERT OR IGNORE INTO urls ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in COLUMNS)})",
+                urls,
+            )
+
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO mailboxes VALUES (?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime, digest),
+        )
+
+    return len(new_keys)
+
+
+def query(db, **where):
+    """Yields a dict for each indexed URL matching all of the given columns
+    (e.g., host="www.example.com"), oldest first."""
+    for column in where:
+        if column not in COLUMNS:
+            raise ValueError(f"unknown column: {column}")
+
+    sql = f"SELECT {', '.join(COLUMNS)} FROM urls"
+    if where:
+        sql += " WHERE " + " AND ".join(f"{column} = ?" for column in where)
+    sql += " ORDER BY date, mailbox, key"
+
+    for row in db.execute(sql, tuple(where.values())):
+        yield dict(zip(COLUMNS, row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="index the proofpoint-mangled URLs in mail archives, and query the index"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser(
+        "index", help="add new messages in mailboxes (mbox files or Maildirs)"
+    )
+    index_parser.add_argument("db", help="index database")
+    index_parser.add_argument("mailbox", nargs="+", help="mbox file or Maildir")
+
+    query_parser = subparsers.add_parser(
+        "query", help="print matching URLs as JSON lines"
+    )
+    query_parser.add_argument("db", help="index database")
+    query_parser.add_argument("--url", help="cleaned URL", dest="cleaned_url")
+    query_parser.add_argument("--host", help="host of the cleaned URL")
+    query_parser.add_argument("--org-id", help="organization id")
+    query_parser.add_argument("--recipient", help="recipient identifier")
+    query_parser.add_argument("--message-id", help="Message-ID, e.g., <x@example.com>")
+    query_parser.add_argument("--mailbox", help="mbox file or Maildir")
+
+    args = parser.parse_args()
+    db = connect(args.db)
+
+    if args.command == "index":
+        for path in args.mailbox:
+            n = index_mailbox(db, path)
+            print(f"{path}: {n} new messages", file=sys.stderr)
+    else:
+        where = {
+            column: getattr(args, column)
+            for column in ["cleaned_url", "host", "org_id", "recipient", "message_id"]
+            if getattr(args, column) is not None
+        }
+        if args.mailbox is not None:
+            where["mailbox"] = os.path.abspath(args.mailbox)
+        for row in query(db, **where):
+            print(json.dumps(row))
+
+    db.close()
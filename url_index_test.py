@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import email.message
+import mailbox
+import os
+import tempfile
+import unittest
+
+from url_index import connect, index_mailbox, query
+
+V2_URL = "https://urldefense.proofpoint.com/v2/url?u=https-3A__www.example.com_a&d=DwMFaQ&c=ORG2&r=RCPT2&m=MSG&s=SIG&e="
+
+
+def v3_url(recipient):
+    return (
+        f"https://urldefense.com/v3/__https://www.example.com/b__;!!ORG3!{recipient}$"
+    )
+
+
+def message(n, *urls):
+    e = email.message.EmailMessage()
+    e["Message-ID"] = f"<{n}@example.com>"
+    e["Date"] = f"Thu, {n:02d} Jan 2026 00:00:00 +0000"
+    e["Subject"] = f"message {n}"
+    e.set_content("see " + "\n and ".join(urls) + "\n")
+    e.add_alternative(f'<a href="{urls[0]}">link</a>\n', subtype="html")
+    return e
+
+
+class TestUrlIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = connect(os.path.join(self.tmp.name, "urls.db"))
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def test_mbox(self):
+        path = os.path.join(self.tmp.name, "mbox")
+        mbox = mailbox.mbox(path)
+        mbox.add(message(1, V2_URL, v3_url("alice")))
+        mbox.add(message(2, v3_url("bob"), "https://www.example.org/"))
+        mbox.flush()
+
+        self.assertEqual(index_mailbox(self.db, path), 2)
+
+        rows = list(query(self.db, cleaned_url="https://www.example.com/b"))
+        self.assertEqual([r["recipient"] for r in rows], ["alice", "bob"])
+        self.assertEqual(
+            [r["message_id"] for r in rows], ["<1@example.com>", "<2@example.com>"]
+        )
+        self.assertEqual(rows[0]["org_id"], "ORG3")
+        self.assertEqual(rows[0]["date"], "2026-01-01T00:00:00+00:00")
+
+        (row,) = query(self.db, recipient="RCPT2")
+        self.assertEqual(row["cleaned_url"], "https://www.example.com/a")
+        self.assertEqual(row["host"], "www.example.com")
+        self.assertEqual(row["version"], "ppv2")
+        self.assertEqual(row["org_id"], "ORG2")
+        self.assertIn('"m": "MSG"', row["extra"])
+
+        # unmangled URLs aren't indexed
+        self.assertEqual(list(query(self.db, host="www.example.org")), [])
+
+        # unchanged: nothing to do
+        self.assertEqual(index_mailbox(self.db, path), 0)
+
+        # appended to: only the new message is parsed
+        mbox.add(message(3, v3_url("carol")))
+        mbox.flush()
+        self.assertEqual(index_mailbox(self.db, path), 1)
+        self.assertEqual(len(list(query(self.db, host="www.example.com"))), 4)
+
+        # rewritten: indexed again from scratch
+        mbox.remove(0)
+        mbox.flush()
+        self.assertEqual(index_mailbox(self.db, path), 2)
+        self.assertEqual(
+            [r["recipient"] for r in query(self.db, host="www.example.com")],
+            ["bob", "carol"],
+        )
+
+        # a message removed and a bigger one appended: the file doesn't
+        # shrink, but the messages have moved
+        mbox.remove(1)
+        mbox.add(message(4, v3_url("dave"), V2_URL))
+        mbox.flush()
+        self.assertEqual(index_mailbox(self.db, path), 2)
+        self.assertEqual(
+            {r["message_id"]: r["recipient"] for r in query(self.db, org_id="ORG3")},
+            {"<3@example.com>": "carol", "<4@example.com>": "dave"},
+        )
+        mbox.close()
+
+    def test_malformed_url(self):
+        path = os.path.join(self.tmp.name, "mbox")
+        mbox = mailbox.mbox(path)
+        mbox.add(message(1, "https://urldefense.com/v2/url?x=1", v3_url("alice")))
+        mbox.close()
+
+        self.assertEqual(index_mailbox(self.db, path), 1)
+        self.assertEqual([r["recipient"] for r in query(self.db)], ["alice"])
+
+    def test_invalid_host(self):
+        # decodes to "http://[x/", which urlsplit() can't parse
+        url = "https://urldefense.com/v3/__http://*x/__;Ww!!a!b$"
+        path = os.path.join(self.tmp.name, "mbox")
+        mbox = mailbox.mbox(path)
+        mbox.add(message(1, url, v3_url("alice")))
+        mbox.close()
+
+        self.assertEqual(index_mailbox(self.db, path), 1)
+        rows = list(query(self.db, org_id="a"))
+        self.assertEqual(
+            [(r["cleaned_url"], r["host"]) for r in rows], [("http://[x/", None)]
+        )
+        self.assertEqual(len(list(query(self.db, recipient="alice"))), 1)
+
+    def test_maildir(self):
+        path = os.path.join(self.tmp.name, "Maildir")
+        md = mailbox.Maildir(path)
+        key = md.add(message(1, v3_url("alice")))
+        md.add(message(2, v3_url("bob")))
+
+        self.assertEqual(index_mailbox(self.db, path), 2)
+        self.assertEqual(index_mailbox(self.db, path), 0)
+
+        md.remove(key)
+        md.add(message(3, v3_url("carol")))
+        self.assertEqual(index_mailbox(self.db, path), 1)
+        self.assertEqual(
+            [r["recipient"] for r in query(self.db, org_id="ORG3")], ["bob", "carol"]
+        )
+
+    def test_query_unknown_column(self):
+        with self.assertRaises(ValueError):
+            list(query(self.db, bogus="x"))
+
+
+if __name__ == "__main__":
+    unittest.main()
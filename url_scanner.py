@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# url_scanner.py - finds URLs in text, in linear time
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage: cat text | ./url_scanner.py
+#
+
+import re
+import sys
+
+# https://gist.github.com/gruber/8891611
+URL_REGEX = r"""(?i)\b((?:https?:(?:/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)/)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b/?(?!@)))"""
+
+# the top-level domains in URL_REGEX
+TLDS = "com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw"
+
+#
+# URL_REGEX has nested quantifiers, i.e., `(?:[^\s()<>{}\[\]]+|...)+`, so it
+# backtracks exponentially on some inputs: a URL followed by a run of
+# punctuation (e.g., `http://a/!!!!!!!!!!!!!!!!!!!!!!!!!! `) takes minutes.
+#
+# scan() finds the same matches as re.finditer(URL_REGEX, text) without
+# backtracking. URL_REGEX is:
+#
+#   (?i)\b( PREFIX BODY+ END | DOMAIN )
+#
+# where
+#
+#   PREFIX := https?:(?:/{1,3}|[a-z0-9%]) | [a-z0-9.\-]+[.]TLD/
+#   BODY   := [^\s()<>{}\[\]]+ | PAREN2 | PAREN
+#   END    := PAREN2 | PAREN | [^\s`!()\[\]{};:'".,<>?«»“”‘’]
+#   PAREN2 := \([^\s()]*?\([^\s()]+\)[^\s()]*?\)
+#   PAREN  := \([^\s]+?\)
+#   DOMAIN := (?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.]TLD\b/?(?!@)
+#
+# a match never contains whitespace, and whether there's a match at a
+# position only depends on the run of non-whitespace characters ("segment")
+# around it, so segments are scanned independently. only segments with an
+# "anchor" (`http:`, `https:` or `.TLD`), which every match contains, are
+# scanned at all.
+#
+# within a segment, each part of the regex is evaluated in the order the
+# regex engine would try it, but the results are memoized per position
+# (they only depend on the text to the right), so every segment is processed
+# in a constant number of passes. see _Segment for the details.
+#
+
+_ANCHOR_REGEX = re.compile(r"(?i)https?:|[.](?:" + TLDS + r")\b")
+_SCHEME_REGEX = re.compile(r"(?i)https?:")
+_TLD_SLASH_REGEX = re.compile(r"(?i)[.](?:" + TLDS + r")/")
+_DOMAIN_END_REGEX = re.compile(r"(?i)[.](?:" + TLDS + r")\b/?(?!@)")
+_NON_WHITESPACE_REGEX = re.compile(r"\S*")
+
+# characters matched by (?i)[a-z0-9], including the four non-ASCII letters
+# that match [a-z] case-insensitively
+_ALNUM = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789" "İıſK"
+)
+# [a-z0-9.\-]
+_HOSTNAME = _ALNUM | frozenset(".-")
+# [a-z0-9%]
+_ALNUM_PERCENT = _ALNUM | frozenset("%")
+# characters that BODY's first alternative doesn't match (besides whitespace)
+_BRACKETS = frozenset("()<>{}[]")
+# characters that END's last alternative doesn't match (besides whitespace)
+_NOT_END = _BRACKETS | frozenset("`!;:'\".,?«»“”‘’")
+
+
+def _is_word(c):
+    # \w, for \b
+    return c.isalnum() or c == "_"
+
+
+class _Segment:
+    r"""Memoized evaluation of URL_REGEX over text[start:end], a run of
+    non-whitespace characters.
+
+    For a position i, tail[i] is where a match ends if the regex engine is
+    in BODY+ at i, having matched at least one BODY already (i.e., it
+    may either match another BODY or END), or None if there's no match from
+    there. first[i] is the same, but before any BODY has matched (i.e., only
+    another BODY is allowed).
+
+    The regex engine tries another BODY before END (the `+` is greedy), and
+    BODY's alternatives in order:
+
+      - `[^\s()<>{}\[\]]+` greedily, i.e., the longest run of "plain"
+        characters first, then shorter ones. if nothing is found after the
+        full run, the match ends after the last plain character at or after
+        i (but before the end of the run) that END accepts.
+      - PAREN2, which can only match one way.
+      - PAREN, lazily, i.e., up to the first `)` from i + 2, then the next
+        `)`, and so on.
+
+    END's alternatives are PAREN2, PAREN (up to the first `)`) and a single
+    character.
+    """
+
+    def __init__(self, text, start, end):
+        self.text = text
+        self.start = start
+        self.end = end
+
+        n = end - start
+        self.tail = tail = [None] * (n + 2)
+        self.first = first = [None] * (n + 2)
+
+        # index of the next `(` or `)` at or after i
+        next_paren = [n] * (n + 2)
+        # index of the next `)` at or after i
+        next_close = [None] * (n + 2)
+        # index of the next `)` at or after i with a match after it
+        next_close_match = [None] * (n + 2)
+        # end of the run of plain characters containing i
+        run_end = [n] * (n + 1)
+        # index of the last character at or after i in the same run of plain
+        # characters that END accepts
+        last_end_char = [None] * (n + 1)
+
+        for i in range(n - 1, -1, -1):
+            c = text[start + i]
+
+            if c == "(" or c == ")":
+                next_paren[i] = i
+            else:
+                next_paren[i] = next_paren[i + 1]
+
+            if c not in _BRACKETS:
+                if i + 1 < n and text[start + i + 1] not in _BRACKETS:
+                    run_end[i] = run_end[i + 1]
+                    last_end_char[i] = last_end_char[i + 1]
+                else:
+                    run_end[i] = i + 1
+                    last_end_char[i] = None
+                if last_end_char[i] is None and c not in _NOT_END:
+                    last_end_char[i] = i
+
+                after_run = tail[run_end[i]]
+                if after_run is not None:
+                    first[i] = tail[i] = after_run
+                else:
+                    if i + 1 < run_end[i] and last_end_char[i + 1] is not None:
+                        first[i] = start + last_end_char[i + 1] + 1
+                    if last_end_char[i] is not None:
+                        tail[i] = start + last_end_char[i] + 1
+
+            elif c == "(":
+                paren2 = self._paren2(i, next_paren)
+                if paren2 is not None and tail[paren2] is not None:
+                    first[i] = tail[paren2]
+                elif next_close_match[i + 2] is not None:
+                    first[i] = tail[next_close_match[i + 2] + 1]
+
+                if first[i] is not None:
+                    tail[i] = first[i]
+                elif paren2 is not None:
+                    tail[i] = start + paren2
+                elif next_close[i + 2] is not None:
+                    tail[i] = start + next_close[i + 2] + 1
+
+            # else: `)`, `<`, `>`, `{`, `}`, `[` or `]` can't start either
+            # BODY or END
+
+            if c == ")":
+                next_close[i] = i
+                if tail[i + 1] is not None:
+                    next_close_match[i] = i
+                else:
+                    next_close_match[i] = next_close_match[i + 1]
+            else:
+                next_close[i] = next_close[i + 1]
+                next_close_match[i] = next_close_match[i + 1]
+
+    def _paren2(self, i, next_paren):
+        # returns the index just past `(x(y)z)` starting at i, or None
+        text = self.text
+        start = self.start
+        n = self.end - start
+
+        a = next_paren[i + 1]
+        if a >= n or text[start + a] != "(":
+            return None
+        b = next_paren[a + 1]
+        if b >= n or text[start + b] != ")" or b < a + 2:
+            return None
+        c = next_paren[b + 1]
+        if c >= n or text[start + c] != ")":
+            return None
+        return c + 1
+
+    def body(self, i):
+        # end of the match if PREFIX ends at (absolute) index i
+        return self.first[i - self.start]
+
+
+def _scan_segment(text, start, end):
+    # yields (start, end) of the matches in text[start:end], in order
+    segment = None
+    pos = start
+
+    # per run of [a-z0-9.\-] characters (from run_start): the end of the
+    # run, and where a match using the second PREFIX alternative ends (or
+    # None). this doesn't depend on where in the run the match starts, as
+    # long as it's before the last `.`.
+    run_start = run_end = None
+    run_match = None
+
+    # per chain of DOMAIN labels (from chain_start): the end of the chain,
+    # and the rightmost `.` followed by a top-level domain (or None) with the
+    # end of its match
+    chain_start = chain_end = None
+    chain_dot = chain_match = None
+
+    while pos < end:
+        c = text[pos]
+        prev = text[pos - 1] if pos > 0 else " "
+        boundary = _is_word(prev) != _is_word(c)
+        match_end = None
+
+        # https?:(?:/{1,3}|[a-z0-9%]) BODY+ END
+        if boundary and c in "hH":
+            m = _SCHEME_REGEX.match(text, pos, end)
+            if m is not None:
+                if segment is None:
+                    segment = _Segment(text, start, end)
+
+                i = m.end()
+                slashes = 0
+                while slashes < 3 and i + slashes < end and text[i + slashes] == "/":
+                    slashes += 1
+                if slashes > 0:
+                    prefix_ends = range(i + slashes, i, -1)
+                elif i < end and text[i] in _ALNUM_PERCENT:
+                    prefix_ends = [i + 1]
+                else:
+                    prefix_ends = []
+
+                for prefix_end in prefix_ends:
+                    match_end = segment.body(prefix_end)
+                    if match_end is not None:
+                        break
+
+        # [a-z0-9.\-]+[.]TLD/ BODY+ END
+        if match_end is None and boundary and c in _HOSTNAME:
+            if run_start is None or not run_start <= pos < run_end:
+                run_start = run_end = pos
+                while run_end < end and text[run_end] in _HOSTNAME:
+                    run_end += 1
+
+                run_match = None
+                dot = text.rfind(".", pos, run_end)
+                if run_end < end and dot >= pos:
+                    m = _TLD_SLASH_REGEX.match(text, dot, end)
+                    if m is not None and m.end() == run_end + 1:
+                        if segment is None:
+                            segment = _Segment(text, start, end)
+                        run_match = (dot, segment.body(run_end + 1))
+
+            if run_match is not None and pos < run_match[0]:
+                match_end = run_match[1]
+
+        # (?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.]TLD\b/?(?!@)
+        if match_end is None and boundary and c in _ALNUM and prev != "@":
+            if chain_start is None or not chain_start <= pos < chain_end:
+                chain_start = i = pos
+                chain_dot = chain_match = None
+                while True:
+                    while i < end and text[i] in _ALNUM:
+                        i += 1
+                    if i < end and text[i] == ".":
+                        m = _DOMAIN_END_REGEX.match(text, i)
+                        if m is not None:
+                            chain_dot = i
+                            chain_match = m.end()
+                    if i + 1 < end and text[i] in ".-" and text[i + 1] in _ALNUM:
+                        i += 1
+                    else:
+                        break
+                chain_end = i
+
+            if chain_dot is not None and pos < chain_dot:
+                match_end = chain_match
+
+        if match_end is not None:
+            yield pos, match_end
+            pos = match_end
+        else:
+            pos += 1
+
+
+def scan(text):
+    """Yields (start, end) for each URL in `text`, in order.
+
+    Equivalent to ((m.start(), m.end()) for m in re.finditer(URL_REGEX,
+    text)), but runs in time linear in len(text).
+    """
+    pos = 0
+    for anchor in _ANCHOR_REGEX.finditer(text):
+        if anchor.start() < pos:
+            continue
+
+        # find the run of non-whitespace characters around the anchor
+        start = anchor.start()
+        while start > pos and not text[start - 1].isspace():
+            start -= 1
+        end = _NON_WHITESPACE_REGEX.match(text, anchor.start()).end()
+
+        yield from _scan_segment(text, start, end)
+        pos = end
+
+
+if __name__ == "__main__":
+    text = sys.stdin.read()
+    for start, end in scan(text):
+        print(text[start:end])
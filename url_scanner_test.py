@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import random
+import re
+import time
+import unittest
+from parameterized import parameterized
+
+from url_scanner import scan, URL_REGEX
+
+REGEX = re.compile(URL_REGEX)
+
+# pieces of text to build test inputs from
+PIECES = [
+    "http://",
+    "https://",
+    "HTTPS:/",
+    "http:x",
+    "www.",
+    "example",
+    ".com",
+    ".co.uk",
+    ".org/",
+    "/path",
+    "(x)",
+    "(a(b)c)",
+    "((",
+    "))",
+    "?q=1&r=2",
+    "#frag",
+    "!",
+    ".",
+    ",",
+    " ",
+    "\n",
+    "@",
+    "<",
+    ">",
+    '"',
+    "'",
+    "[",
+    "]",
+    "{",
+    "}",
+    "-",
+    "_",
+    "%20",
+    "é",
+    "ſ",
+    "urldefense.com/v3/__",
+    "__;Iw!!",
+    "$",
+    "*",
+    ";",
+    ":",
+]
+
+
+def regex_spans(text):
+    return [(m.start(), m.end()) for m in REGEX.finditer(text)]
+
+
+class TestScan(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ["http://www.example.com/path"],
+            ["see <https://example.com/a?b=c>, or (www.example.com)."],
+            ["http://a/(b)c) http://a/(b(c)d)e http://a/((((x"],
+            ["foo@example.com example.com/bar@ x.co.uk/"],
+            ["https://urldefense.com/v3/__http://www.example.com__;!!foo!bar$"],
+            ["http://a/!!!!!!!! trailing punctuation"],
+            ["no urls at all"],
+            [""],
+        ]
+    )
+    def test_examples(self, text):
+        self.assertEqual(list(scan(text)), regex_spans(text))
+
+    def test_urls_plain(self):
+        with open("tests/urls-plain.txt") as f:
+            text = f.read()
+        self.assertEqual(list(scan(text)), regex_spans(text))
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(3000):
+            text = "".join(rng.choice(PIECES) for _ in range(rng.randint(1, 10)))
+            self.assertEqual(list(scan(text)), regex_spans(text), repr(text))
+
+    @parameterized.expand(
+        [
+            ["trailing punctuation", lambda n: "http://a/" + "!" * n + " "],
+            ["open parens", lambda n: "http://a/" + "(" * n],
+            ["nested parens", lambda n: "http://a/" + "((a)" * n],
+            ["dotted labels", lambda n: "a." * n + "x"],
+        ]
+    )
+    def test_adversarial(self, name, family):
+        # URL_REGEX takes minutes on the first of these for n = 30; a linear
+        # scan of 200k characters takes well under a second
+        start = time.perf_counter()
+        list(scan(family(200000)))
+        self.assertLess(time.perf_counter() - start, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
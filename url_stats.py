@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+#
+# url_stats.py - memory-bounded statistics over (many) cleaned URLs
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# usage:
+#   ./get_urls.py --stats part1.json < message
+#   ./url_stats.py merge all.json part1.json part2.json ...
+#   ./url_stats.py report all.json
+#
+
+import argparse
+import array
+import base64
+import fcntl
+import hashlib
+import heapq
+import json
+import math
+import os
+import sys
+import urllib.parse
+
+#
+# counting the unique URLs (or top domains) in 10^9 URLs exactly takes more
+# memory than we have, so we use sketches instead: fixed-size summaries with
+# a configurable error, that can be merged. workers can each build a sketch
+# of part of the input, and the sketches are merged at the end.
+#
+#   HyperLogLog      number of distinct items, within `error` (relative
+#                    standard error) using 2^p one-byte registers, where
+#                    p = log2((1.04 / error)^2)
+#   CountMinSketch   frequency of an item, overestimated by at most
+#                    `epsilon` * (total count) with probability 1 - `delta`,
+#                    using e/epsilon x ln(1/delta) counters
+#
+# UrlStats combines them: one HyperLogLog for all cleaned URLs, a
+# CountMinSketch of domains, and for the `top` most frequent domains, a
+# (smaller) HyperLogLog of their unique URLs.
+#
+# a domain's HyperLogLog only starts when the domain enters the top, and the
+# URLs seen before then are gone, so its unique URL count is too low by up
+# to the number of those URLs. the report gives that number (estimated) as
+# `untracked_urls`: unique_urls is exact(ish) only when it's 0.
+#
+
+
+def _hash(item, size=8):
+    return int.from_bytes(
+        hashlib.blake2b(
+            item.encode("utf-8", "surrogatepass"), digest_size=size
+        ).digest(),
+        "big",
+    )
+
+
+class HyperLogLog:
+    def __init__(self, error=0.01, p=None):
+        if p is None:
+            p = math.ceil(math.log2((1.04 / error) ** 2))
+        if not 4 <= p <= 18:
+            raise ValueError(f"precision out of range (4-18): {p}")
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, item):
+        h = _hash(item)
+        i = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        # position of the leftmost 1-bit in the remaining 64 - p bits
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("can't merge HyperLogLogs of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+
+        # small range correction: linear counting
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros != 0:
+            estimate = m * math.log(m / zeros)
+
+        return round(estimate)
+
+    def to_dict(self):
+        return {
+            "p": self.p,
+            "registers": base64.b64encode(self.registers).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        hll = cls(p=d["p"])
+        hll.registers = bytearray(base64.b64decode(d["registers"]))
+        return hll
+
+
+class CountMinSketch:
+    def __init__(self, epsilon=0.001, delta=0.01, width=None, depth=None):
+        self.width = width or math.ceil(math.e / epsilon)
+        self.depth = depth or math.ceil(math.log(1 / delta))
+        self.total = 0
+        self.counts = array.array("Q", bytes(8 * self.width * self.depth))
+
+    def _cells(self, item):
+        # double hashing: `depth` hash functions from one 128-bit hash
+        h = _hash(item, 16)
+        h1, h2 = h >> 64, h & ((1 << 64) - 1)
+        for row in range(self.depth):
+            yield row * self.width + (h1 + row * h2) % self.width
+
+    def add(self, item, count=1):
+        self.total += count
+        for cell in self._cells(item):
+            self.counts[cell] += count
+
+    def estimate(self, item):
+        return min(self.counts[cell] for cell in self._cells(item))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge CountMinSketches of different size")
+        self.total += other.total
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+    def to_dict(self):
+        return {
+            "width": self.width,
+            "depth": self.depth,
+            "total": self.total,
+            "counts": base64.b64encode(self.counts.tobytes()).decode("ascii"),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        cms = cls(width=d["width"], depth=d["depth"])
+        cms.total = d["total"]
+        cms.counts = array.array("Q")
+        cms.counts.frombytes(base64.b64decode(d["counts"]))
+        return cms
+
+
+class UrlStats:
+    def __init__(
+        self, error=0.01, domain_error=0.05, epsilon=0.001, delta=0.01, top=100
+    ):
+        if top < 1:
+            raise ValueError("top must be at least 1")
+        self.urls = HyperLogLog(error)
+        self.domains = CountMinSketch(epsilon, delta)
+        self.domain_error = domain_error
+        self.top = top
+        # domain -> HyperLogLog of its URLs, for the `top` domains
+        self.top_domains = {}
+        # domain -> number of its URLs seen before its HyperLogLog started
+        self.untracked = {}
+        # a lower bound on the smallest estimated count in top_domains
+        self._threshold = 0
+
+    def add(self, url):
+        # URLs without a scheme, e.g., www.example.com/path
+        netloc_url = url if "//" in url else "//" + url
+        try:
+            domain = urllib.parse.urlsplit(netloc_url).hostname or ""
+        except ValueError:
+            # e.g., "http://[x/" (an invalid IPv6 address): counted, under
+            # no domain, like URLs without a host
+            domain = ""
+
+        self.urls.add(url)
+        self.domains.add(domain)
+
+        if domain not in self.top_domains:
+            # estimates only grow, so if this domain can't beat the lowest
+            # count we last saw, it can't beat the current lowest either
+            count = self.domains.estimate(domain)
+            if len(self.top_domains) >= self.top and count <= self._threshold:
+                return
+
+            self.top_domains[domain] = HyperLogLog(self.domain_error)
+            self.untracked[domain] = count - 1
+            self._evict()
+
+        if domain in self.top_domains:
+            self.top_domains[domain].add(url)
+
+    def _evict(self):
+        # keep the `top` domains with the highest estimated counts
+        if len(self.top_domains) < self.top:
+            return
+
+        counts = {d: self.domains.estimate(d) for d in self.top_domains}
+        for domain in heapq.nsmallest(len(counts) - self.top, counts, key=counts.get):
+            del self.top_domains[domain]
+            del self.untracked[domain]
+            del counts[domain]
+        self._threshold = min(counts.values())
+
+    def merge(self, other):
+        if (
+            other.urls.p != self.urls.p
+            or (other.domains.width, other.domains.depth)
+            != (self.domains.width, self.domains.depth)
+            or other.domain_error != self.domain_error
+        ):
+            raise ValueError("can't merge UrlStats with different error bounds")
+
+        # a domain's URLs in a sketch where it wasn't in the top are untracked
+        for domain in self.top_domains.keys() - other.top_domains.keys():
+            self.untracked[domain] += other.domains.estimate(domain)
+        for domain, hll in other.top_domains.items():
+            if domain not in self.top_domains:
+                self.top_domains[domain] = HyperLogLog(p=hll.p)
+                self.untracked[domain] = self.domains.estimate(domain)
+            self.top_domains[domain].merge(hll)
+            self.untracked[domain] += other.untracked[domain]
+
+        self.urls.merge(other.urls)
+        self.domains.merge(other.domains)
+        self._evict()
+
+    def report(self):
+        top_domains = sorted(
+            ((self.domains.estimate(d), d) for d in self.top_domains), reverse=True
+        )
+        return {
+            "urls": self.domains.total,
+            "unique_urls": len(self.urls),
+            "top_domains": [
+                {
+                    "domain": domain,
+                    "urls": count,
+                    "unique_urls": len(self.top_domains[domain]),
+                    "untracked_urls": self.untracked[domain],
+                }
+                for count, domain in top_domains
+            ],
+        }
+
+    def to_dict(self):
+        return {
+            "urls": self.urls.to_dict(),
+            "domains": self.domains.to_dict(),
+            "domain_error": self.domain_error,
+            "top": self.top,
+            "top_domains": {d: hll.to_dict() for d, hll in self.top_domains.items()},
+            "untracked": self.untracked,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls.__new__(cls)
+        stats.urls = HyperLogLog.from_dict(d["urls"])
+        stats.domains = CountMinSketch.from_dict(d["domains"])
+        stats.domain_error = d["domain_error"]
+        stats.top = d["top"]
+        stats.top_domains = {
+            domain: HyperLogLog.from_dict(hll)
+            for domain, hll in d["top_domains"].items()
+        }
+        stats.untracked = dict(d["untracked"])
+        stats._threshold = 0
+        stats._evict()
+        return stats
+
+
+def load(path):
+    with open(path) as f:
+        return UrlStats.from_dict(json.load(f))
+
+
+def update_stats_file(path, stats):
+    """Merges `stats` into the UrlStats stored as JSON in the file at `path`,
+    creating it if needed. Like decode_email.update_counters_file(), the file
+    is locked while it's updated."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        data = f.read()
+        if data:
+            totals = UrlStats.from_dict(json.loads(data))
+            totals.merge(stats)
+        else:
+            totals = stats
+
+        f.seek(0)
+        f.truncate()
+        json.dump(totals.to_dict(), f)
+        f.write("\n")
+
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="merge and report URL statistics (see get_urls.py --stats)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="merge statistics files")
+    merge_parser.add_argument("output", help="write merged statistics to this file")
+    merge_parser.add_argument("input", nargs="+", help="statistics file")
+
+    report_parser = subparsers.add_parser(
+        "report", help="print (merged) statistics as JSON"
+    )
+    report_parser.add_argument("input", nargs="+", help="statistics file")
+
+    args = parser.parse_args()
+
+    stats = load(args.input[0])
+    for path in args.input[1:]:
+        stats.merge(load(path))
+
+    if args.command == "merge":
+        with open(args.output, "w") as f:
+            json.dump(stats.to_dict(), f)
+            f.write("\n")
+    else:
+        json.dump(stats.report(), sys.stdout, indent=2)
+        print()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+#
+# To the extent possible under law, the author(s) have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software.
+#
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+
+import json
+import os
+import random
+import tempfile
+import unittest
+from parameterized import parameterized
+
+from url_stats import HyperLogLog, CountMinSketch, UrlStats, update_stats_file
+
+
+def urls(n, seed=0):
+    # URLs on a few popular domains and many rare ones (zipf-ish)
+    rng = random.Random(seed)
+    for i in range(n):
+        domain = f"d{int(rng.paretovariate(1.0))}.example.com"
+        yield f"https://{domain}/{rng.randrange(n)}"
+
+
+class TestHyperLogLog(unittest.TestCase):
+    @parameterized.expand([[0.05, 100], [0.05, 20000], [0.02, 50000]])
+    def test_error(self, error, n):
+        hll = HyperLogLog(error)
+        for i in range(n):
+            hll.add(str(i))
+            hll.add(str(i))
+        # 3 standard errors
+        self.assertAlmostEqual(len(hll), n, delta=3 * error * n)
+
+    def test_merge(self):
+        a, b, both = HyperLogLog(0.05), HyperLogLog(0.05), HyperLogLog(0.05)
+        for i in range(10000):
+            (a if i % 2 else b).add(str(i))
+            both.add(str(i))
+        a.merge(b)
+        self.assertEqual(a.registers, both.registers)
+
+        with self.assertRaises(ValueError):
+            a.merge(HyperLogLog(0.01))
+
+    def test_to_dict(self):
+        hll = HyperLogLog(0.05)
+        for i in range(1000):
+            hll.add(str(i))
+        copy = HyperLogLog.from_dict(json.loads(json.dumps(hll.to_dict())))
+        self.assertEqual(copy.registers, hll.registers)
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_error(self):
+        cms = CountMinSketch(epsilon=0.01, delta=0.01)
+        exact = {}
+        for url in urls(20000):
+            domain = url.split("/")[2]
+            cms.add(domain)
+            exact[domain] = exact.get(domain, 0) + 1
+        for item, count in exact.items():
+            self.assertGreaterEqual(cms.estimate(item), count)
+            self.assertLessEqual(cms.estimate(item), count + 0.01 * cms.total)
+
+    def test_merge(self):
+        a, b = CountMinSketch(0.01), CountMinSketch(0.01)
+        a.add("x", 3)
+        b.add("x", 4)
+        b.add("y")
+        a.merge(b)
+        self.assertEqual(a.estimate("x"), 7)
+        self.assertEqual(a.total, 8)
+
+        with self.assertRaises(ValueError):
+            a.merge(CountMinSketch(0.1))
+
+
+class TestUrlStats(unittest.TestCase):
+    def exact(self, items):
+        counts = {}
+        unique = {}
+        for url in items:
+            domain = url.split("/")[2]
+            counts[domain] = counts.get(domain, 0) + 1
+            unique.setdefault(domain, set()).add(url)
+        return counts, unique
+
+    def check(self, stats, items):
+        counts, unique = self.exact(items)
+        report = stats.report()
+
+        self.assertEqual(report["urls"], len(items))
+        self.assertAlmostEqual(
+            report["unique_urls"], len(set(items)), delta=0.03 * len(set(items))
+        )
+
+        top = sorted(counts, key=counts.get, reverse=True)[:5]
+        reported = [d["domain"] for d in report["top_domains"][:5]]
+        self.assertEqual(reported, top)
+        for d in report["top_domains"][:5]:
+            self.assertAlmostEqual(
+                d["unique_urls"],
+                len(unique[d["domain"]]),
+                delta=0.15 * len(unique[d["domain"]]),
+            )
+
+    def test_report(self):
+        items = list(urls(20000))
+        stats = UrlStats(top=10)
+        for url in items:
+            stats.add(url)
+        self.check(stats, items)
+        self.assertEqual(len(stats.report()["top_domains"]), 10)
+
+    def test_merge(self):
+        # e.g., one worker per archive, merged at the end
+        items = list(urls(20000))
+        workers = [UrlStats(top=10) for _ in range(4)]
+        for i, url in enumerate(items):
+            workers[i % 4].add(url)
+
+        stats = UrlStats.from_dict(json.loads(json.dumps(workers[0].to_dict())))
+        for worker in workers[1:]:
+            stats.merge(worker)
+        self.check(stats, items)
+
+        with self.assertRaises(ValueError):
+            stats.merge(UrlStats(error=0.1))
+
+    @parameterized.expand([("one", False), ("merged", True)])
+    def test_untracked(self, _, merged):
+        # b.example.com only makes it into the top after a.example.com's
+        # first URLs: those aren't in its unique URL count
+        items = [f"https://a.example.com/{i}" for i in range(10)]
+        items += [f"https://b.example.com/{i}" for i in range(20)]
+        if merged:
+            stats = UrlStats(top=1)
+            for url in items[:15]:
+                stats.add(url)
+            other = UrlStats(top=1)
+            for url in items[15:]:
+                other.add(url)
+            stats.merge(other)
+        else:
+            stats = UrlStats(top=1)
+            for url in items:
+                stats.add(url)
+
+        (domain,) = stats.report()["top_domains"]
+        self.assertEqual(domain["domain"], "b.example.com")
+        self.assertEqual(domain["urls"], 20)
+        self.assertEqual(domain["unique_urls"] + domain["untracked_urls"], 20)
+        self.assertGreater(domain["untracked_urls"], 0)
+
+        stats = UrlStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+        self.assertEqual(stats.report()["top_domains"], [domain])
+
+    def test_top(self):
+        with self.assertRaises(ValueError):
+            UrlStats(top=0)
+
+    def test_no_scheme(self):
+        stats = UrlStats()
+        stats.add("www.example.com/path")
+        self.assertEqual(stats.report()["top_domains"][0]["domain"], "www.example.com")
+
+    def test_invalid_host(self):
+        stats = UrlStats()
+        stats.add("http://[x/")
+        stats.add("https://www.example.com/")
+        report = stats.report()
+        self.assertEqual(report["urls"], 2)
+        self.assertEqual(
+            sorted(d["domain"] for d in report["top_domains"]), ["", "www.example.com"]
+        )
+
+    def test_update_stats_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stats.json")
+            for url in ["https://a.example.com/", "https://b.example.com/"]:
+                stats = UrlStats()
+                stats.add(url)
+                update_stats_file(path, stats)
+            totals = update_stats_file(path, UrlStats())
+            self.assertEqual(totals.report()["urls"], 2)
+            self.assertEqual(totals.report()["unique_urls"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()